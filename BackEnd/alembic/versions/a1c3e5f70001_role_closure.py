@@ -0,0 +1,50 @@
+"""role closure table
+
+Revision ID: a1c3e5f70001
+Revises: 
+Create Date: 2026-10-18 12:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a1c3e5f70001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+role = sa.table('role', sa.column('id', sa.Integer), sa.column('parent_id', sa.Integer))
+role_closure = sa.table('role_closure', sa.column('ancestor_id', sa.Integer), sa.column('descendant_id', sa.Integer), sa.column('depth', sa.Integer))
+
+
+def upgrade():
+    op.create_table(
+        'role_closure',
+        sa.Column('ancestor_id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('descendant_id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('depth', sa.Integer(), server_default='0', nullable=False),
+        sa.PrimaryKeyConstraint('ancestor_id', 'descendant_id'),
+    )
+    op.create_index('role_closure_descendant_id_index', 'role_closure', ['descendant_id', 'ancestor_id'], unique=False)
+    
+    # 用parent_id回填，grand_id是VARCHAR(126)，层级深的时候会被截断，不可靠
+    connection = op.get_bind()
+    parent_map = {i: p for i, p in connection.execute(sa.select([role.c.id, role.c.parent_id]))}
+    rows = []
+    for role_id in parent_map:
+        rows.append({'ancestor_id': role_id, 'descendant_id': role_id, 'depth': 0})
+        depth, parent_id, seen = 1, parent_map[role_id], {role_id}
+        while parent_id and parent_id in parent_map and parent_id not in seen:
+            rows.append({'ancestor_id': parent_id, 'descendant_id': role_id, 'depth': depth})
+            seen.add(parent_id)
+            depth, parent_id = depth + 1, parent_map[parent_id]
+    
+    for i in range(0, len(rows), 1000):
+        op.bulk_insert(role_closure, rows[i:i + 1000])
+
+
+def downgrade():
+    op.drop_index('role_closure_descendant_id_index', table_name='role_closure')
+    op.drop_table('role_closure')
@@ -0,0 +1,39 @@
+"""user2role unique membership
+
+Revision ID: b2d4f6a80002
+Revises: a1c3e5f70001
+Create Date: 2026-10-18 14:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b2d4f6a80002'
+down_revision = 'a1c3e5f70001'
+branch_labels = None
+depends_on = None
+
+user2role = sa.table('user2role', sa.column('id', sa.Integer), sa.column('user_id', sa.Integer), sa.column('role_id', sa.Integer))
+
+
+def upgrade():
+    # 以前 users:add 没有去重，先删掉重复的关联，每一对 (user_id, role_id) 保留id最小的一行
+    connection = op.get_bind()
+    seen, duplicate_ids = set(), []
+    for i, user_id, role_id in connection.execute(sa.select([user2role.c.id, user2role.c.user_id, user2role.c.role_id]).order_by(user2role.c.id)):
+        if (user_id, role_id) in seen:
+            duplicate_ids.append(i)
+        seen.add((user_id, role_id))
+    
+    for i in range(0, len(duplicate_ids), 1000):
+        connection.execute(user2role.delete().where(user2role.c.id.in_(duplicate_ids[i:i + 1000])))
+    
+    op.drop_index('user_id2role_id_index', table_name='user2role')
+    op.create_index('user_id2role_id_index', 'user2role', ['user_id', 'role_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index('user_id2role_id_index', table_name='user2role')
+    op.create_index('user_id2role_id_index', 'user2role', ['user_id', 'role_id'], unique=False)
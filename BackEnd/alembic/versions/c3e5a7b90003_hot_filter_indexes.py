@@ -0,0 +1,35 @@
+"""indexes for hot filters
+
+Revision ID: c3e5a7b90003
+Revises: b2d4f6a80002
+Create Date: 2026-10-18 16:00:00
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3e5a7b90003'
+down_revision = 'b2d4f6a80002'
+branch_labels = None
+depends_on = None
+
+# (索引名, 表, 列)，和model里的定义保持一致
+INDEXES = (
+    ('ix_form_phone', 'form', ['phone']),
+    ('ix_form_in_time_real', 'form', ['in_time_real']),
+    ('ix_form_out_time_real', 'form', ['out_time_real']),
+    ('role_id2permission_id_index', 'permission2role', ['role_id', 'permission_id']),
+    ('permission2role_permission_id_index', 'permission2role', ['permission_id']),
+    ('user2role_role_id_index', 'user2role', ['role_id']),
+)
+
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
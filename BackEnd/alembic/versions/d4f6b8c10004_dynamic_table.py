@@ -0,0 +1,33 @@
+"""dynamic table registry for month partitioned form
+
+Revision ID: d4f6b8c10004
+Revises: c3e5a7b90003
+Create Date: 2026-10-18 18:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4f6b8c10004'
+down_revision = 'c3e5a7b90003'
+branch_labels = None
+depends_on = None
+
+# form_YYYYMM 这样的分表在第一次写入的时候由 DynamicModelMixin 建，这里只建登记它们的表
+
+
+def upgrade():
+    op.create_table(
+        'dynamic_table',
+        sa.Column('name', sa.VARCHAR(126), primary_key=True),
+        sa.Column('prefix', sa.VARCHAR(126), nullable=False),
+        sa.Column('suffix', sa.VARCHAR(126), nullable=False),
+    )
+    op.create_index('ix_dynamic_table_prefix', 'dynamic_table', ['prefix'])
+
+
+def downgrade():
+    op.drop_index('ix_dynamic_table_prefix', table_name='dynamic_table')
+    op.drop_table('dynamic_table')
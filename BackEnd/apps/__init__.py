@@ -7,16 +7,24 @@ from starlette.middleware.cors import CORSMiddleware, ALL_METHODS, SAFELISTED_HE
 
 from apps.a_common.db import Base
 from apps.a_common.error import AppError, ER, exception_handler, exceptions, PermissionError
-from apps.foundation import engine
+from apps.a_common.metrics import register_collector
+from apps.a_common.replica import SAFE_METHODS, mark_read_after_write, replica_set
+from apps.a_common.sql_trace import finish_request_trace, start_request_trace
+from apps.foundation import database, engine
+from apps.logic.permission_index import permission_index
+from apps.logic.role_tree import load_role_tree, role_tree
 from apps.logconfig import init_logger_config
 from apps.view.constants import constants_prefix, constants_router, constants_router
 from apps.view.file import file_prefix, file_router, file_router
+from apps.view.job import job_prefix, job_router
 from apps.view.manage_user import manage_user_prefix, manage_user_router
+from apps.view.metrics import metrics_prefix, metrics_router
 from apps.view.permission import permission_prefix, permission_router
 from apps.view.user import user_prefix, user_router, user_router
 from apps.view.role import role_prefix, role_router, role_router
 from apps.view.form import form_prefix, form_router, form_router
 from config import API_PREFIX, DEBUG, DEFAULT_APP_NAME
+from utils.encode import hash_pool_stats, shutdown_hash_pool
 
 # 命名规则如下，蓝图加上后缀，避免发生命名冲突，所有的资源都以复数形式呈现
 
@@ -29,6 +37,8 @@ ROUTERS = [
     (permission_router, [permission_prefix], permission_prefix),
     (manage_user_router, [manage_user_prefix], manage_user_prefix),
     (form_router, [form_prefix], form_prefix),
+    (metrics_router, [metrics_prefix], metrics_prefix),
+    (job_router, [job_prefix], job_prefix),
 ]
 
 
@@ -73,9 +83,20 @@ def add_middleware(app: FastAPI):
     @app.middleware("http")
     async def request_timer_mark(request: Request, call_next):
         start_time = time.time()
+        trace = start_request_trace(request.url.path)
+        try:
+            response = await call_next(request)
+        finally:
+            process_time = time.time() - start_time
+            logger.info(f'{request.url} cost: {process_time} sql: {trace.count} queries {trace.duration:.4f}')
+            finish_request_trace(trace)
+        return response
+    
+    @app.middleware("http")
+    async def read_after_write(request: Request, call_next):
         response = await call_next(request)
-        process_time = time.time() - start_time
-        logger.info(f'{request.url} cost: {process_time}')
+        if replica_set.replicas and request.method not in SAFE_METHODS:
+            mark_read_after_write(response)
         return response
     
     @app.exception_handler(AppError)
@@ -89,7 +110,14 @@ def add_middleware(app: FastAPI):
 
 def init_foundations(app: FastAPI):
     init_logger_config()
-    pass
+    register_collector('hash_pool', hash_pool_stats)
+    register_collector('role_tree', role_tree.stats)
+    register_collector('permission_index', permission_index.stats)
+    app.add_event_handler('startup', load_role_tree)
+    app.add_event_handler('startup', database.connect)
+    app.add_event_handler('shutdown', database.disconnect)
+    app.add_event_handler('shutdown', replica_set.disconnect)
+    app.add_event_handler('shutdown', shutdown_hash_pool)
 
 
 app = create_app()
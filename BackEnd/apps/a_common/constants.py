@@ -5,6 +5,10 @@ from typing_extensions import Literal
 """ 这里放一些不会改变的东西 比如类型到数字的映射关系 """
 
 MANAGE_ROLE_PERMISSION_NAME = 'manage-user:{role_id}'
+# 带参数的权限写成 动作:参数，参数可以是 角色id、角色id/*（这个角色和它所有的子角色）、*（全部）
+MANAGE_ROLE_SUBTREE_PERMISSION_NAME = 'manage-user:{role_id}/*'
+PERMISSION_WILDCARD = '*'
+PERMISSION_SUBTREE_SUFFIX = '/*'
 
 
 def to_choice(cls: object) -> Tuple:
@@ -1,12 +1,24 @@
+import base64
+import json
 from contextlib import contextmanager
 from logging import getLogger
+from typing import Iterable, List, Optional, Sequence, Tuple, Union
 
-from sqlalchemy import func, or_
+from databases import Database
+from sqlalchemy import BigInteger, Column, MetaData, Table, VARCHAR, and_, event, false, func, or_, select, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.ext import baked
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Query, Session
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.util import find_tables
+from starlette.concurrency import run_in_threadpool
 
-from apps.a_common.error import NotFound
-from apps.foundation import SessionLocal
+from apps.a_common.cache import LRUCache
+from apps.a_common.error import InvalidParamError, NotFound
+from apps.a_common.metrics import register_collector
+from apps.foundation import SessionLocal, database, engine
+from utils.encode import uuid
 
 """
 约定
@@ -48,8 +60,104 @@ def fast_count(query: Query) -> int:
     return total or 0  # total could be None
 
 
+# 热点查询用 bakery 缓存构造好的Query和编译好的sql，第二次调用起只绑定参数，用法见 apps/crud/user.py 的 get_user_by_id
+# 缓存的key是lambda的代码位置，所以lambda里不能引用外面的变量，参数都用bindparam
+BAKERY_SIZE = 200
+bakery = baked.bakery(size=BAKERY_SIZE)
+
+
+class CountMode:
+    EXACT = 'exact'  # 每次都count
+    CACHED = 'cached'  # 精确的count，按sql缓存，表有写入就失效（只有当前worker里的写入，见 _table_versions）
+    ESTIMATE = 'estimate'  # 没有过滤条件的列表，用数据库的统计信息估算
+    NONE = 'none'  # 不count，多取一行判断有没有下一页
+
+
+COUNT_CACHE_TTL = 30
+count_cache = LRUCache(maxsize=1024, ttl=COUNT_CACHE_TTL)
+register_collector('count_cache', count_cache.stats)
+
+# 每张表的写入版本，执行 insert/update/delete 时+1，缓存的key里带上相关表的版本，写入之后旧的缓存自然就用不到了
+# 这里是sql执行时就+1，还没commit的时候别的请求可能又缓存了旧的值，所以缓存的时间不要太长
+# 版本和缓存都在进程内，每个worker一份，别的worker（或者manage.py、直接改数据库）的写入不会让这里失效
+# 所以 CACHED 的count最多比数据库旧 COUNT_CACHE_TTL 秒，要求准确的列表用 EXACT
+_table_versions = {}
+
+
+def bump_table_version(name: str):
+    """ 让这张表的count缓存失效，经过engine的写入会自动调用，databases的异步写入要自己调用 """
+    _table_versions[name] = _table_versions.get(name, 0) + 1
+
+
+@event.listens_for(Engine, 'after_execute')
+def _bump_table_version(conn, clauseelement, multiparams, params, result):
+    if isinstance(clauseelement, UpdateBase) and getattr(clauseelement, 'table', None) is not None:
+        bump_table_version(clauseelement.table.name)
+
+
+def _count_cache_key(query: Query, key: str = None) -> str:
+    """ 调用方给了key（接口名加上过滤参数）就不用每次编译sql，没给的时候用编译出来的sql和参数 """
+    statement = query.statement
+    tables = sorted({t.name for t in find_tables(statement, include_aliases=True)})
+    versions = [(t, _table_versions.get(t, 0)) for t in tables]
+    if key is not None:
+        return f'{key}|{versions}'
+    compiled = statement.compile(dialect=query.session.get_bind().dialect)
+    return f'{compiled}|{sorted((k, repr(v)) for k, v in compiled.params.items())}|{versions}'
+
+
+def _estimate_count(query: Query) -> Optional[int]:
+    """ 只有单表、没有where、没有group by的才估算，估算不了返回None """
+    statement = query.statement
+    if statement._whereclause is not None or query._group_by or len(statement.froms) != 1 or not hasattr(statement.froms[0], 'name'):
+        return None
+    
+    table_name = statement.froms[0].name
+    dialect_name = query.session.get_bind().dialect.name
+    if dialect_name == 'mysql':
+        sql = 'SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :name'
+    elif dialect_name == 'postgresql':
+        sql = 'SELECT reltuples::bigint FROM pg_class WHERE relname = :name'
+    else:
+        return None
+    total = query.session.execute(text(sql), {'name': table_name}).scalar()
+    return None if total is None or total < 0 else int(total)
+
+
+def count_query(query: Query, mode: str = CountMode.EXACT, key: str = None) -> Tuple[Optional[int], str]:
+    """ 按mode统计数量，返回 (数量, 实际使用的mode)，估算不了的时候退回到缓存的精确count，NONE返回None，key 见 _count_cache_key """
+    if mode == CountMode.NONE:
+        return None, CountMode.NONE
+    
+    if mode == CountMode.ESTIMATE:
+        total = _estimate_count(query)
+        if total is not None:
+            return total, CountMode.ESTIMATE
+        mode = CountMode.CACHED
+    
+    if mode == CountMode.CACHED:
+        cache_key = _count_cache_key(query, key)
+        total = count_cache.get(cache_key)
+        if total is None:
+            total = fast_count(query)
+            count_cache.set(cache_key, total)
+        return total, CountMode.CACHED
+    
+    return fast_count(query), CountMode.EXACT
+
+
+def _default_order_by(query: Query) -> Query:
+    """ 没有ORDER BY的时候按主键排序，否则 LIMIT/OFFSET 每次返回的结果可能不一样 """
+    if query._order_by or query._group_by or len(query.column_descriptions) != 1:
+        return query
+    mapper = getattr(query.column_descriptions[0]['entity'], '__mapper__', None)
+    if mapper is None or query.column_descriptions[0]['type'] is not query.column_descriptions[0]['entity']:
+        return query
+    return query.order_by(*mapper.primary_key)
+
+
 class Pagination:
-    def __init__(self, query: Query, page_id=1, page_size=20, page_info=None):
+    def __init__(self, query: Query, page_id=1, page_size=20, page_info=None, count_mode: str = CountMode.EXACT, count_key: str = None):
         if page_info:
             page_id = page_info.page_id
             page_size = page_info.page_size
@@ -58,13 +166,20 @@ class Pagination:
             logger.info(f'page_id: {page_id}, page_size: {page_size}, page_info: {page_info}')
             raise NotFound()
         
-        total = fast_count(query)
-        if total and total > 0:
-            items = query.limit(page_size).offset((page_id - 1) * page_size).all()
+        total, self.count_mode = count_query(query, count_mode, count_key)
+        if total is None:
+            # 不count的时候多取一行，用来判断有没有下一页
+            items = _default_order_by(query).limit(page_size + 1).offset((page_id - 1) * page_size).all()
+            self.has_more = len(items) > page_size
+            items = items[:page_size]
+        elif total > 0:
+            items = _default_order_by(query).limit(page_size).offset((page_id - 1) * page_size).all()
+            self.has_more = page_id * page_size < total
         else:
             total = 0
             page_id = 1
             items = []
+            self.has_more = False
         
         self.items = items
         self.page_id = page_id
@@ -73,9 +188,7 @@ class Pagination:
     
     @property
     def next_page_id(self):
-        if self.page_id * self.page_size >= self.total:
-            return None
-        return self.page_id + 1
+        return self.page_id + 1 if self.has_more else None
     
     @property
     def prev_page_id(self):
@@ -84,6 +197,123 @@ class Pagination:
         return self.page_id - 1
 
 
+def encode_cursor(values: list, forward: bool) -> str:
+    data = json.dumps({'v': values, 'f': forward}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, size: int) -> Tuple[list, bool]:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        values, forward = data['v'], data['f']
+    except (ValueError, KeyError, TypeError):
+        raise InvalidParamError(['cursor'])
+    if not isinstance(values, list) or len(values) != size or not all(isinstance(v, int) for v in values):
+        raise InvalidParamError(['cursor'])
+    return values, bool(forward)
+
+
+def keyset_bounds(page_info, size: int, desc: bool = False) -> Optional[Tuple[Optional[list], bool, int]]:
+    """
+    游标分页时返回 (游标的值, 是否倒序取, 要取的行数)，第一页游标的值是None，不是游标分页返回None
+    KeysetPagination 用的就是这个，UNION ALL 之类的子查询可以用它把条件和LIMIT下推到每个分支里，见 apps/crud/form.py 的 form_union
+    """
+    if getattr(page_info, 'cursor', None) is None:
+        return None
+    values, forward = None, True
+    if page_info.cursor:
+        values, forward = decode_cursor(page_info.cursor, size)
+    # 往前翻的时候倒过来排序，取出来之后再反转
+    return values, desc == forward, page_info.page_size + 1
+
+
+def keyset_after(keyset: Sequence, values: list, reverse: bool):
+    """ (c1, c2, ...) 按字典序严格排在 values 后面，展开成 or/and，MySQL下比行值比较更容易走索引 """
+    conditions = []
+    for n, column in enumerate(keyset):
+        equal = [keyset[k] == values[k] for k in range(n)]
+        conditions.append(and_(*equal, column < values[n] if reverse else column > values[n]))
+    return or_(*conditions)
+
+
+class KeysetPagination:
+    """
+    游标分页，按 keyset 里的列排序（最后一列要唯一，一般是id），用上一页最后一行的值作为下一页的起点
+    不算总数，翻到多深都只扫描 page_size+1 行，keyset 里的列要有索引，值为NULL的行不会出现
+    cursor 为空字符串时是第一页，之后用 next_cursor / prev_cursor
+    """
+    
+    def __init__(self, query: Query, keyset: Sequence, page_info, desc: bool = False):
+        self.keyset = tuple(keyset)
+        self.page_size = page_info.page_size
+        self.desc = desc
+        
+        values, reverse, limit = keyset_bounds(page_info, len(self.keyset), desc)
+        forward = desc == reverse
+        
+        for column in self.keyset:
+            query = query.filter(column.isnot(None))
+        if values is not None:
+            query = query.filter(keyset_after(self.keyset, values, reverse))
+        order = [c.desc() if reverse else c.asc() for c in self.keyset]
+        items = query.order_by(None).order_by(*order).limit(limit).all()
+        
+        has_more = len(items) > self.page_size
+        items = items[:self.page_size]
+        if not forward:
+            items.reverse()
+        
+        self.items = items
+        self.total = None
+        self.count_mode = CountMode.NONE
+        self.has_next = has_more if forward else True
+        self.has_prev = (values is not None) if forward else has_more
+    
+    def _key(self, item) -> list:
+        return [getattr(item, column.key) for column in self.keyset]
+    
+    @property
+    def next_cursor(self) -> Optional[str]:
+        if not self.has_next or not self.items:
+            return None
+        return encode_cursor(self._key(self.items[-1]), True)
+    
+    @property
+    def prev_cursor(self) -> Optional[str]:
+        if not self.has_prev or not self.items:
+            return None
+        return encode_cursor(self._key(self.items[0]), False)
+
+
+def make_pagination(query: Query, page_info, keyset: Sequence = None, desc: bool = False, count_mode: str = CountMode.EXACT,
+                    count_key: str = None) -> Union[Pagination, KeysetPagination]:
+    """
+    接口支持游标分页的话传入keyset，请求里带了cursor参数就用游标分页，否则还是传统分页，count_mode 见 CountMode
+    count_key 是 CACHED 时count缓存的key，带上所有影响结果的参数，见 _count_cache_key
+    """
+    if keyset is not None and getattr(page_info, 'cursor', None) is not None:
+        return KeysetPagination(query, keyset, page_info, desc=desc)
+    return Pagination(query, page_info=page_info, count_mode=count_mode, count_key=count_key)
+
+
+def to_model(model, row):
+    """ 异步查询返回的是Record，转成没有绑定session的ORM对象，方便直接用serializer，不要再往session里add """
+    if row is None:
+        return None
+    return model(**dict(row))
+
+
+async def get_async_db() -> Database:
+    """
+    异步的数据库依赖，不阻塞事件循环。只能执行sqlalchemy core的语句，例如
+        row = await db.fetch_one(select([UserDB.__table__]).where(UserDB.id == user_id))
+    需要事务的时候用 async with db.transaction()
+    """
+    if not database.is_connected:
+        await database.connect()
+    return database
+
+
 # Dependency
 async def get_session() -> Session:
     db = SessionLocal()
@@ -122,67 +352,206 @@ def or_many_condition(condition: list):
     return or_(*condition)
 
 
-""" 生产动态表 暂时还没用 """
-# class DynamicModelMixin(object):
-# 	@classmethod
-# 	def _create(cls, tb_suffix, auto_create_table=True):
-# 		# 1.tb_suffix和cls，生成表名字
-# 		# 2.搜索当前对象中的声明类是否有该类，如果有，直接使用其创建对象，否则尝试生成新类，创建数据库表并用新类创建对象
-# 		# tb_keys = [cls.__name__.lower(), tb_suffix]
-# 		# tb_name = '_'.join(filter(lambda x: x != '', tb_keys))
-# 		tb_name = cls.__name__.lower()
-# 		if tb_suffix != "":
-# 			tb_name = "%s_%s" % (tb_name, str(tb_suffix))
-# 		tb_cls = None
-# 		if tb_name in db.Model._decl_class_registry:
-# 			if isinstance(db.Model._decl_class_registry[tb_name], _MultipleClassMarker):
-# 				tb_cls = list(db.Model._decl_class_registry[tb_name].contents)[0]()
-# 			else:
-# 				tb_cls = db.Model._decl_class_registry[tb_name]
-# 		if tb_cls is None:
-# 			if hasattr(cls, '__bind_key__'):
-# 				db_engine = db.get_engine(bind=cls.__bind_key__)
-# 			else:
-# 				db_engine = db.get_engine()
-# 			tb_exists = db_engine.dialect.has_table(db_engine, tb_name)
-# 			if tb_exists or auto_create_table:
-# 				metadata = {
-# 					'__tablename__': tb_name,
-# 					'__tb_suffix__': tb_suffix,
-# 					'__table_args__': {
-# 						'extend_existing': True
-# 					}
-# 				}
-# 				tb_cls = type(tb_name, (db.Model, cls), metadata)
-# 				if not tb_exists:
-# 					tb_cls.__table__.create(bind=db_engine)
-# 		return tb_cls
-#
-# 	@classmethod
-# 	def check_on(cls):
-# 		""" 检查一个动态表有没有on成具体的一个表 """
-# 		table_name = getattr(cls, '__tablename__', None)
-# 		if table_name is None:
-# 			raise Exception('DynamicModel used before on')
-# 		else:
-# 			return table_name
-#
-# 	@classmethod
-# 	def on(cls, suffix, auto_create_table=True):
-# 		m = cls._create(suffix, auto_create_table)
-# 		return m
-#
-# 	@classmethod
-# 	def on_date(cls, suffix, date, auto_create_table=True):
-# 		m = cls._create('{}_{}'.format(suffix, date), auto_create_table)
-# 		return m
-
-# def get_table_session(table):
-# 	""" 获得对应表下的session """
-# 	if getattr(table, '__bind_key__', None):
-# 		engine = db.get_engine(bind=table.__bind_key__)
-# 		session_maker = sessionmaker(engine)
-# 		session = session_maker()
-# 	else:
-# 		session = db.sessionmaker()()
-# 	return session
+""" id列表的过滤条件，阈值由 manage.py bench id-filter 在目标数据库上跑出来，换数据库之后要重新跑一下 """
+ID_FILTER_OR_LIMIT = 8  # 不超过这个数量用 or
+ID_FILTER_IN_CHUNK_SIZE = 500  # 每个 in 最多这么多个id，多个in之间用or连起来
+# 超过这个数量用临时表，sqlite默认最多999个绑定参数，所以单独设置
+ID_FILTER_TEMP_TABLE_THRESHOLD = {
+    'sqlite': 900,
+    'default': 5000,
+}
+
+
+class IdFilterStrategy:
+    OR = 'or'
+    IN = 'in'
+    TEMP_TABLE = 'temp_table'
+
+
+# 临时表只在当前连接里可见，用token区分同一个连接里的不同过滤条件
+_id_filter_table = Table(
+    'tmp_id_filter', MetaData(),
+    Column('token', VARCHAR(32), primary_key=True),
+    Column('id', BigInteger, primary_key=True),
+)
+_CREATE_ID_FILTER_TABLE = 'CREATE TEMPORARY TABLE IF NOT EXISTS tmp_id_filter (token VARCHAR(32) NOT NULL, id BIGINT NOT NULL, PRIMARY KEY (token, id))'
+
+
+def choose_id_filter_strategy(dialect_name: str, size: int) -> str:
+    if size <= ID_FILTER_OR_LIMIT:
+        return IdFilterStrategy.OR
+    threshold = ID_FILTER_TEMP_TABLE_THRESHOLD.get(dialect_name, ID_FILTER_TEMP_TABLE_THRESHOLD['default'])
+    if size <= threshold:
+        return IdFilterStrategy.IN
+    return IdFilterStrategy.TEMP_TABLE
+
+
+@contextmanager
+def id_filter(session: Session, column, ids: Iterable[int], strategy: str = None):
+    """
+    按id的数量和数据库选择过滤方式：很少的时候用 or，中等数量的时候分块 in，很多的时候写进临时表再 in 子查询
+    用临时表的时候要在with里面执行完sql，出来之后会清掉临时表里的数据
+    example:
+        with id_filter(session, UserDB.id, user_ids) as condition:
+            session.query(UserDB).filter(condition).update(...)
+    """
+    ids = list(dict.fromkeys(ids))
+    if len(ids) == 0:
+        # 和 or_many_condition 不同，空列表什么都不匹配，避免 update 整张表
+        yield false()
+        return
+    
+    strategy = strategy or choose_id_filter_strategy(session.get_bind().dialect.name, len(ids))
+    
+    if strategy == IdFilterStrategy.OR:
+        yield or_many_condition([column == i for i in ids])
+        return
+    
+    if strategy == IdFilterStrategy.IN:
+        chunks = [column.in_(ids[i:i + ID_FILTER_IN_CHUNK_SIZE]) for i in range(0, len(ids), ID_FILTER_IN_CHUNK_SIZE)]
+        yield or_many_condition(chunks)
+        return
+    
+    token = uuid()
+    session.execute(text(_CREATE_ID_FILTER_TABLE))
+    for i in range(0, len(ids), ID_FILTER_IN_CHUNK_SIZE):
+        session.execute(_id_filter_table.insert(), [{'token': token, 'id': j} for j in ids[i:i + ID_FILTER_IN_CHUNK_SIZE]])
+    try:
+        yield column.in_(select([_id_filter_table.c.id]).where(_id_filter_table.c.token == token))
+    finally:
+        session.execute(_id_filter_table.delete().where(_id_filter_table.c.token == token))
+
+
+def insert_ignore(session: Union[Session, Connection], table: Table):
+    """ 插入时跳过违反唯一约束的行，各个数据库的写法不一样 """
+    dialect_name = session.get_bind().dialect.name if isinstance(session, Session) else session.dialect.name
+    if dialect_name == 'mysql':
+        return table.insert().prefix_with('IGNORE')
+    if dialect_name == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    if dialect_name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(table).on_conflict_do_nothing()
+    return table.insert()
+
+
+# 异步的Database对应的同步engine，按url找，async_on 建表的时候借用它的连接池和connect_args
+_sync_engines = {str(database.url): engine}
+
+
+def bind_sync_engine(db: Database, sync_engine: Engine):
+    """ 自己建的Database（比如测试库）要登记一下对应的同步engine，没登记的用主库的engine """
+    _sync_engines[str(db.url)] = sync_engine
+
+
+""" 动态表：同样的列按后缀分表，建过的表登记在 dynamic_table 里，查询时从这里知道有哪些表 """
+_dynamic_table = Table(
+    'dynamic_table', Base.metadata,
+    Column('name', VARCHAR(126), primary_key=True),
+    Column('prefix', VARCHAR(126), nullable=False, index=True),
+    Column('suffix', VARCHAR(126), nullable=False),
+)
+
+
+class DynamicModelMixin(object):
+    """
+    列定义在mixin上，表名是 {__dynamic_prefix__}_{后缀}，例如
+        class FormMixin(DynamicModelMixin):
+            __dynamic_prefix__ = 'form'
+            id = Column(Integer(), primary_key=True)
+        
+        FormMixin.on(session, '202105')  # 写入之前调用，没有表就建表并登记
+        FormMixin.model('202105')  # 只拿到类，不检查表在不在
+        FormMixin.suffixes(session)  # 已经建了的表的后缀
+    同一个后缀拿到的都是同一个类。要在mixin上调用，不要在已经映射的子类上调用
+    """
+    __dynamic_prefix__: str = None
+    _dynamic_models = {}
+    _dynamic_created = set()
+    
+    @classmethod
+    def table_name(cls, suffix: str) -> str:
+        return f'{cls.__dynamic_prefix__}_{suffix}'
+    
+    @classmethod
+    def model(cls, suffix: str):
+        name = cls.table_name(suffix)
+        model = cls._dynamic_models.get(name)
+        if model is None:
+            model = type(f'{cls.__name__}_{suffix}', (cls, Base), {'__tablename__': name, '__dynamic_suffix__': suffix})
+            cls._dynamic_models[name] = model
+        return model
+    
+    @classmethod
+    def _create(cls, conn, suffix: str):
+        model = cls.model(suffix)
+        model.__table__.create(bind=conn, checkfirst=True)
+        conn.execute(insert_ignore(conn, _dynamic_table).values(name=model.__tablename__, prefix=cls.__dynamic_prefix__, suffix=suffix))
+        cls._dynamic_created.add(model.__tablename__)
+        logger.info(f'dynamic table {model.__tablename__} created')
+        return model
+    
+    @classmethod
+    def on(cls, session: Session, suffix: str, auto_create_table: bool = True):
+        """ 没有表的时候建表，auto_create_table=False时没有表返回None """
+        if cls.table_name(suffix) in cls._dynamic_created:
+            return cls.model(suffix)
+        if suffix in cls.suffixes(session):
+            cls._dynamic_created.add(cls.table_name(suffix))
+            return cls.model(suffix)
+        if not auto_create_table:
+            return None
+        return cls._create(session.connection(), suffix)
+    
+    @classmethod
+    async def async_on(cls, db: Database, suffix: str):
+        """ 异步的版本，建表很少发生，用这个Database对应的同步engine在线程池里建，见 bind_sync_engine """
+        if cls.table_name(suffix) in cls._dynamic_created:
+            return cls.model(suffix)
+        if suffix in await cls.async_suffixes(db):
+            cls._dynamic_created.add(cls.table_name(suffix))
+            return cls.model(suffix)
+        
+        def create():
+            with _sync_engines.get(str(db.url), engine).begin() as conn:
+                return cls._create(conn, suffix)
+        
+        return await run_in_threadpool(create)
+    
+    @classmethod
+    def _suffixes_statement(cls):
+        return select([_dynamic_table.c.suffix]).where(_dynamic_table.c.prefix == cls.__dynamic_prefix__).order_by(_dynamic_table.c.suffix)
+    
+    @classmethod
+    def suffixes(cls, session: Session) -> List[str]:
+        return [i[0] for i in session.execute(cls._suffixes_statement())]
+    
+    @classmethod
+    async def async_suffixes(cls, db: Database) -> List[str]:
+        return [i[0] for i in await db.fetch_all(cls._suffixes_statement())]
+    
+    @classmethod
+    def drop(cls, session: Session, suffix: str):
+        """ 删掉整张表，比DELETE快得多。DDL在mysql里会隐式提交 """
+        model = cls.model(suffix)
+        model.__table__.drop(bind=session.connection(), checkfirst=True)
+        session.execute(_dynamic_table.delete().where(_dynamic_table.c.name == model.__tablename__))
+        cls._dynamic_created.discard(model.__tablename__)
+    
+    @classmethod
+    def drop_all(cls, session: Session) -> List[str]:
+        """
+        删掉这个前缀登记过的所有分表，返回表名，清库的时候用
+        分表不在 Base.metadata 的固定表里，只清空 dynamic_table 的话表和数据都还在，下次 on 的时候又会登记回来
+        """
+        names = []
+        for suffix in cls.suffixes(session):
+            cls.drop(session, suffix)
+            names.append(cls.table_name(suffix))
+        cls.forget()
+        return names
+    
+    @classmethod
+    def forget(cls):
+        """ 忘掉进程里记住的已经建好的表，下次 on 的时候重新查 dynamic_table """
+        cls._dynamic_created.clear()
@@ -0,0 +1,158 @@
+import ast
+import re
+from contextlib import contextmanager
+from logging import getLogger
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from alembic.config import Config
+from alembic.script import ScriptDirectory
+from alembic.util import rev_id
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Engine
+
+from apps.a_common.sql_trace import explain, fingerprint
+
+logger = getLogger(__name__)
+
+"""
+索引检查，给 python manage.py db index-audit 用
+1. 收集程序发出的select：跑一遍测试时用 capture_statements 抓，或者用 parse_sql_log 解析 sqlalchemy.engine 的日志（config.py 的 SQL_LOG）
+2. 在执行这些sql的数据库上逐条EXPLAIN（日志里的sql在配置的数据库上），找出全表扫描的表
+3. 全表扫描的表里，where/on/order by 用到、但没有作为任何索引第一列的列，就是缺的索引，可以生成alembic的migration
+"""
+Statement = Tuple[str, object]  # (sql, 参数)
+
+_LOG_ENTRY = re.compile(r'^\[[^\]]*\] \[sqlalchemy\.engine[\w.]*\]:\[[^\]]*\]:\[\w+\] : (.*)$')
+_SQLITE_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$')
+_PG_SEQ_SCAN = re.compile(r'Seq Scan on (\w+)')
+_FILTER_COLUMN = r'[`"]?{table}[`"]?\.[`"]?(\w+)[`"]?\s*(?:=|<|>|!=|\bIN\b|\bLIKE\b|\bIS\b|\bBETWEEN\b)'
+_ORDER_BY = re.compile(r'\bORDER BY\b(.*?)(?:\bLIMIT\b|\bOFFSET\b|$)', re.IGNORECASE | re.DOTALL)
+
+
+def _is_select(statement: str) -> bool:
+    return statement.lstrip()[:6].upper() == 'SELECT'
+
+
+@contextmanager
+def capture_statements():
+    """
+    收集期间经过任意engine执行的select，按指纹去重，保留第一次的参数
+    得到的是 {engine: {指纹: (sql, 参数)}}，参数的占位符和数据库有关，要在同一个engine上EXPLAIN
+    """
+    statements: Dict[Engine, Dict[str, Statement]] = {}
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and _is_select(statement):
+            statements.setdefault(conn.engine, {}).setdefault(fingerprint(statement), (statement, parameters))
+
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(Engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def parse_sql_log(lines: Iterable[str]) -> List[Statement]:
+    """
+    sqlalchemy.engine 的INFO日志里，一条sql（可能有多行）后面跟着一行参数的repr
+    参数被截断、解析不了的sql跳过，没有参数没法EXPLAIN
+    """
+    entries, statements = [], {}
+    for line in lines:
+        line = line.rstrip('\n')
+        match = _LOG_ENTRY.match(line)
+        if match:
+            entries.append(match.group(1))
+        elif entries:
+            entries[-1] += '\n' + line
+
+    for statement, parameters in zip(entries, entries[1:]):
+        if not _is_select(statement):
+            continue
+        try:
+            parameters = ast.literal_eval(parameters)
+        except (ValueError, SyntaxError):
+            continue
+        statements.setdefault(fingerprint(statement), (statement, parameters))
+    return list(statements.values())
+
+
+def find_full_scans(dialect_name: str, plan: List[dict]) -> Set[str]:
+    """ 从EXPLAIN的结果里找出全表扫描的表，走索引的扫描（covering index）不算 """
+    tables = set()
+    for row in plan:
+        if dialect_name == 'sqlite':
+            match = _SQLITE_SCAN.match(row.get('detail', ''))
+            if match:
+                tables.add(match.group(1))
+        elif dialect_name == 'mysql':
+            if row.get('type') == 'ALL' and row.get('table'):
+                tables.add(row['table'])
+        elif dialect_name == 'postgresql':
+            tables.update(_PG_SEQ_SCAN.findall(row.get('QUERY PLAN', '')))
+    return tables
+
+
+def filter_columns(statement: str, table: str) -> List[str]:
+    """ where/on 里和这张表的列比较的列，加上 order by 的列，按出现的顺序去重 """
+    pattern = re.compile(_FILTER_COLUMN.format(table=re.escape(table)), re.IGNORECASE)
+    columns = pattern.findall(statement)
+    for order_by in _ORDER_BY.findall(statement):
+        columns += re.findall(r'[`"]?{}[`"]?\.[`"]?(\w+)'.format(re.escape(table)), order_by)
+    return list(dict.fromkeys(columns))
+
+
+def indexed_columns(engine: Engine, table: str) -> Set[str]:
+    """ 作为主键或者某个索引第一列的列 """
+    inspector = inspect(engine)
+    columns = set(inspector.get_pk_constraint(table).get('constrained_columns') or ())
+    for index in inspector.get_indexes(table):
+        if index['column_names']:
+            columns.add(index['column_names'][0])
+    for constraint in inspector.get_unique_constraints(table):
+        if constraint['column_names']:
+            columns.add(constraint['column_names'][0])
+    return columns
+
+
+def audit(engine: Engine, statements: Iterable[Statement]) -> Tuple[List[dict], List[Tuple[str, str]]]:
+    """ 返回 (每条有全表扫描的sql的报告, 缺的索引 [(表, 列)]) """
+    report, missing, indexed = [], {}, {}
+    with engine.connect() as conn:
+        for statement, parameters in statements:
+            try:
+                plan = explain(conn, statement, parameters)
+            except Exception as e:
+                logger.warning(f'explain fail: {e}, {statement[:200]}')
+                continue
+            for table in sorted(find_full_scans(engine.dialect.name, plan)):
+                if table not in indexed:
+                    indexed[table] = indexed_columns(engine, table)
+                columns = [c for c in filter_columns(statement, table) if c not in indexed[table]]
+                report.append({'table': table, 'statement': statement, 'missing': columns, 'plan': plan})
+                for column in columns:
+                    missing[(table, column)] = True
+    return report, list(missing)
+
+
+def render_migration(missing: List[Tuple[str, str]]) -> Tuple[str, str]:
+    """ 生成migration里 upgrade 和 downgrade 的函数体 """
+    upgrades = [f"    op.create_index('ix_{table}_{column}', '{table}', ['{column}'])" for table, column in missing]
+    downgrades = [f"    op.drop_index('ix_{table}_{column}', table_name='{table}')" for table, column in reversed(missing)]
+    return '\n'.join(upgrades), '\n'.join(downgrades)
+
+
+def write_migration(missing: List[Tuple[str, str]], message: str = 'indexes from index audit', config_file: str = 'alembic.ini') -> Optional[str]:
+    """ 用 alembic/script.py.mako 生成一个新的revision，接在当前的head后面，返回文件路径 """
+    if not missing:
+        return None
+    upgrades, downgrades = render_migration(missing)
+    script_directory = ScriptDirectory.from_config(Config(config_file))
+    script = script_directory.generate_revision(rev_id(), message, head='head', upgrades=upgrades, downgrades=downgrades)
+    # 模板里固定 import 了 sqlalchemy，建索引用不到，去掉免得pyflakes报没用的import
+    if 'sa.' not in upgrades + downgrades:
+        with open(script.path, encoding='utf-8') as f:
+            source = f.read()
+        with open(script.path, 'w', encoding='utf-8') as f:
+            f.write(source.replace('import sqlalchemy as sa\n', '', 1))
+    return script.path
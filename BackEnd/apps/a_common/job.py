@@ -0,0 +1,86 @@
+import asyncio
+from logging import getLogger
+from typing import Awaitable, Callable, Optional, Union
+
+from starlette.concurrency import run_in_threadpool
+
+from apps.a_common.cache import LRUCache
+from utils.encode import uuid
+from utils.time import int_timestamp
+
+logger = getLogger(__name__)
+
+""" 进程内的后台任务，耗时太久的操作放到响应之后执行，通过 /jobs/{job_id} 查看进度。worker重启后任务会丢失 """
+JOB_KEEP_SECONDS = 60 * 60 * 24
+
+
+class JobStatus:
+    PENDING = 'pending'
+    RUNNING = 'running'
+    SUCCESS = 'success'
+    FAIL = 'fail'
+
+
+class Job:
+    def __init__(self, name: str, owner_id: int, total: int):
+        self.id = uuid()
+        self.name = name
+        self.owner_id = owner_id
+        self.total = total
+        self.done = 0
+        self.status = JobStatus.PENDING
+        self.detail = None
+        self.create_at = int_timestamp()
+        self.finish_at = None
+    
+    def __str__(self):
+        return f'[Job: {self.name} {self.id}]'
+    
+    def __repr__(self):
+        return self.__str__()
+    
+    def advance(self, n: int):
+        self.done += n
+    
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'name': self.name,
+            'total': self.total,
+            'done': self.done,
+            'status': self.status,
+            'detail': self.detail,
+            'create_at': self.create_at,
+            'finish_at': self.finish_at,
+        }
+
+
+_jobs = LRUCache(maxsize=1024, ttl=JOB_KEEP_SECONDS)
+
+
+def create_job(name: str, owner_id: int, total: int) -> Job:
+    job = Job(name, owner_id, total)
+    _jobs.set(job.id, job)
+    return job
+
+
+def get_job(job_id: str) -> Optional[Job]:
+    return _jobs.get(job_id)
+
+
+async def run_job(job: Job, func: Callable[..., Union[Awaitable, None]], *args):
+    """ 给BackgroundTasks用：background_tasks.add_task(run_job, job, func, *args)，同步的func放到线程池里执行，不阻塞事件循环 """
+    job.status = JobStatus.RUNNING
+    try:
+        if asyncio.iscoroutinefunction(func):
+            await func(job, *args)
+        else:
+            await run_in_threadpool(func, job, *args)
+    except Exception as e:
+        logger.error(f'{job} fail: {e}', exc_info=True)
+        job.status = JobStatus.FAIL
+        job.detail = str(e)
+    else:
+        job.status = JobStatus.SUCCESS
+    finally:
+        job.finish_at = int_timestamp()
@@ -1,7 +1,11 @@
+import hashlib
+import time
 from logging import getLogger
 
 from itsdangerous import BadSignature, SignatureExpired, TimedJSONWebSignatureSerializer
 
+from apps.a_common.cache import LRUCache
+from apps.a_common.metrics import register_collector
 from config import SECRET_KEY
 
 logger = getLogger(__name__)
@@ -9,22 +13,53 @@ TIMEOUT = 60 * 60 * 31
 
 s = TimedJSONWebSignatureSerializer(SECRET_KEY, expires_in=TIMEOUT)
 
+""" 验证过的token缓存起来，过期时间不超过token自带的exp；验证失败的token也缓存一小会，防止被垃圾token刷CPU """
+VERIFIED_TOKEN_CACHE_SIZE = 8192
+VERIFIED_TOKEN_MAX_TTL = 60 * 10
+BAD_TOKEN_CACHE_SIZE = 1024
+BAD_TOKEN_TTL = 30
+
+verified_token_cache = LRUCache(maxsize=VERIFIED_TOKEN_CACHE_SIZE, ttl=VERIFIED_TOKEN_MAX_TTL)
+bad_token_cache = LRUCache(maxsize=BAD_TOKEN_CACHE_SIZE, ttl=BAD_TOKEN_TTL)
+register_collector('verified_token_cache', verified_token_cache.stats)
+register_collector('bad_token_cache', bad_token_cache.stats)
+
+
+def _token_digest(token: bytes) -> bytes:
+    return hashlib.blake2b(token, digest_size=16).digest()
+
 
 def decode_token(token) -> (dict, bool):
     if isinstance(token, str):
         token = token.encode()
+    if not token:
+        return {}, False
+    
+    key = _token_digest(token)
+    data = verified_token_cache.get(key)
+    if data is not None:
+        return data, True
+    if bad_token_cache.get(key) is not None:
+        return {}, False
     
     try:
-        return s.loads(token), True
+        data, header = s.loads(token, return_header=True)
     except BadSignature:
         logger.info('decode jwt fail, detail: {}'.format(token))
+        bad_token_cache.set(key, True)
         return {}, False
     except SignatureExpired:
         logger.info('token expire')
+        bad_token_cache.set(key, True)
         return {}, False
     except Exception as e:
         logger.error(f"unknown jwt decode error: {str(e)}")
         return {}, False
+    
+    ttl = min(header['exp'] - time.time(), VERIFIED_TOKEN_MAX_TTL)
+    if data is not None:
+        verified_token_cache.set(key, data, ttl=ttl)
+    return data, True
 
 
 def encode_token(user_id) -> bytes:
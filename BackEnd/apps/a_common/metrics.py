@@ -0,0 +1,13 @@
+from typing import Callable, Dict
+
+""" 各个模块把自己的统计数据注册到这里，由 /metrics 接口统一输出 """
+
+_collectors: Dict[str, Callable[[], dict]] = {}
+
+
+def register_collector(name: str, collector: Callable[[], dict]):
+    _collectors[name] = collector
+
+
+def collect_metrics() -> dict:
+    return {name: collector() for name, collector in _collectors.items()}
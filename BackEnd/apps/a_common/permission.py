@@ -1,16 +1,22 @@
 import functools
 from logging import getLogger
 from sqlalchemy.orm import Session
-from typing import List, Tuple
+from typing import Dict, FrozenSet, List, Tuple, Union
 
-from apps.a_common.db import or_many_condition
-from apps.a_common.constants import MANAGE_ROLE_PERMISSION_NAME
+from apps.a_common.constants import MANAGE_ROLE_PERMISSION_NAME, PERMISSION_SUBTREE_SUFFIX, PERMISSION_WILDCARD
 from apps.a_common.error import PermissionError
+from apps.a_common.principal import SUPERUSER_BIT, Principal
+from apps.logic.permission_index import permission_index
+from apps.logic.role_tree import RoleNode, role_tree
 from apps.model.user import UserDB
+from apps.model.user2role import User2RoleDB
 from apps.model.role import RoleDB
 
 logger = getLogger(__name__)
 
+AUTHORIZE_CHUNK_SIZE = 1000
+MANAGE_USER_ACTION = MANAGE_ROLE_PERMISSION_NAME.partition(':')[0]
+
 constants_permission_set = {
     MANAGE_ROLE_PERMISSION_NAME
 }
@@ -18,12 +24,13 @@ constants_permission_set = {
 
 def has_permission_decorator(permission_name: str):
     constants_permission_set.add(permission_name)
+    mask = 1 << SUPERUSER_BIT | 1 << permission_index.bit(permission_name)
     
     def decorator(func):
         @functools.wraps(func)
         async def wrapper(*args, **kwargs):
             user = _find_user(*args, **kwargs)
-            if not has_permission(user, permission_name):
+            if user is None or not user.permission_mask & mask:
                 raise PermissionError()
             
             return await func(*args, **kwargs)
@@ -33,14 +40,11 @@ def has_permission_decorator(permission_name: str):
     return decorator
 
 
-def has_permission(user: UserDB, name: str) -> bool:
+def has_permission(user: Principal, name: str) -> bool:
     if user is None:
         return False
     
-    if name not in user.permission_set and not user.is_superuser:
-        return False
-    
-    return True
+    return permission_index.has(user.permission_mask, name)
 
 
 def _find_user(*args, **kwargs):
@@ -50,7 +54,7 @@ def _find_user(*args, **kwargs):
         return kwargs['manager']
     
     for a in args:
-        if isinstance(a, UserDB):
+        if isinstance(a, Principal):
             return a
     
     return
@@ -60,7 +64,7 @@ def is_superuser(func):
     @functools.wraps(func)
     async def wrapper(*args, **kwargs):
         user = _find_user(*args, **kwargs)
-        if user is None or not user.is_superuser:
+        if user is None or not user.permission_mask & 1 << SUPERUSER_BIT:
             raise PermissionError()
         
         return await func(*args, **kwargs)
@@ -68,7 +72,7 @@ def is_superuser(func):
     return wrapper
 
 
-def has_permission_manage_role(role: RoleDB, user: UserDB) -> bool:
+def has_permission_manage_role(session: Session, role: Union[RoleDB, RoleNode], user: Principal) -> bool:
     """ 查询是否有对role操作的权限，这里比较特殊，是通过role来判断role """
     if role is None or user is None:
         return False
@@ -76,44 +80,93 @@ def has_permission_manage_role(role: RoleDB, user: UserDB) -> bool:
     if user.is_superuser:
         return True
     
-    #  用户有group的父辈group的管理权限，或者直接管理这个group
-    if len(role.grand_id_set & user.role_id_set) > 0 or role.id in user.role_id_set:
+    #  用户有group的父辈group的管理权限，或者直接管理这个group，role可以是RoleDB，也可以是RoleNode
+    if role.id in user.role_id_set:
+        return True
+    role_tree.ensure(session, [role.id])
+    if role_tree.is_under(role.id, user.role_id_set):
         return True
     
     return False
 
 
-def has_permission_manage_user(client: UserDB, user: UserDB) -> bool:
-    """ 查询是否有对单个用户操作的权限 """
-    if client.is_superuser:
-        return True
+class Grant:
+    """ 某个动作上的授权，any：所有，role_ids：只有这些角色，subtree_role_ids：这些角色和它们的子角色 """
+    __slots__ = ('any', 'role_ids', 'subtree_role_ids')
     
-    if MANAGE_ROLE_PERMISSION_NAME.format(role_id=user.role_id_set) in client.permission_set:
-        return True
+    def __init__(self):
+        self.any = False
+        self.role_ids = set()
+        self.subtree_role_ids = set()
     
-    logger.warning(f'{client} try to manage user: {user}')
-    return False
+    def match_role(self, role_id: int) -> bool:
+        """ subtree 的判断用 role_tree，调用前要先 role_tree.ensure """
+        if self.any or role_id in self.role_ids:
+            return True
+        return len(self.subtree_role_ids) != 0 and role_tree.is_under(role_id, self.subtree_role_ids)
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_grants(permission_set: FrozenSet[str]) -> Dict[str, Grant]:
+    """
+    把 动作:参数 形式的权限按动作分组，例如 manage-user:3、manage-user:5/*、manage-user:*
+    Principal的permission_set不可变，同样的权限集合只解析一次，返回值不要修改
+    """
+    grants = {}
+    for name in permission_set:
+        action, sep, param = name.partition(':')
+        if not sep:
+            continue
+        if param == PERMISSION_WILDCARD:
+            grants.setdefault(action, Grant()).any = True
+        elif param.endswith(PERMISSION_SUBTREE_SUFFIX) and param[:-len(PERMISSION_SUBTREE_SUFFIX)].isdigit():
+            grants.setdefault(action, Grant()).subtree_role_ids.add(int(param[:-len(PERMISSION_SUBTREE_SUFFIX)]))
+        elif param.isdigit():
+            grants.setdefault(action, Grant()).role_ids.add(int(param))
+    return grants
+
+
+def authorize_manage_user_ids(session: Session, client: Principal, user_ids: List[int]) -> Tuple[List[int], List[int]]:
+    """
+    批量判断能不能管理这些用户，返回 (allowed, denied)，顺序和传入的一致，重复的id只保留一个
+    只查user2role的(user_id, role_id)，用户属于任意一个能管理的角色就可以管理，不加载UserDB
+    超级管理员、有 manage-user:* 的可以管理所有存在的用户，不存在的用户算在denied里
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    grant = None if client.is_superuser else compile_grants(client.permission_set).get(MANAGE_USER_ACTION)
+    allowed = set()
+    if client.is_superuser or (grant is not None and grant.any):
+        for i in range(0, len(user_ids), AUTHORIZE_CHUNK_SIZE):
+            chunk = user_ids[i:i + AUTHORIZE_CHUNK_SIZE]
+            allowed.update(r[0] for r in session.query(UserDB.id).filter(UserDB.id.in_(chunk)))
+    elif grant is not None:
+        matched = {}
+        for i in range(0, len(user_ids), AUTHORIZE_CHUNK_SIZE):
+            chunk = user_ids[i:i + AUTHORIZE_CHUNK_SIZE]
+            rows = session.query(User2RoleDB.user_id, User2RoleDB.role_id).filter(User2RoleDB.user_id.in_(chunk)).all()
+            if grant.subtree_role_ids:
+                role_tree.ensure(session, {role_id for _, role_id in rows})
+            for user_id, role_id in rows:
+                if role_id not in matched:
+                    matched[role_id] = grant.match_role(role_id)
+                if matched[role_id]:
+                    allowed.add(user_id)
+    
+    denied = [i for i in user_ids if i not in allowed]
+    if denied:
+        logger.warning(f'{client} try to manage users: {denied[:20]}, total: {len(denied)}')
+    return [i for i in user_ids if i in allowed], denied
 
 
-def get_user_role_id(session: Session, id_list: List[int]) -> List[Tuple[int, int]]:
-    users = session.query(UserDB).filter(or_many_condition([UserDB.id == i for i in id_list])).all()
-    role_ids = []
-    for user in users:
-        role_ids.append((user.id, user.role_id_set))
-    return role_ids
+def has_permission_manage_user(session: Session, client: Principal, user_id: int) -> bool:
+    """ 查询是否有对单个用户操作的权限 """
+    allowed, _ = authorize_manage_user_ids(session, client, [user_id])
+    return len(allowed) != 0
 
 
-def has_permission_manage_user_ids(session: Session, client: UserDB, user_ids: List[int]) -> Tuple[bool, List[int]]:
-    """ 查询是否有对一群用户操作的权限 """
-    user_data_list = get_user_role_id(session, user_ids)
-    
-    if client.is_superuser:
-        return True, [i[0] for i in user_data_list]
-    
-    for user_id, role_id in user_data_list:
-        if MANAGE_ROLE_PERMISSION_NAME.format(role_id=role_id) in client.permission_set:
-            continue
-        logger.warning(f'{client} try to manage user: {user_id}')
+def has_permission_manage_user_ids(session: Session, client: Principal, user_ids: List[int]) -> Tuple[bool, List[int]]:
+    """ 查询是否有对一群用户操作的权限，有一个不能管理就算失败 """
+    allowed, denied = authorize_manage_user_ids(session, client, user_ids)
+    if denied and not client.is_superuser:
         return False, []
-    
-    return True, [i[0] for i in user_data_list]
+    return True, allowed
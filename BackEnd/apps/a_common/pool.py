@@ -0,0 +1,101 @@
+import os
+import time
+from collections import deque
+from typing import Dict, Tuple
+
+from sqlalchemy import exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+from apps.a_common.metrics import register_collector
+
+"""
+连接池的统计和大小
+InstrumentedQueuePool 记录每次取连接等了多久、超时了几次，通过 /metrics/sql-pool 查看
+derive_pool_sizes 按全局的连接预算和worker数算出每个worker的连接池大小，避免加worker的时候打满数据库的max_connections
+"""
+POOL_WAIT_SAMPLES = 1000  # 最近这么多次取连接的耗时，用来算分位数
+POOL_MAX_OVERFLOW = 10  # sqlalchemy 默认的 max_overflow
+
+
+def _percentile_ms(sorted_waits, p: float) -> float:
+    if not sorted_waits:
+        return 0
+    return round(sorted_waits[min(len(sorted_waits) - 1, int(len(sorted_waits) * p))] * 1000, 3)
+
+
+class InstrumentedQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.recent_waits = deque(maxlen=POOL_WAIT_SAMPLES)
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            raise
+        wait = time.perf_counter() - start
+        self.checkouts += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self.recent_waits.append(wait)
+        return conn
+
+    def stats(self) -> dict:
+        waits = sorted(self.recent_waits)
+        return {
+            'size': self.size(),
+            'max_overflow': self._max_overflow,
+            'checked_in': self.checkedin(),
+            'checked_out': self.checkedout(),
+            'overflow': max(self.overflow(), 0),
+            'checkouts': self.checkouts,
+            'timeouts': self.timeouts,
+            'wait_avg_ms': round(self.wait_total / self.checkouts * 1000, 3) if self.checkouts else 0,
+            'wait_max_ms': round(self.wait_max * 1000, 3),
+            'wait_p50_ms': _percentile_ms(waits, 0.5),
+            'wait_p99_ms': _percentile_ms(waits, 0.99),
+        }
+
+
+_engines: Dict[str, Engine] = {}
+
+
+def watch_engine(name: str, engine: Engine):
+    """ 用了 InstrumentedQueuePool 的engine才有等待时间等统计，其他的只有 status """
+    _engines[name] = engine
+
+
+def pool_stats() -> dict:
+    # engine.dispose() 之后连接池是新的，所以每次都从engine上取
+    return {
+        name: engine.pool.stats() if isinstance(engine.pool, InstrumentedQueuePool) else {'status': engine.pool.status()}
+        for name, engine in _engines.items()
+    }
+
+
+register_collector('sql_pool', pool_stats)
+
+
+def get_worker_count(configured: int = 0) -> int:
+    """ 配置里没写就用 gunicorn/uvicorn 的 WEB_CONCURRENCY 环境变量 """
+    return configured or int(os.environ.get('WEB_CONCURRENCY', 1))
+
+
+def derive_pool_sizes(budget: int, workers: int, async_pool_size: int) -> Tuple[int, int, int]:
+    """
+    把一个数据库能给的连接数 budget 平分给 workers 个worker，返回每个worker的 (pool_size, max_overflow, async_pool_size)
+    每个worker的sync连接池（pool_size + max_overflow）和异步连接池加起来不超过平分到的连接数
+    异步连接池最多占四分之一，剩下的给sync，其中五分之一作为overflow
+    """
+    per_worker = max(budget // max(workers, 1), 2)
+    async_pool_size = max(min(async_pool_size, per_worker // 4), 1)
+    rest = per_worker - async_pool_size
+    max_overflow = rest // 5
+    return max(rest - max_overflow, 1), max_overflow, async_pool_size
@@ -0,0 +1,50 @@
+from typing import FrozenSet, Iterable
+
+# permission_mask 的第0位表示超级管理员，其他位由 apps.logic.permission_index 按权限名分配
+SUPERUSER_BIT = 0
+
+
+class Principal:
+    """
+    鉴权用的用户身份，只放鉴权需要的数据，不是ORM对象，也不能修改
+    因为不可变，可以直接放进缓存，在请求之间共享
+    需要用户完整数据的地方，用id再去查UserDB
+    鉴权只看 permission_mask，permission_set 是给 manage-user:{role_id} 这类带参数的权限和展示用的
+    """
+    __slots__ = ('id', 'is_superuser', 'role_id_set', 'role_set', 'permission_set', 'permission_mask')
+
+    id: int
+    is_superuser: bool
+    role_id_set: FrozenSet[int]
+    role_set: FrozenSet[str]
+    permission_set: FrozenSet[str]
+    permission_mask: int
+
+    def __init__(self, id: int, is_superuser: bool = False, role_id_set: Iterable[int] = (), role_set: Iterable[str] = (), permission_set: Iterable[str] = (),
+                 permission_mask: int = 0):
+        object.__setattr__(self, 'id', id)
+        object.__setattr__(self, 'is_superuser', bool(is_superuser))
+        object.__setattr__(self, 'role_id_set', frozenset(role_id_set))
+        object.__setattr__(self, 'role_set', frozenset(role_set))
+        object.__setattr__(self, 'permission_set', frozenset(permission_set))
+        object.__setattr__(self, 'permission_mask', permission_mask | (1 << SUPERUSER_BIT if is_superuser else 0))
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f'{self} is immutable')
+
+    def __delattr__(self, key):
+        raise AttributeError(f'{self} is immutable')
+
+    def __eq__(self, other):
+        if not isinstance(other, Principal):
+            return NotImplemented
+        return all(getattr(self, k) == getattr(other, k) for k in self.__slots__)
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, k) for k in self.__slots__))
+
+    def __str__(self):
+        return f'[Principal: {self.id}]'
+
+    def __repr__(self):
+        return self.__str__()
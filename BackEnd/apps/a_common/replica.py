@@ -0,0 +1,164 @@
+import time
+from logging import getLogger
+from threading import Lock
+from typing import List, Optional
+
+from databases import Database
+from fastapi import Cookie, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.sql.dml import UpdateBase
+
+from apps.a_common.db import get_async_db
+from apps.a_common.metrics import register_collector
+from apps.foundation import engine, replicas
+
+try:
+    from config import SQL_READ_AFTER_WRITE_SECONDS
+except ImportError:
+    SQL_READ_AFTER_WRITE_SECONDS = 5
+
+logger = getLogger(__name__)
+
+"""
+读写分离：只读的接口用 get_read_session / get_async_read_db，其他接口照旧用 get_session / get_async_db
+副本按权重平滑轮询，执行出错（连不上、断开）的副本摘掉 REPLICA_EJECT_SECONDS 秒，没有可用的副本就读主库
+写请求之后，中间件会给客户端设置 READ_PRIMARY_COOKIE，这段时间里这个客户端的读也走主库，避免主从延迟读不到刚写的数据
+"""
+REPLICA_EJECT_SECONDS = 30
+READ_PRIMARY_COOKIE = 'read-primary-until'
+SAFE_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS'))
+
+
+class Replica:
+    __slots__ = ('engine', 'database', 'weight', 'current', 'failures', 'ejected_until')
+
+    def __init__(self, engine: Engine, database: Optional[Database] = None, weight: int = 1):
+        self.engine = engine
+        self.database = database
+        self.weight = weight
+        self.current = 0
+        self.failures = 0
+        self.ejected_until = 0
+
+    def __str__(self):
+        return f'[Replica: {self.engine.url!r}]'
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class ReplicaSet:
+    def __init__(self, replicas: List[Replica] = ()):
+        self._lock = Lock()
+        self.replicas: List[Replica] = []
+        for replica in replicas:
+            self.add(replica)
+
+    def add(self, replica: Replica):
+        """ 副本的engine执行出错时自动摘掉 """
+        @event.listens_for(replica.engine, 'handle_error')
+        def eject_on_error(context):
+            if context.is_disconnect or isinstance(context.sqlalchemy_exception, OperationalError):
+                self.eject(replica)
+
+        self.replicas.append(replica)
+
+    def choose(self) -> Optional[Replica]:
+        """ 平滑加权轮询（和nginx的一样），权重2:1时选择的顺序是 a a b a a b ...，被摘掉的跳过 """
+        now = time.monotonic()
+        best, total = None, 0
+        with self._lock:
+            for replica in self.replicas:
+                if replica.ejected_until > now:
+                    continue
+                replica.current += replica.weight
+                total += replica.weight
+                if best is None or replica.current > best.current:
+                    best = replica
+            if best is not None:
+                best.current -= total
+        return best
+
+    def eject(self, replica: Replica):
+        with self._lock:
+            replica.failures += 1
+            replica.ejected_until = time.monotonic() + REPLICA_EJECT_SECONDS
+        logger.warning(f'{replica} ejected for {REPLICA_EJECT_SECONDS}s, failures: {replica.failures}')
+
+    async def disconnect(self):
+        for replica in self.replicas:
+            if replica.database is not None and replica.database.is_connected:
+                await replica.database.disconnect()
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            'replicas': [{
+                'url': repr(replica.engine.url),
+                'weight': replica.weight,
+                'failures': replica.failures,
+                'ejected': replica.ejected_until > now,
+            } for replica in self.replicas],
+        }
+
+
+class RoutingSession(Session):
+    """
+    读走副本，写走主库。一旦写过（flush或者执行insert/update/delete），这个session后面的读也走主库
+    直接用 session.execute('UPDATE ...') 写字符串sql的话判断不出来，只读接口里不要这么写
+    """
+
+    def __init__(self, replica: Replica = None, **kwargs):
+        super().__init__(**kwargs)
+        self.replica = replica
+        self.use_primary = replica is None
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self.use_primary and (self._flushing or isinstance(clause, UpdateBase)):
+            self.use_primary = True
+        if self.use_primary:
+            return super().get_bind(mapper, clause)
+        return self.replica.engine
+
+
+replica_set = ReplicaSet([Replica(e, d, w) for e, d, w in replicas])
+register_collector('replicas', replica_set.stats)
+ReadSessionLocal = sessionmaker(class_=RoutingSession, autocommit=False, autoflush=False, bind=engine, expire_on_commit=False)
+
+
+def need_read_primary(read_primary_until: float) -> bool:
+    return read_primary_until > time.time()
+
+
+def mark_read_after_write(response: Response):
+    """ 写请求的response上调用，接下来 SQL_READ_AFTER_WRITE_SECONDS 秒里这个客户端读主库 """
+    until = time.time() + SQL_READ_AFTER_WRITE_SECONDS
+    response.set_cookie(READ_PRIMARY_COOKIE, f'{until:.3f}', max_age=SQL_READ_AFTER_WRITE_SECONDS)
+
+
+# Dependency
+async def get_read_session(read_primary_until: float = Cookie(0, alias=READ_PRIMARY_COOKIE)) -> Session:
+    replica = None if need_read_primary(read_primary_until) else replica_set.choose()
+    db = ReadSessionLocal(replica=replica)
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def get_async_read_db(read_primary_until: float = Cookie(0, alias=READ_PRIMARY_COOKIE)) -> Database:
+    """ 只读接口的异步版本，副本连不上就摘掉，这次读主库 """
+    replica = None if need_read_primary(read_primary_until) else replica_set.choose()
+    if replica is None or replica.database is None:
+        return await get_async_db()
+    if not replica.database.is_connected:
+        try:
+            await replica.database.connect()
+        except Exception as e:
+            logger.warning(f'connect {replica} fail: {e}')
+            replica_set.eject(replica)
+            return await get_async_db()
+    return replica.database
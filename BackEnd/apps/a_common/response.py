@@ -1,12 +1,13 @@
 # coding=utf-8
 from logging import getLogger
+from typing import Union
 from urllib.parse import urlencode
 
 from fastapi import Request
 from fastapi.responses import JSONResponse, Response
 from starlette.background import BackgroundTask
 
-from apps.a_common.db import Pagination
+from apps.a_common.db import CountMode, KeysetPagination, Pagination
 from config import ADDRESS
 from utils.encode import json
 
@@ -63,8 +64,12 @@ def url_for(endpoint, **kwargs):
     return f"{ADDRESS}{endpoint}"
 
 
-def make_paginate_info(paginate: Pagination, request: Request):
-    """ 制作传统分页的分页信息 """
+def make_paginate_info(paginate: Union[Pagination, KeysetPagination], request: Request):
+    """
+    制作分页信息，游标分页时next/previous里带的是cursor，没有count
+    count_mode 说明count是怎么来的：exact/cached 是精确值，estimate 是估算值，none 表示没有count
+    has_more 表示还有没有下一页，没有count的时候前端靠它判断
+    """
     url = request.url._url
     
     if url.startswith("http"):
@@ -75,6 +80,14 @@ def make_paginate_info(paginate: Pagination, request: Request):
         
         params['page_size'] = paginate.page_size
         
+        if isinstance(paginate, KeysetPagination):
+            params.pop('page_id', None)
+            params['cursor'] = paginate.next_cursor
+            next = None if params['cursor'] is None else url_for(endpoint, **params)
+            params['cursor'] = paginate.prev_cursor
+            previous = None if params['cursor'] is None else url_for(endpoint, **params)
+            return dict(next=next, previous=previous, count=None, count_mode=paginate.count_mode, has_more=next is not None)
+        
         params['page_id'] = paginate.next_page_id
         next = None if params['page_id'] is None else url_for(endpoint, **params)
         params['page_id'] = paginate.prev_page_id
@@ -82,8 +95,8 @@ def make_paginate_info(paginate: Pagination, request: Request):
     else:
         raise Exception()
     
-    return dict(next=next, previous=previous, count=paginate.total)
+    return dict(next=next, previous=previous, count=paginate.total, count_mode=paginate.count_mode, has_more=next is not None)
 
 
 def empty_paginate_response():
-    return success_response([], dict(next=None, previous=None, count=0))
+    return success_response([], dict(next=None, previous=None, count=0, count_mode=CountMode.EXACT, has_more=False))
@@ -21,10 +21,12 @@ class ParamsBase:
 class PageInfo(ParamsBase):
     page_id: int
     page_size: int
+    cursor: str = None
 
 
-def PageInfo_(page_id: int = Query(1, ge=1), page_size: int = Query(20, ge=1, le=50)) -> PageInfo:
-    return PageInfo(page_id=page_id, page_size=page_size)
+def PageInfo_(page_id: int = Query(1, ge=1), page_size: int = Query(20, ge=1, le=50),
+              cursor: str = Query(None, description="游标分页，只有部分列表支持。第一页传空字符串，之后用返回的next/previous，游标分页时page_id无效，count为null")) -> PageInfo:
+    return PageInfo(page_id=page_id, page_size=page_size, cursor=cursor)
 
 
 class _CommonlyUsedUserSearch(BaseModel, abc.ABC):
@@ -0,0 +1,131 @@
+import re
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+from logging import getLogger
+from typing import List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from apps.a_common.metrics import register_collector
+
+try:
+    from config import SQL_SLOW_QUERY_MS
+except ImportError:
+    SQL_SLOW_QUERY_MS = 200
+
+logger = getLogger(__name__)
+
+"""
+按请求统计sql：request_timer_mark 中间件调用 start_request_trace，结束时把查询次数和耗时打到同一行日志里
+同一个请求里相同指纹（参数换成?，in列表折叠）的sql执行了 N_PLUS_ONE_THRESHOLD 次以上，记一条N+1的警告
+超过 SQL_SLOW_QUERY_MS 的select，顺手在同一个连接上跑一次EXPLAIN，连同sql放进环形缓冲区，通过 /metrics/slow-queries 查看
+只统计经过sqlalchemy engine的sql，databases的异步查询不在里面
+"""
+N_PLUS_ONE_THRESHOLD = 5
+SLOW_QUERY_BUFFER_SIZE = 100
+SLOW_QUERY_TEXT_LIMIT = 2000
+
+_IN_LIST = re.compile(r'\((?:\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*,)+\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*\)')
+_SPACES = re.compile(r'\s+')
+_EXPLAIN = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'mysql': 'EXPLAIN ',
+    'postgresql': 'EXPLAIN ',
+}
+
+
+class RequestTrace:
+    __slots__ = ('path', 'count', 'duration', 'fingerprints')
+
+    def __init__(self, path: str = ''):
+        self.path = path
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = Counter()
+
+    def add(self, statement: str, duration: float):
+        self.count += 1
+        self.duration += duration
+        self.fingerprints[fingerprint(statement)] += 1
+
+    def repeated(self, threshold: int = N_PLUS_ONE_THRESHOLD):
+        return [(statement, count) for statement, count in self.fingerprints.most_common() if count >= threshold]
+
+
+_current_trace: ContextVar[Optional[RequestTrace]] = ContextVar('sql_request_trace', default=None)
+slow_queries = deque(maxlen=SLOW_QUERY_BUFFER_SIZE)
+_totals = {'statements': 0, 'slow': 0, 'n_plus_one': 0}
+
+
+def fingerprint(statement: str) -> str:
+    """ 参数已经是占位符了，只需要把 in (?, ?, ?) 折叠成 in (?)，去掉多余的空白 """
+    return _IN_LIST.sub('(?)', _SPACES.sub(' ', statement).strip())
+
+
+def start_request_trace(path: str) -> RequestTrace:
+    """ 在call_next之前调用，call_next里的任务会复制context，拿到的是同一个对象 """
+    trace = RequestTrace(path)
+    _current_trace.set(trace)
+    return trace
+
+
+def finish_request_trace(trace: RequestTrace):
+    for statement, count in trace.repeated():
+        _totals['n_plus_one'] += 1
+        logger.warning(f'possible N+1 in {trace.path}: {count} x {statement[:200]}')
+
+
+def explain(conn, statement: str, parameters) -> List[dict]:
+    """ 每一行是 {列名: 值}，不支持的数据库返回空列表 """
+    prefix = _EXPLAIN.get(conn.dialect.name)
+    if prefix is None:
+        return []
+    # 直接用dbapi的cursor，不会再触发engine的事件
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        columns = [i[0] for i in cursor.description]
+        return [{k: str(v) for k, v in zip(columns, row)} for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['sql_trace_start'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info.pop('sql_trace_start', time.perf_counter())
+    _totals['statements'] += 1
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(statement, duration)
+
+    if duration * 1000 < SQL_SLOW_QUERY_MS:
+        return
+    _totals['slow'] += 1
+    plan = []
+    if not executemany and statement.lstrip()[:6].upper() == 'SELECT':
+        try:
+            plan = explain(conn, statement, parameters)
+        except Exception as e:
+            logger.warning(f'explain slow query fail: {e}')
+    slow_queries.append({
+        'at': int(time.time()),
+        'path': trace.path if trace is not None else '',
+        'duration_ms': round(duration * 1000, 3),
+        'statement': statement[:SLOW_QUERY_TEXT_LIMIT],
+        'parameters': repr(parameters)[:SLOW_QUERY_TEXT_LIMIT],
+        'explain': plan,
+    })
+
+
+def sql_trace_stats() -> dict:
+    return dict(_totals, slow_query_buffer=len(slow_queries), slow_query_ms=SQL_SLOW_QUERY_MS)
+
+
+register_collector('sql', sql_trace_stats)
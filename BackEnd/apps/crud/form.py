@@ -1,66 +1,189 @@
-from typing import List
+from typing import Callable, List, Optional, Sequence, Tuple
+from databases import Database
 from sqlalchemy.orm import Session, Query
-from sqlalchemy import text, desc
+from sqlalchemy import BigInteger, literal, select, union_all
+from sqlalchemy.sql import Alias
 
-from apps.model.form import FormDB
+from apps.a_common.db import bump_table_version, keyset_after, to_model
+from apps.model.form import FORM_ID_FACTOR, FormDB, FormMixin, form_month, from_form_id
 from apps.serializer.form import FormSerializer, FormSearchSerializer, FormUpdateSerializer
 from utils.time import int_timestamp
 
+"""
+表单按 in_time_applied 的月份分表（见 apps/model/form.py），旧的 form 表一直在查询范围里
+列表和搜索把涉及到的表 UNION ALL 成一个子查询 form_all，id 已经换成对外的id，分页、排序都在子查询上做
+游标分页的时候把游标条件和LIMIT下推到每张表里（bounds 见 apps/a_common/db.py 的 keyset_bounds），每张表只走索引取一页，不用把所有分表都扫一遍
+"""
+FORM_COLUMNS = [c.key for c in FormDB.__table__.columns if c.key != 'id']
+Criteria = Callable[[type], list]  # 传入一个分表的model，返回这张表上的where条件
+
+
+def _select_models(suffixes: List[str], applied_from: int = None, applied_to: int = None) -> List[Tuple[str, type]]:
+    """ 按 in_time_applied 的范围裁掉不可能有数据的分表，旧表没法按月份裁，一直带上 """
+    first = form_month(applied_from) if applied_from is not None else None
+    last = form_month(applied_to) if applied_to is not None else None
+    models = [('', FormDB)]
+    for suffix in suffixes:
+        if (first is None or suffix >= first) and (last is None or suffix <= last):
+            models.append((suffix, FormMixin.model(suffix)))
+    return models
+
+
+def form_models(session: Session, applied_from: int = None, applied_to: int = None) -> List[Tuple[str, type]]:
+    return _select_models(FormMixin.suffixes(session), applied_from, applied_to)
+
+
+async def async_form_models(db: Database, applied_from: int = None, applied_to: int = None) -> List[Tuple[str, type]]:
+    return _select_models(await FormMixin.async_suffixes(db), applied_from, applied_to)
+
+
+def _page_of(s, model, offset: int, keyset: Sequence[str], bounds: Tuple[Optional[list], bool, int]):
+    """ 一张表上的一页：游标之后的、按keyset排好序的前limit行，id的条件换成分表里的id，这样能走主键 """
+    values, reverse, limit = bounds
+    columns = [getattr(model, name) for name in keyset]
+    for column in columns:
+        s = s.where(column.isnot(None))
+    if values is not None:
+        s = s.where(keyset_after(columns, [v - offset if name == 'id' else v for name, v in zip(keyset, values)], reverse))
+    # sqlite不允许 UNION ALL 的分支里直接带 ORDER BY/LIMIT，包一层子查询
+    return select([s.order_by(*[c.desc() if reverse else c.asc() for c in columns]).limit(limit).alias()])
+
+
+def form_union(models: List[Tuple[str, type]], criteria: Criteria = None, keyset: Sequence[str] = (), bounds: Tuple[Optional[list], bool, int] = None) -> Alias:
+    """ 每张表选出对外的id和其他列，UNION ALL 起来，bounds 不是None的时候每张表只取一页 """
+    selects = []
+    for suffix, model in models:
+        offset = int(suffix or 0) * FORM_ID_FACTOR
+        id_column = (literal(offset, BigInteger) + model.id) if offset else model.id
+        s = select([id_column.label('id')] + [getattr(model, c) for c in FORM_COLUMNS])
+        for condition in (criteria(model) if criteria is not None else ()):
+            s = s.where(condition)
+        if bounds is not None:
+            s = _page_of(s, model, offset, keyset, bounds)
+        selects.append(s)
+    statement = selects[0] if len(selects) == 1 else union_all(*selects)
+    return statement.alias('form_all')
+
+
+def form_union_query(session: Session, models: List[Tuple[str, type]], criteria: Criteria = None, keyset: Sequence[str] = (),
+                     bounds: Tuple[Optional[list], bool, int] = None) -> Tuple[Query, Alias]:
+    """ 返回 (query, 子查询)，排序和游标分页用子查询的列，例如 form_all.c.id，外层还是要用同样的keyset做一遍游标分页 """
+    form_all = form_union(models, criteria, keyset, bounds)
+    return session.query(form_all), form_all
+
+
+def _model_of(session: Session, form_id: int):
+    """ 对外的id对应的 (model, 分表里的id)，分表不存在的时候model是None """
+    suffix, local_id = from_form_id(form_id)
+    if not suffix:
+        return FormDB, local_id
+    return FormMixin.on(session, suffix, auto_create_table=False), local_id
+
 
 def add_form(session: Session, form_data: FormSerializer) -> FormDB:
-    form = FormDB(
-        name=form_data.name,
-        sex=form_data.sex,
-        phone=form_data.phone,
-        IDCard=form_data.IDCard,
-        org_name=form_data.org_name,
-        car_id=form_data.car_id,
-        reason=form_data.reason,
-        guarantor=form_data.guarantor,
-        guarantor_phone=form_data.guarantor_phone,
-        health_code_status=form_data.health_code_status,
-        is_cough=form_data.is_cough,
-        is_been_epidemic_area_in_two_weeks=form_data.is_been_epidemic_area_in_two_weeks,
-        in_time_applied=form_data.in_time_applied,
-        in_time_real=form_data.in_time_real,
-        out_time_real=form_data.out_time_real,
-        out_time_applied=form_data.out_time_applied)
+    model = FormMixin.on(session, form_month(form_data.in_time_applied))
+    form = model(**form_data.dict(exclude={'id'}))
     session.add(form)
     return form
 
 
 def update_form_by_phone(session: Session, data: FormUpdateSerializer):
-    forms = session.query(FormDB).filter(FormDB.phone == data.phone).order_by(FormDB.in_time_real).all()
-    if forms:
-        forms[0].out_time_real = int_timestamp()
-        session.add(forms[0])
+    query, form_all = form_union_query(session, form_models(session), lambda m: [m.phone == data.phone])
+    first = query.order_by(form_all.c.in_time_real).first()
+    if first is not None:
+        model, local_id = _model_of(session, first.id)
+        session.query(model).filter(model.id == local_id).update({model.out_time_real: int_timestamp()}, synchronize_session=False)
 
 
 def get_form_by_id(session: Session, form_id: int) -> FormDB:
-    form = session.query(FormDB).filter(FormDB.id == form_id).first()
+    model, local_id = _model_of(session, form_id)
+    if model is None:
+        return None
+    form = session.query(model).filter(model.id == local_id).first()
     return form
 
 
-def get_form_by_search(session: Session, search_condiction: FormSearchSerializer) -> Query:
-    query = session.query(FormDB)
-    if search_condiction.name is not None:
-        query.filter(FormDB.name == search_condiction.name)
-    if search_condiction.sex is not None:
-        query.filter(FormDB.sex == search_condiction.sex)
-    if search_condiction.health_code_status is not None:
-        query.filter(FormDB.health_code_status == search_condiction.health_code_status)
-    if search_condiction.is_been_epidemic_area_in_two_weeks is not None:
-        query.filter(FormDB.is_been_epidemic_area_in_two_weeks == search_condiction.is_been_epidemic_area_in_two_weeks)
-    if search_condiction.is_cough is not None:
-        query.filter(FormDB.is_cough == search_condiction.is_cough)
-    if search_condiction.in_time is not None:
-        query.filter(FormDB.in_time_real > search_condiction.in_time)
-    if search_condiction.out_time is not None:
-        query.filter(FormDB.out_time_real < search_condiction.out_time)
-    return query
+def get_form_by_search(session: Session, search_condiction: FormSearchSerializer, keyset: Sequence[str] = (),
+                       bounds: Tuple[Optional[list], bool, int] = None) -> Tuple[Query, Alias]:
+    def criteria(model) -> list:
+        conditions = []
+        if search_condiction.name is not None:
+            conditions.append(model.name == search_condiction.name)
+        if search_condiction.sex is not None:
+            conditions.append(model.sex == search_condiction.sex)
+        if search_condiction.health_code_status is not None:
+            conditions.append(model.health_code_status == search_condiction.health_code_status)
+        if search_condiction.is_been_epidemic_area_in_two_weeks is not None:
+            conditions.append(model.is_been_epidemic_area_in_two_weeks == search_condiction.is_been_epidemic_area_in_two_weeks)
+        if search_condiction.is_cough is not None:
+            conditions.append(model.is_cough == search_condiction.is_cough)
+        if search_condiction.in_time is not None:
+            conditions.append(model.in_time_real > search_condiction.in_time)
+        if search_condiction.out_time is not None:
+            conditions.append(model.out_time_real < search_condiction.out_time)
+        if search_condiction.applied_from is not None:
+            conditions.append(model.in_time_applied >= search_condiction.applied_from)
+        if search_condiction.applied_to is not None:
+            conditions.append(model.in_time_applied <= search_condiction.applied_to)
+        return conditions
+    
+    models = form_models(session, search_condiction.applied_from, search_condiction.applied_to)
+    return form_union_query(session, models, criteria, keyset, bounds)
 
 
 def delete_form_by_id(session: Session, form_id: int) -> FormDB:
-    form = session.query(FormDB).filter(FormDB.id == form_id).first()
-    session.delete(form)
+    form = get_form_by_id(session, form_id)
+    if form is not None:
+        session.delete(form)
     return form
+
+
+async def _async_model_of(db: Database, form_id: int):
+    suffix, local_id = from_form_id(form_id)
+    if not suffix:
+        return FormDB, local_id
+    if suffix not in await FormMixin.async_suffixes(db):
+        return None, local_id
+    return FormMixin.model(suffix), local_id
+
+
+async def async_add_form(db: Database, form_data: FormSerializer) -> FormDB:
+    model = await FormMixin.async_on(db, form_month(form_data.in_time_applied))
+    values = form_data.dict(exclude={'id'})
+    local_id = await db.execute(model.__table__.insert().values(**values))
+    bump_table_version(model.__tablename__)
+    return model(id=local_id, **values)
+
+
+async def async_update_form_by_phone(db: Database, data: FormUpdateSerializer):
+    """ 和 update_form_by_phone 一样，只改最早的一条 """
+    form_all = form_union(await async_form_models(db), lambda m: [m.phone == data.phone])
+    form_id = await db.fetch_val(select([form_all.c.id]).order_by(form_all.c.in_time_real).limit(1))
+    if form_id is None:
+        return
+    model, local_id = await _async_model_of(db, form_id)
+    if model is not None:
+        await db.execute(model.__table__.update().where(model.id == local_id).values(out_time_real=int_timestamp()))
+        bump_table_version(model.__tablename__)
+
+
+async def async_get_form_by_id(db: Database, form_id: int) -> Optional[FormDB]:
+    model, local_id = await _async_model_of(db, form_id)
+    if model is None:
+        return None
+    row = await db.fetch_one(select([model.__table__]).where(model.id == local_id))
+    return to_model(model, row)
+
+
+async def async_delete_form_by_id(db: Database, form_id: int) -> Optional[FormDB]:
+    model, local_id = await _async_model_of(db, form_id)
+    if model is None:
+        return None
+    async with db.transaction():
+        row = await db.fetch_one(select([model.__table__]).where(model.id == local_id))
+        if row is not None:
+            await db.execute(model.__table__.delete().where(model.id == local_id))
+    if row is None:
+        return None
+    bump_table_version(model.__tablename__)
+    return to_model(model, row)
@@ -1,6 +1,9 @@
+from typing import List
+
 from sqlalchemy.orm import Session
 
 from apps.model.permission import PermissionDB
+from apps.model.permission2role import Permission2RoleDB
 from apps.serializer.permission import PermissionSerializer
 
 
@@ -22,3 +25,7 @@ def update_permission_by_id(session: Session, permission_id: int, permission_ser
     permission.name = permission_serializer.name
     session.add(permission)
     return permission
+
+
+def get_role_ids_by_permission_id(session: Session, permission_id: int) -> List[int]:
+    return [i[0] for i in session.query(Permission2RoleDB.role_id).filter(Permission2RoleDB.permission_id == permission_id).distinct()]
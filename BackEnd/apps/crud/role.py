@@ -1,45 +1,53 @@
 from logging import getLogger
-from typing import List
+from typing import Iterable, List, Optional, Tuple, Union
 
+from databases import Database
+from sqlalchemy import bindparam, literal, select
 from sqlalchemy.orm import Session
 
-from apps.a_common.db import or_many_condition, Pagination
+from apps.a_common.db import CountMode, KeysetPagination, Pagination, bakery, id_filter, insert_ignore, make_pagination, to_model
+from apps.a_common.principal import Principal
 from apps.a_common.scheme import PageInfo
 from apps.model.permission2role import Permission2RoleDB
 from apps.model.user import UserDB
 from apps.model.user2role import User2RoleDB
 from apps.model.role import RoleDB
+from apps.model.role_closure import RoleClosureDB
 from apps.serializer.role import RoleSerializer
 
 logger = getLogger(__name__)
 
+ADD_MEMBERSHIP_CHUNK_SIZE = 1000
+
+
+_role_by_id = bakery(lambda session: session.query(RoleDB))
+_role_by_id += lambda query: query.filter(RoleDB.id == bindparam('role_id'))
+
 
 def get_role_by_id(session: Session, i: int) -> RoleDB:
-    return session.query(RoleDB).filter(RoleDB.id == i).first()
+    return _role_by_id(session).params(role_id=i).first()
 
 
-def get_users_by_role_id(session: Session, i: int, page_info: PageInfo) -> Pagination:
+def get_users_by_role_id(session: Session, i: int, page_info: PageInfo) -> Union[Pagination, KeysetPagination]:
     users = session.query(UserDB). \
         filter(RoleDB.id == i). \
         filter(User2RoleDB.role_id == RoleDB.id). \
         filter(User2RoleDB.user_id == UserDB.id)
     
-    pagination = Pagination(users, page_info=page_info)
+    # 根角色下面是全校的人，不count，用has_more翻页
+    pagination = make_pagination(users, page_info, keyset=(UserDB.id,), count_mode=CountMode.NONE)
     return pagination
 
 
-def get_role_under_user(session: Session, user: UserDB, page_info: PageInfo) -> Pagination:
+def get_role_under_user(session: Session, user: Principal, page_info: PageInfo) -> Union[Pagination, KeysetPagination]:
     if user.is_superuser:
-        pagination = Pagination(session.query(RoleDB), page_info=page_info)
+        # 没有过滤条件，用数据库的统计信息估算总数
+        pagination = make_pagination(session.query(RoleDB), page_info, keyset=(RoleDB.id,), count_mode=CountMode.ESTIMATE)
         return pagination
     
-    query = session.query(RoleDB)
-    condition_list = [RoleDB.id.in_(user.role_id_set)]
-    for role_id in user.role_id_set:
-        condition_list.append(RoleDB.grand_id.like(f'%|{role_id}|%'))
-    
-    query = query.filter(or_many_condition(condition_list))
-    pagination = Pagination(query, page_info=page_info)
+    subtree = session.query(RoleClosureDB.descendant_id).filter(RoleClosureDB.ancestor_id.in_(user.role_id_set))
+    query = session.query(RoleDB).filter(RoleDB.id.in_(subtree))
+    pagination = make_pagination(query, page_info, keyset=(RoleDB.id,))
     return pagination
 
 
@@ -47,6 +55,37 @@ def get_role_by_user_id(session: Session, user_id: int) -> List[RoleDB]:
     return session.query(RoleDB).filter(User2RoleDB.user_id == user_id, User2RoleDB.role_id == RoleDB.id).all()
 
 
+async def async_get_role_by_id(db: Database, i: int) -> Optional[RoleDB]:
+    row = await db.fetch_one(select([RoleDB.__table__]).where(RoleDB.id == i))
+    return to_model(RoleDB, row)
+
+
+async def async_get_role_by_user_id(db: Database, user_id: int) -> List[RoleDB]:
+    rows = await db.fetch_all(
+        select([RoleDB.__table__]).
+            select_from(RoleDB.__table__.join(User2RoleDB.__table__, User2RoleDB.role_id == RoleDB.id)).
+            where(User2RoleDB.user_id == user_id)
+    )
+    return [to_model(RoleDB, row) for row in rows]
+
+
+def add_users_to_role(session: Session, role_id: int, user_ids: List[int]) -> Tuple[List[int], int]:
+    """
+    幂等地把用户加到角色里，返回 (新加的用户id, 已经在角色里的数量)
+    先一条sql查出已经存在的，剩下的分块用core的insert写入，并发重复插入由唯一索引+insert ignore兜底
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    with id_filter(session, User2RoleDB.user_id, user_ids) as condition:
+        present = {i[0] for i in session.query(User2RoleDB.user_id).filter(User2RoleDB.role_id == role_id).filter(condition)}
+    
+    added_ids = [i for i in user_ids if i not in present]
+    statement = insert_ignore(session, User2RoleDB.__table__)
+    for i in range(0, len(added_ids), ADD_MEMBERSHIP_CHUNK_SIZE):
+        chunk = added_ids[i:i + ADD_MEMBERSHIP_CHUNK_SIZE]
+        session.execute(statement, [{'user_id': user_id, 'role_id': role_id} for user_id in chunk])
+    return added_ids, len(present)
+
+
 def add_permission_to_role(session: Session, permission_ids: List[int], role_id: int):
     session.add_all(tuple(Permission2RoleDB(permission_id=i, role_id=role_id) for i in permission_ids))
 
@@ -61,4 +100,42 @@ def add_role(session: Session, data: RoleSerializer) -> RoleDB:
             grand_id = f'|{data.parent_id}|'
     role = RoleDB(name=data.name, parent_id=data.parent_id or 0, grand_id=grand_id)
     session.add(role)
+    session.flush()
+    add_role_closure(session, role.id, role.parent_id)
     return role
+
+
+def add_role_closure(session: Session, role_id: int, parent_id: int):
+    """ 新角色的祖先 = 父角色的祖先（包括父角色自己），再加上自己 """
+    closure = RoleClosureDB.__table__
+    if parent_id:
+        ancestors = select([closure.c.ancestor_id, literal(role_id), closure.c.depth + 1]). \
+            where(closure.c.descendant_id == parent_id)
+        session.execute(closure.insert().from_select(['ancestor_id', 'descendant_id', 'depth'], ancestors))
+    session.execute(closure.insert().values(ancestor_id=role_id, descendant_id=role_id, depth=0))
+
+
+def delete_role_closure(session: Session, role_ids: Iterable[int]):
+    role_ids = list(role_ids)
+    session.query(RoleClosureDB).filter(RoleClosureDB.descendant_id.in_(role_ids)).delete(False)
+    session.query(RoleClosureDB).filter(RoleClosureDB.ancestor_id.in_(role_ids)).delete(False)
+
+
+def get_role_subtree_ids(session: Session, role_id: int) -> List[int]:
+    """ 角色和它所有的后代，一条sql查出来，按深度从深到浅排序，从前往后删不会留下断开的子树 """
+    query = session.query(RoleClosureDB.descendant_id). \
+        filter(RoleClosureDB.ancestor_id == role_id). \
+        order_by(RoleClosureDB.depth.desc())
+    role_ids = [i[0] for i in query if i[0] != role_id]
+    role_ids.append(role_id)
+    return role_ids
+
+
+def delete_roles(session: Session, role_ids: List[int]) -> List[int]:
+    """ 删除角色以及用户、权限、闭包表里的关联数据，返回受影响的用户id。role_ids 要调用方分好块 """
+    user_ids = [i[0] for i in session.query(User2RoleDB.user_id).filter(User2RoleDB.role_id.in_(role_ids)).distinct()]
+    session.query(User2RoleDB).filter(User2RoleDB.role_id.in_(role_ids)).delete(False)
+    session.query(Permission2RoleDB).filter(Permission2RoleDB.role_id.in_(role_ids)).delete(False)
+    delete_role_closure(session, role_ids)
+    session.query(RoleDB).filter(RoleDB.id.in_(role_ids)).delete(False)
+    return user_ids
@@ -1,29 +1,31 @@
-from typing import List, Tuple, Union, Set
+from typing import Dict, Iterable, List, Optional, Tuple, Union, Set
 
-from sqlalchemy import func
+from databases import Database
+from sqlalchemy import bindparam, case, func, select
 from sqlalchemy.orm import Query, Session
 
 from apps.a_common.constants import USER_IDENTITY_LITERAL, UserIdentity
-from apps.a_common.db import fast_count, or_many_condition
+from apps.a_common.db import bakery, bump_table_version, fast_count, id_filter, to_model
 from apps.a_common.error import AppError, InvalidParamError, PermissionError
+from apps.a_common.principal import Principal
 from apps.a_common.scheme import CommonlyUsedUserSearch
 from apps.crud.role import get_role_by_id
-from apps.model.permission import PermissionDB
-from apps.model.permission2role import Permission2RoleDB
+from apps.logic.permission_index import permission_index
 from apps.model.user import UserDB
 from apps.model.user2role import User2RoleDB
 from apps.model.role import RoleDB
 from apps.serializer.user import BaseUserSerializer, CreateUser
-from utils.time import timer
+from utils.time import int_timestamp, timer
 
 
-def add_user(session: Session, user_data: CreateUser) -> UserDB:
+def add_user(session: Session, user_data: CreateUser, password_hash: str) -> UserDB:
+    """ password_hash 由调用方提前算好，async的接口里用 async_generate_password_hash """
     user = UserDB(
         name=user_data.name,
         sex=user_data.sex,
         phone=user_data.phone,
+        password=password_hash,
     )
-    user.generate_password_hash(user_data.password)
     session.add(user)
     return user
 
@@ -33,43 +35,73 @@ def get_users_by_id_list(session: Session, user_ids: List[int]) -> List[UserDB]:
     return users
 
 
+_user_by_id = bakery(lambda session: session.query(UserDB))
+_user_by_id += lambda query: query.filter(UserDB.id == bindparam('user_id'))
+
+
 def get_user_by_id(session: Session, user_id: int) -> UserDB:
-    user = session.query(UserDB).filter(UserDB.id == user_id).first()
+    user = _user_by_id(session).params(user_id=user_id).first()
     return user
 
 
-def get_user_with_permission_and_group_by_id(session: Session, user_id: int) -> UserDB:
-    subquery_group = session.query(RoleDB, User2RoleDB.user_id). \
-        filter(User2RoleDB.role_id == RoleDB.id).subquery()
-    
-    subquery_permission = session.query(PermissionDB.name, Permission2RoleDB.role_id). \
-        filter(PermissionDB.id == Permission2RoleDB.permission_id).subquery()
-    
-    result = session.query(UserDB, subquery_group.c.name, subquery_permission.c.name, subquery_group.c.id). \
-        outerjoin(subquery_group, subquery_group.c.user_id == UserDB.id). \
-        outerjoin(subquery_permission, subquery_permission.c.role_id == subquery_group.c.id). \
-        filter(UserDB.id == user_id) \
-        .all()
+def get_user_ids_by_role_ids(session: Session, role_ids: Iterable[int]) -> List[int]:
+    role_ids = list(role_ids)
+    if not role_ids:
+        return []
+    return [i[0] for i in session.query(User2RoleDB.user_id).filter(User2RoleDB.role_id.in_(role_ids)).distinct()]
+
+
+_principal_rows = bakery(lambda session: session.query(UserDB.is_superuser, RoleDB.id, RoleDB.name))
+_principal_rows += lambda query: query. \
+    outerjoin(User2RoleDB, User2RoleDB.user_id == UserDB.id). \
+    outerjoin(RoleDB, RoleDB.id == User2RoleDB.role_id). \
+    filter(UserDB.id == bindparam('user_id'))
+
+
+def get_principal_by_id(session: Session, user_id: int) -> Optional[Principal]:
+    """
+    只查用户和他的角色，每个角色一行
+    权限不再join，直接用 permission_index 里预先算好的角色掩码做或运算
+    """
+    role_rows = _principal_rows(session).params(user_id=user_id).all()
     
-    if len(result) == 0:
+    if len(role_rows) == 0:
         return None
     
-    user: UserDB = result[0][0]
-    for _, group_name, permission_name, group_id in result:
-        if group_name:
-            user.role_set.add(group_name)
-        if permission_name:
-            user.permission_set.add(permission_name)
-        if group_id:
-            user.role_id_set.add(group_id)
-    return user
+    role_id_set = {role_id for _, role_id, _ in role_rows if role_id is not None}
+    role_set = {role_name for _, role_id, role_name in role_rows if role_id is not None}
+    
+    permission_index.ensure(session)
+    permission_mask = permission_index.role_mask(role_id_set)
+    permission_set = permission_index.names_of(permission_mask)
+    return Principal(user_id, role_rows[0][0], role_id_set, role_set, permission_set, permission_mask)
+
+
+_user_by_phone = bakery(lambda session: session.query(UserDB))
+_user_by_phone += lambda query: query.filter(UserDB.phone == bindparam('phone'))
 
 
 def get_user_by_phone_number(session: Session, phone_number: str) -> UserDB:
-    user = session.query(UserDB).filter(UserDB.phone == phone_number).first()
+    user = _user_by_phone(session).params(phone=phone_number).first()
     return user
 
 
+async def async_get_user_by_id(db: Database, user_id: int) -> Optional[UserDB]:
+    """ 返回的UserDB没有绑定session，只能读，要修改用 async_update_user_password 这样的core语句 """
+    row = await db.fetch_one(select([UserDB.__table__]).where(UserDB.id == user_id))
+    return to_model(UserDB, row)
+
+
+async def async_get_user_by_phone_number(db: Database, phone_number: str) -> Optional[UserDB]:
+    row = await db.fetch_one(select([UserDB.__table__]).where(UserDB.phone == phone_number))
+    return to_model(UserDB, row)
+
+
+async def async_update_user_password(db: Database, user_id: int, password_hash: str):
+    await db.execute(UserDB.__table__.update().where(UserDB.id == user_id).values(password=password_hash, update_at=int_timestamp()))
+    bump_table_version(UserDB.__tablename__)
+
+
 def update_user_by_id(session: Session, user_id: int, user_data: BaseUserSerializer) -> UserDB:
     user = session.query(UserDB).filter(UserDB.id == user_id).first()
     user.sex = user_data.sex
@@ -78,6 +110,15 @@ def update_user_by_id(session: Session, user_id: int, user_data: BaseUserSeriali
     return user
 
 
+def update_users_password(session: Session, password_map: Dict[int, str]) -> int:
+    """ 一条UPDATE ... SET password = CASE id WHEN .. THEN .. END 批量写入各自的hash """
+    if not password_map:
+        return 0
+    return session.query(UserDB). \
+        filter(UserDB.id.in_(list(password_map))). \
+        update({UserDB.password: case(password_map, value=UserDB.id)}, synchronize_session=False)
+
+
 def delete_user_by_id(session: Session, user_id: int) -> UserDB:
     user = session.query(UserDB).filter(UserDB.id == user_id).first()
     session.delete(user)
@@ -86,25 +127,28 @@ def delete_user_by_id(session: Session, user_id: int) -> UserDB:
 
 @timer
 def update_user_identity(session: Session, user_ids: List[int], identity: USER_IDENTITY_LITERAL):
-    session.query(UserDB). \
-        filter(or_many_condition([UserDB.id == i for i in user_ids])). \
-        update({UserDB.user_identity: UserDB.user_identity.op('|')(identity)}, synchronize_session=False)
+    with id_filter(session, UserDB.id, user_ids) as condition:
+        session.query(UserDB). \
+            filter(condition). \
+            update({UserDB.user_identity: UserDB.user_identity.op('|')(identity)}, synchronize_session=False)
 
 
 @timer
 def cancel_user_identity(session: Session, user_ids: Set[int], identity: USER_IDENTITY_LITERAL):
-    session.query(UserDB). \
-        filter(or_many_condition([UserDB.id == i for i in user_ids])). \
-        filter(UserDB.user_identity.op('&')(identity) == identity). \
-        update({UserDB.user_identity: UserDB.user_identity - identity}, synchronize_session=False)
+    with id_filter(session, UserDB.id, user_ids) as condition:
+        session.query(UserDB). \
+            filter(condition). \
+            filter(UserDB.user_identity.op('&')(identity) == identity). \
+            update({UserDB.user_identity: UserDB.user_identity - identity}, synchronize_session=False)
 
 
 @timer
 def update_and_cancel_user_identity(session: Session, user_ids: List[int], update_identity: USER_IDENTITY_LITERAL, cancel_identity: USER_IDENTITY_LITERAL):
-    session.query(UserDB). \
-        filter(or_many_condition([UserDB.id == i for i in user_ids])). \
-        filter(UserDB.user_identity.op('&')(cancel_identity) == cancel_identity). \
-        update({UserDB.user_identity: UserDB.user_identity - cancel_identity + update_identity}, synchronize_session=False)
+    with id_filter(session, UserDB.id, user_ids) as condition:
+        session.query(UserDB). \
+            filter(condition). \
+            filter(UserDB.user_identity.op('&')(cancel_identity) == cancel_identity). \
+            update({UserDB.user_identity: UserDB.user_identity - cancel_identity + update_identity}, synchronize_session=False)
 
 
 @timer
@@ -131,13 +175,13 @@ def common_user_search(query: Query, params: CommonlyUsedUserSearch) -> Query:
 
 
 @timer
-def common_user_search_with_permission_check(manager: UserDB, query: Query, session: Session, params: CommonlyUsedUserSearch) -> Tuple[Union[Query, None], Union[AppError, None]]:
+def common_user_search_with_permission_check(manager: Principal, query: Query, session: Session, params: CommonlyUsedUserSearch) -> Tuple[Union[Query, None], Union[AppError, None]]:
     from apps.a_common.permission import has_permission_manage_role
     
     if params.role_id is None:
         return None, InvalidParamError('请选择角色')
     
-    if has_permission_manage_role(get_role_by_id(session=session, i=params.role_id), manager):
+    if has_permission_manage_role(session, get_role_by_id(session=session, i=params.role_id), manager):
         query = query.filter(User2RoleDB.role_id == params.role_id)
     else:
         return None, PermissionError('您没有查看这个组的权限')
@@ -1,9 +1,55 @@
 # coding=utf-8
+from databases import Database
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
+from apps.a_common.pool import InstrumentedQueuePool, POOL_MAX_OVERFLOW, derive_pool_sizes, get_worker_count, watch_engine
 from config import SQL_CONNECT_ARGS, SQL_POOL_SIZE, SQL_POOL_TIMEOUT, SQL_URL
 
+try:
+    from config import ASYNC_SQL_URL, ASYNC_SQL_POOL_SIZE
+except ImportError:
+    ASYNC_SQL_URL = SQL_URL
+    ASYNC_SQL_POOL_SIZE = 20
+
+try:
+    from config import SQL_REPLICAS
+except ImportError:
+    SQL_REPLICAS = []
+
+try:
+    from config import SQL_POOL_MODE, SQL_CONNECTION_BUDGET, SQL_WORKERS
+except ImportError:
+    SQL_POOL_MODE, SQL_CONNECTION_BUDGET, SQL_WORKERS = 'fixed', 0, 0
+
 """ 实例化各种扩展，包括flask插件，也包括其他的一些实例，比如redis、minio、普罗米修斯等等 """
-engine = create_engine(SQL_URL, pool_size=SQL_POOL_SIZE, pool_timeout=SQL_POOL_TIMEOUT, encoding='utf8', connect_args=SQL_CONNECT_ARGS)
+# budget模式下按 所有worker共用的连接数/worker数 算出每个worker的连接池大小，fixed模式每个worker都用SQL_POOL_SIZE
+if SQL_POOL_MODE == 'budget':
+    pool_size, max_overflow, async_pool_size = derive_pool_sizes(SQL_CONNECTION_BUDGET, get_worker_count(SQL_WORKERS), ASYNC_SQL_POOL_SIZE)
+else:
+    pool_size, max_overflow, async_pool_size = SQL_POOL_SIZE, POOL_MAX_OVERFLOW, ASYNC_SQL_POOL_SIZE
+
+
+def _create_engine(url: str, name: str):
+    engine = create_engine(url, poolclass=InstrumentedQueuePool, pool_size=pool_size, max_overflow=max_overflow, pool_timeout=SQL_POOL_TIMEOUT,
+                           encoding='utf8', connect_args=SQL_CONNECT_ARGS)
+    watch_engine(name, engine)
+    return engine
+
+
+def _create_database(url: str) -> Database:
+    # aiosqlite 没有连接池参数
+    if url.startswith('sqlite'):
+        return Database(url)
+    return Database(url, min_size=1, max_size=async_pool_size)
+
+
+engine = _create_engine(SQL_URL, 'primary')
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine, expire_on_commit=False)
+# 异步驱动的连接池，不阻塞事件循环，只能用sqlalchemy core的语句，启动时connect，关闭时disconnect
+database = _create_database(ASYNC_SQL_URL)
+# 只读副本 (engine, database, weight)，怎么选副本见 apps/a_common/replica.py
+replicas = [
+    (_create_engine(replica['url'], f'replica-{i}'), _create_database(replica.get('async_url', replica['url'])), replica.get('weight', 1))
+    for i, replica in enumerate(SQL_REPLICAS)
+]
@@ -0,0 +1,212 @@
+import csv
+import gzip
+import hashlib
+import json
+import os
+import time
+from datetime import datetime
+from logging import getLogger
+from typing import Dict, Iterator, List, Optional
+
+import pytz
+from sqlalchemy import and_, func, select
+from sqlalchemy.orm import Session
+
+from apps.a_common.error import DBError
+from apps.crud.form import FORM_COLUMNS, form_models
+from apps.model.form import FormDB, FormMixin, form_month, to_form_id
+from config import FILE_PATH
+from utils.time import int_timestamp, to_formatted_time
+
+logger = getLogger(__name__)
+
+"""
+表单归档：python manage.py form archive --before 2021-06-01
+1. 旧表和分表里 in_time_applied 早于 before 的表单，按id分批读出，按申请日期写到 {path}{日期}/ 下，gzip压缩的ndjson或csv，id是对外的id
+2. 写完读回文件校验，行数、id和数据库里的对不上就停下，不删任何数据
+3. 整个月都早于 before 的分表直接drop，其他的按归档了的id小批量删除，每批单独提交，避免长时间锁表
+每次归档在 {path} 下写一个 manifest-{run_id}.json，记录每个文件的行数和sha256
+审计的时候用 iter_archived_forms 或者 python manage.py form archive-query 查
+"""
+ARCHIVE_PATH = f'{FILE_PATH}archive/form/'
+ARCHIVE_FORMATS = ('ndjson', 'csv')
+ARCHIVE_DATE_FORMAT = '%Y-%m-%d'
+ARCHIVE_COLUMNS = ['id'] + FORM_COLUMNS
+_PYTHON_TYPES = {c.key: c.type.python_type for c in FormDB.__table__.columns}
+
+
+def date_begin(date: str) -> int:
+    """ YYYY-MM-DD 那天0点（北京时间）的时间戳 """
+    return int(pytz.timezone('Asia/Shanghai').localize(datetime.strptime(date, ARCHIVE_DATE_FORMAT)).timestamp())
+
+
+def _file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _from_csv(column: str, value: str):
+    """ csv里全是字符串，按列的类型转回来，空字符串是None """
+    if value == '':
+        return None
+    python_type = _PYTHON_TYPES[column]
+    if python_type is bool:
+        return value == 'True'
+    return python_type(value)
+
+
+def _read_file(path: str) -> Iterator[dict]:
+    with gzip.open(path, 'rt', encoding='utf-8', newline='') as f:
+        if path.endswith('.ndjson.gz'):
+            for line in f:
+                yield json.loads(line)
+            return
+        for row in csv.DictReader(f):
+            yield {k: _from_csv(k, v) for k, v in row.items()}
+
+
+class ArchiveWriter:
+    """ 一张表一次归档的文件，按申请日期分目录，每个日期一个文件，用到的时候才打开 """
+
+    def __init__(self, path: str, table: str, run_id: str, fmt: str = 'ndjson'):
+        self.path = path
+        self.table = table
+        self.run_id = run_id
+        self.fmt = fmt
+        self.counts: Dict[str, int] = {}
+        self._files = {}
+
+    def write(self, row: dict):
+        date = to_formatted_time(row['in_time_applied'], ARCHIVE_DATE_FORMAT)
+        file_path = f'{self.path}{date}/{self.table}.{self.run_id}.{self.fmt}.gz'
+        if file_path not in self._files:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            f = gzip.open(file_path, 'wt', encoding='utf-8', newline='')
+            writer = csv.DictWriter(f, ARCHIVE_COLUMNS) if self.fmt == 'csv' else None
+            if writer is not None:
+                writer.writeheader()
+            self._files[file_path] = (f, writer)
+            self.counts[file_path] = 0
+        f, writer = self._files[file_path]
+        if writer is None:
+            f.write(json.dumps(row, ensure_ascii=False, separators=(',', ':')) + '\n')
+        else:
+            writer.writerow(row)
+        self.counts[file_path] += 1
+
+    def close(self):
+        for f, _ in self._files.values():
+            f.close()
+        self._files.clear()
+
+    def verify(self, ids: List[int]):
+        """ 读回写好的文件，和写进去的id一一对应才算成功 """
+        archived = []
+        for file_path, count in self.counts.items():
+            rows = [row['id'] for row in _read_file(file_path)]
+            if len(rows) != count:
+                raise DBError([f'{file_path}: wrote {count} rows, read back {len(rows)}'])
+            archived += rows
+        if sorted(archived) != sorted(ids):
+            raise DBError([f'{self.table}: archived ids do not match the rows read from database'])
+
+
+def _archive_table(session: Session, suffix: str, model, cutoff: int, writer: ArchiveWriter, batch_size: int) -> List[int]:
+    """ 按id分批读出 in_time_applied < cutoff 的行写进文件，返回分表里的id """
+    table = model.__table__
+    condition = table.c.in_time_applied < cutoff
+    local_ids, last_id = [], 0
+    while True:
+        rows = session.execute(
+            select([table]).where(and_(condition, table.c.id > last_id)).order_by(table.c.id).limit(batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        for row in rows:
+            data = {c: row[c] for c in ARCHIVE_COLUMNS}
+            data['id'] = to_form_id(suffix, row['id'])
+            writer.write(data)
+            local_ids.append(row['id'])
+        last_id = rows[-1]['id']
+
+    # 归档期间插入的、id更小的旧数据不在文件里，数据库里按同样的条件数一遍
+    if local_ids:
+        total = session.execute(select([func.count()]).where(and_(condition, table.c.id <= last_id))).scalar()
+        if total != len(local_ids):
+            raise DBError([f'{table.name}: {total} rows in database, archived {len(local_ids)}'])
+    return local_ids
+
+
+def _delete_in_batches(session: Session, model, local_ids: List[int], batch_size: int, pause: float):
+    table = model.__table__
+    for i in range(0, len(local_ids), batch_size):
+        session.execute(table.delete().where(table.c.id.in_(local_ids[i:i + batch_size])))
+        session.commit()
+        if pause:
+            time.sleep(pause)
+
+
+def archive_forms(session: Session, before: str, path: str = ARCHIVE_PATH, fmt: str = 'ndjson', batch_size: int = 5000,
+                  delete_batch_size: int = 500, pause: float = 0, keep: bool = False) -> dict:
+    """
+    归档 in_time_applied 早于 before（YYYY-MM-DD，北京时间）的表单，返回manifest
+    keep=True 只归档和校验，不删除
+    """
+    cutoff = date_begin(before)
+    run_id = to_formatted_time(int_timestamp(), '%Y%m%d%H%M%S')
+    manifest = {'run_id': run_id, 'before': before, 'format': fmt, 'tables': {}}
+    # 分表的后缀 >= cutoff 的月份时，表里一定没有要归档的数据
+    for suffix, model in form_models(session, applied_to=cutoff - 1):
+        writer = ArchiveWriter(path, model.__tablename__, run_id, fmt)
+        try:
+            local_ids = _archive_table(session, suffix, model, cutoff, writer, batch_size)
+        finally:
+            writer.close()
+        writer.verify([to_form_id(suffix, i) for i in local_ids])
+
+        action = 'keep'
+        if local_ids and not keep:
+            # 整个月都在cutoff之前的分表，表里的行都归档了就drop
+            total = session.query(func.count(model.id)).scalar() if suffix and suffix < form_month(cutoff) else None
+            if total == len(local_ids):
+                FormMixin.drop(session, suffix)
+                session.commit()
+                action = 'drop'
+            else:
+                _delete_in_batches(session, model, local_ids, delete_batch_size, pause)
+                action = 'delete'
+
+        manifest['tables'][model.__tablename__] = {
+            'rows': len(local_ids),
+            'action': action,
+            'files': {p: {'rows': c, 'sha256': _file_sha256(p)} for p, c in writer.counts.items()},
+        }
+        logger.info(f'archive {model.__tablename__}: {len(local_ids)} rows, {action}')
+
+    os.makedirs(path, exist_ok=True)
+    with open(f'{path}manifest-{run_id}.json', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+
+def archived_dates(path: str = ARCHIVE_PATH) -> List[str]:
+    if not os.path.isdir(path):
+        return []
+    return sorted(d for d in os.listdir(path) if os.path.isdir(os.path.join(path, d)))
+
+
+def iter_archived_forms(date_from: Optional[str] = None, date_to: Optional[str] = None, path: str = ARCHIVE_PATH, **equals) -> Iterator[dict]:
+    """
+    查归档的表单，先按申请日期的目录裁剪（左闭右闭），再逐行比较 equals 里的列，例如
+        iter_archived_forms('2021-05-01', '2021-05-31', phone='13218655818')
+    """
+    for date in archived_dates(path):
+        if (date_from is not None and date < date_from) or (date_to is not None and date > date_to):
+            continue
+        for name in sorted(os.listdir(os.path.join(path, date))):
+            for row in _read_file(os.path.join(path, date, name)):
+                if all(row.get(k) == v for k, v in equals.items()):
+                    yield row
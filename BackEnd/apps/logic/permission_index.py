@@ -0,0 +1,108 @@
+import time
+from logging import getLogger
+from threading import RLock
+from typing import Dict, FrozenSet, Iterable
+
+from sqlalchemy.orm import Session
+
+from apps.a_common.principal import SUPERUSER_BIT
+from apps.model.permission import PermissionDB
+from apps.model.permission2role import Permission2RoleDB
+
+logger = getLogger(__name__)
+
+"""
+把权限名编译成固定的比特位，角色的权限预先算成一个整数掩码，用户的权限就是他所有角色掩码的或
+比特位按名字分配，只增不减，同一个进程里一个名字的比特位不会变，缓存里的Principal不会因为重新加载而错位
+修改了权限、角色权限的接口，commit之后调用 permission_index.expire()，超过PERMISSION_INDEX_RELOAD_SECONDS也会重新加载
+"""
+PERMISSION_INDEX_RELOAD_SECONDS = 60
+
+
+class PermissionIndex:
+    def __init__(self):
+        self._lock = RLock()
+        self._bits: Dict[str, int] = {}
+        self._names: Dict[int, str] = {}
+        self._role_masks: Dict[int, int] = {}
+        self._loaded_at = None
+        self._generation = 0
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded_at is not None
+
+    def bit(self, name: str) -> int:
+        """ 名字对应的比特位，没有就分配一个，第0位留给超级管理员 """
+        bit = self._bits.get(name)
+        if bit is not None:
+            return bit
+        with self._lock:
+            if name not in self._bits:
+                bit = len(self._bits) + SUPERUSER_BIT + 1
+                self._bits[name] = bit
+                self._names[bit] = name
+            return self._bits[name]
+
+    def mask_of(self, names: Iterable[str]) -> int:
+        mask = 0
+        for name in names:
+            mask |= 1 << self.bit(name)
+        return mask
+
+    def names_of(self, mask: int) -> FrozenSet[str]:
+        names, bit = [], 0
+        while mask:
+            if mask & 1 and bit in self._names:
+                names.append(self._names[bit])
+            mask >>= 1
+            bit += 1
+        return frozenset(names)
+
+    def load(self, session: Session):
+        generation = self._generation
+        rows = session.query(Permission2RoleDB.role_id, PermissionDB.name). \
+            filter(PermissionDB.id == Permission2RoleDB.permission_id). \
+            all()
+        for name, in session.query(PermissionDB.name).order_by(PermissionDB.id):
+            self.bit(name)
+
+        role_masks = {}
+        for role_id, name in rows:
+            role_masks[role_id] = role_masks.get(role_id, 0) | 1 << self.bit(name)
+
+        with self._lock:
+            self._role_masks = role_masks
+            # 加载期间有写入的话，这次结果可能已经过期，下次用到的时候再加载
+            if generation == self._generation:
+                self._loaded_at = time.monotonic()
+        logger.info(f'permission index loaded, {len(self._bits)} permissions, {len(role_masks)} roles')
+
+    def expire(self):
+        with self._lock:
+            self._generation += 1
+            self._loaded_at = None
+
+    def ensure(self, session: Session):
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > PERMISSION_INDEX_RELOAD_SECONDS:
+            self.load(session)
+
+    def role_mask(self, role_ids: Iterable[int]) -> int:
+        mask = 0
+        for role_id in role_ids:
+            mask |= self._role_masks.get(role_id, 0)
+        return mask
+
+    def has(self, mask: int, name: str) -> bool:
+        """ 一次位运算，同时判断超级管理员和权限位 """
+        return mask & (1 << SUPERUSER_BIT | 1 << self.bit(name)) != 0
+
+    def stats(self) -> dict:
+        return {
+            'loaded': self.loaded,
+            'bits': len(self._bits),
+            'roles': len(self._role_masks),
+        }
+
+
+permission_index = PermissionIndex()
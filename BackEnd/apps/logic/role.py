@@ -0,0 +1,43 @@
+from logging import getLogger
+from typing import List
+
+from sqlalchemy.orm import Session
+
+from apps.a_common.db import get_session_local
+from apps.a_common.job import Job
+from apps.crud.role import delete_roles
+from apps.crud.user import cancel_user_as_admin_if_no_role
+from apps.logic.role_tree import role_tree
+from apps.logic.user import invalidate_principal
+
+logger = getLogger(__name__)
+
+DELETE_ROLE_CHUNK_SIZE = 500
+
+
+def delete_role_subtree(session: Session, role_ids: List[int]) -> List[int]:
+    """
+    分块删除角色，再批量重新计算受影响用户的身份，返回受影响的用户id
+    role_ids 用 get_role_subtree_ids 得到，不会commit，commit之后调用方要更新 role_tree 和 principal 缓存
+    """
+    user_ids = set()
+    for i in range(0, len(role_ids), DELETE_ROLE_CHUNK_SIZE):
+        user_ids.update(delete_roles(session, role_ids[i:i + DELETE_ROLE_CHUNK_SIZE]))
+    
+    user_ids = list(user_ids)
+    for i in range(0, len(user_ids), DELETE_ROLE_CHUNK_SIZE):
+        cancel_user_as_admin_if_no_role(session, user_ids[i:i + DELETE_ROLE_CHUNK_SIZE])
+    return user_ids
+
+
+def delete_role_subtree_job(job: Job, role_ids: List[int]):
+    """ 后台任务版本，每一块单独commit，先删深的，中途失败剩下的也是一棵完整的子树，可以再删一次 """
+    for i in range(0, len(role_ids), DELETE_ROLE_CHUNK_SIZE):
+        chunk = role_ids[i:i + DELETE_ROLE_CHUNK_SIZE]
+        with get_session_local() as session:
+            user_ids = delete_role_subtree(session, chunk)
+            session.commit()
+        role_tree.remove(chunk)
+        invalidate_principal(user_ids)
+        job.advance(len(chunk))
+    logger.info(f'{job} delete {len(role_ids)} roles')
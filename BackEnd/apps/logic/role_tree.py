@@ -0,0 +1,148 @@
+import time
+from logging import getLogger
+from threading import RLock
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set
+
+from sqlalchemy.orm import Session
+
+from apps.a_common.db import get_session_local
+from apps.model.role import RoleDB
+
+logger = getLogger(__name__)
+
+"""
+进程内的角色树，启动时整棵加载，角色增删改的接口commit之后调用 add/rename/remove 增量更新
+祖先、后代的判断都是集合查找，不产生sql
+其他worker的修改这里看不到，所以遇到数据库里有、树里没有的role_id，或者超过ROLE_TREE_RELOAD_SECONDS，会重新加载一次
+"""
+ROLE_TREE_RELOAD_SECONDS = 60
+
+
+class RoleNode:
+    __slots__ = ('id', 'name', 'parent_id', 'children', 'ancestors')
+
+    def __init__(self, id: int, name: str, parent_id: int, ancestors: FrozenSet[int] = frozenset()):
+        self.id = id
+        self.name = name
+        self.parent_id = parent_id or 0
+        self.children: Set[int] = set()
+        self.ancestors: FrozenSet[int] = ancestors
+
+    def __str__(self):
+        return f'[RoleNode: {self.id}]'
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class RoleTree:
+    def __init__(self):
+        self._nodes: Dict[int, RoleNode] = {}
+        self._lock = RLock()
+        self._loaded_at = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded_at is not None
+
+    def load(self, session: Session):
+        rows = session.query(RoleDB.id, RoleDB.name, RoleDB.parent_id).all()
+        nodes = {i: RoleNode(i, name, parent_id) for i, name, parent_id in rows}
+        for node in nodes.values():
+            if node.parent_id in nodes:
+                nodes[node.parent_id].children.add(node.id)
+
+        for node in nodes.values():
+            ancestors, parent_id = [], node.parent_id
+            while parent_id in nodes and parent_id != node.id and parent_id not in ancestors:
+                ancestors.append(parent_id)
+                parent_id = nodes[parent_id].parent_id
+            node.ancestors = frozenset(ancestors)
+
+        with self._lock:
+            self._nodes = nodes
+            self._loaded_at = time.monotonic()
+        logger.info(f'role tree loaded, {len(nodes)} roles')
+
+    def clear(self):
+        with self._lock:
+            self._nodes = {}
+            self._loaded_at = None
+
+    def ensure(self, session: Session, role_ids: Iterable[int] = ()):
+        """ 没加载过、太久没加载、或者有数据库里存在但树里没有的role_id时，重新加载 """
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > ROLE_TREE_RELOAD_SECONDS:
+            self.load(session)
+            return
+
+        missing = [i for i in role_ids if i not in self._nodes]
+        if missing and session.query(RoleDB.id).filter(RoleDB.id.in_(missing)).first() is not None:
+            self.load(session)
+
+    def get(self, role_id: int) -> Optional[RoleNode]:
+        return self._nodes.get(role_id)
+
+    def add(self, role_id: int, name: str, parent_id: int):
+        with self._lock:
+            parent = self._nodes.get(parent_id)
+            ancestors = parent.ancestors | {parent_id} if parent else frozenset()
+            self._nodes[role_id] = RoleNode(role_id, name, parent_id, ancestors)
+            if parent:
+                parent.children.add(role_id)
+
+    def rename(self, role_id: int, name: str):
+        node = self._nodes.get(role_id)
+        if node:
+            node.name = name
+
+    def remove(self, role_ids: Iterable[int]):
+        """ 只删除给定的节点，子节点的祖先里去掉被删的节点 """
+        with self._lock:
+            removed = {i for i in role_ids if i in self._nodes}
+            for role_id in removed:
+                node = self._nodes.pop(role_id)
+                parent = self._nodes.get(node.parent_id)
+                if parent:
+                    parent.children.discard(role_id)
+            for node in self._nodes.values():
+                if node.ancestors & removed:
+                    node.ancestors = node.ancestors - removed
+
+    def ancestors(self, role_id: int) -> FrozenSet[int]:
+        node = self._nodes.get(role_id)
+        return node.ancestors if node else frozenset()
+
+    def descendants(self, role_id: int, include_self: bool = True) -> List[int]:
+        if role_id not in self._nodes:
+            return []
+        result, stack = [], [role_id]
+        while stack:
+            i = stack.pop()
+            result.append(i)
+            stack.extend(self._nodes[i].children if i in self._nodes else ())
+        return result if include_self else result[1:]
+
+    def stats(self) -> dict:
+        return {
+            'loaded': self.loaded,
+            'size': len(self._nodes),
+        }
+
+    def is_under(self, role_id: int, ancestor_ids: Iterable[int]) -> bool:
+        """ role_id 是否在 ancestor_ids 中任意一个角色的子树里（包括它自己） """
+        ancestor_ids = ancestor_ids if isinstance(ancestor_ids, (set, frozenset)) else set(ancestor_ids)
+        if role_id in ancestor_ids:
+            return True
+        return not self.ancestors(role_id).isdisjoint(ancestor_ids)
+
+
+role_tree = RoleTree()
+
+
+def load_role_tree():
+    """ 启动时加载，失败了也没关系，第一次用到的时候会再加载 """
+    try:
+        with get_session_local() as session:
+            role_tree.load(session)
+    except Exception as e:
+        logger.warning(f'load role tree fail: {e}')
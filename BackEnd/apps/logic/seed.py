@@ -0,0 +1,225 @@
+import random
+import time
+from logging import getLogger
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from sqlalchemy import func, text
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.schema import Table
+
+from apps.a_common.constants import MANAGE_ROLE_PERMISSION_NAME, MANAGE_ROLE_SUBTREE_PERMISSION_NAME, HealthCodeStatus, Sex, UserIdentity
+from apps.model.form import FormMixin, form_month
+from apps.model.permission import PermissionDB
+from apps.model.permission2role import Permission2RoleDB
+from apps.model.role import RoleDB
+from apps.model.role_closure import RoleClosureDB
+from apps.model.user import UserDB
+from apps.model.user2role import User2RoleDB
+from utils.encode import generate_password_hash
+from utils.time import PER_DAY_SECONDS, PER_HOUR_SECONDS
+
+logger = getLogger(__name__)
+
+"""
+造数据：python manage.py seed --users 100000 --roles-depth 5 --forms 1000000
+- 同一个 seed 生成的数据完全一样（在空库上id也一样），方便在本地对比性能和执行计划
+- 用core的 insert + executemany 分批写入，不经过ORM
+- 所有用户的密码都是同一个，hash只算一次，登录用 --password 给的密码
+- id 从每张表现有的最大id往后排，手机号、角色名都由id得到，所以可以在已有数据上追加，重复跑就是再加一份
+"""
+SEED_BATCH_SIZE = 5000
+SEED_PHONE_BASE = 19000000000  # 用户的手机号是 SEED_PHONE_BASE + 用户id
+SEED_END = 1622476800  # 表单的申请时间在这之前，2021-06-01 00:00 北京时间，固定下来保证可以复现
+FAMILY_NAMES = '王李张刘陈杨黄赵吴周徐孙马朱胡郭何高林罗'
+GIVEN_NAMES = '伟芳娜敏静丽强磊军洋勇艳杰涛明超秀霞平刚桂英华'
+REASONS = ('走亲访友', '送货', '施工', '面试', '参加会议', '办事', '讲座', '探望学生')
+ORG_NAMES = ('x大学党委组织部', 'x大学后勤处', 'x大学计算机学院', '外卖', '快递', '装修公司', '校外培训机构')
+PROVINCE_CODES = ('京', '沪', '浙', '苏', '粤', '川', '鄂', '湘')
+_ID_CARD_WEIGHTS = (7, 9, 10, 5, 8, 4, 2, 1, 6, 3, 7, 9, 10, 5, 8, 4, 2)
+_ID_CARD_CHECKS = '10X98765432'
+
+
+def _name(rng: random.Random) -> str:
+    return rng.choice(FAMILY_NAMES) + ''.join(rng.choice(GIVEN_NAMES) for _ in range(rng.randint(1, 2)))
+
+
+def _id_card(rng: random.Random) -> str:
+    """ 地区码、生日、顺序码都是随机的，校验位是对的 """
+    body = f'{rng.randint(110000, 659999)}{rng.randint(1960, 2003)}{rng.randint(1, 12):02d}{rng.randint(1, 28):02d}{rng.randint(0, 999):03d}'
+    return body + _ID_CARD_CHECKS[sum(int(c) * w for c, w in zip(body, _ID_CARD_WEIGHTS)) % 11]
+
+
+def _next_id(session: Session, table: Table) -> int:
+    return (session.query(func.max(table.c.id)).scalar() or 0) + 1
+
+
+def seed_roles(rng: random.Random, depth: int, fanout: int, start_id: int) -> Tuple[List[dict], List[dict]]:
+    """
+    深度为depth的角色树，每个节点的子节点数在 1 ~ 2*fanout-1 之间（平均fanout），返回 (角色, 闭包表的行)
+    grand_id 的写法和 apps/crud/role.py 的 add_role 一样
+    """
+    roles, closure = [], []
+    level = [(0, '', ())]  # (id, grand_id, 祖先id从根开始)
+    for _ in range(depth):
+        next_level = []
+        for parent_id, parent_grand_id, parent_ancestors in level:
+            count = rng.randint(1, 2 * fanout - 1) if parent_id else fanout
+            for _ in range(count):
+                role_id = start_id + len(roles)
+                grand_id = (f'{parent_grand_id}{parent_id}|' if parent_grand_id else f'|{parent_id}|') if parent_id else ''
+                ancestors = parent_ancestors + (role_id,)
+                roles.append({'id': role_id, 'name': f'seed-role-{role_id}', 'parent_id': parent_id, 'grand_id': grand_id})
+                closure += [{'ancestor_id': a, 'descendant_id': role_id, 'depth': len(ancestors) - 1 - n} for n, a in enumerate(ancestors)]
+                next_level.append((role_id, grand_id, ancestors))
+        level = next_level
+    return roles, closure
+
+
+def seed_permissions(rng: random.Random, roles: List[dict], count: int, start_id: int) -> Tuple[List[dict], List[dict]]:
+    """ 普通的权限加上管理角色的权限，每个角色随机分到几个，返回 (权限, 权限和角色的关系) """
+    names = [f'seed-permission-{start_id + i}' for i in range(count)]
+    for role in roles[:count]:
+        names.append(MANAGE_ROLE_PERMISSION_NAME.format(role_id=role['id']))
+        names.append(MANAGE_ROLE_SUBTREE_PERMISSION_NAME.format(role_id=role['id']))
+    permissions = [{'id': start_id + i, 'name': name} for i, name in enumerate(names)]
+    relations = []
+    for role in roles:
+        for permission in rng.sample(permissions, min(rng.randint(0, 5), len(permissions))):
+            relations.append({'permission_id': permission['id'], 'role_id': role['id']})
+    return permissions, relations
+
+
+def seed_users(rng: random.Random, count: int, start_id: int, password_hash: str, identity: int = UserIdentity.COMMON_USER,
+               now: int = SEED_END) -> Iterator[dict]:
+    for user_id in range(start_id, start_id + count):
+        yield {
+            'id': user_id,
+            'phone': str(SEED_PHONE_BASE + user_id),
+            'password': password_hash,
+            'is_superuser': False,
+            'is_active': True,
+            'name': _name(rng),
+            'sex': rng.choice((Sex.MALE, Sex.FEMALE)),
+            'address': '',
+            'birthday': now - rng.randint(18, 60) * 365 * PER_DAY_SECONDS,
+            'user_identity': identity,
+            'create_at': now - rng.randint(0, 365) * PER_DAY_SECONDS,
+            'update_at': now,
+        }
+
+
+def seed_user2roles(rng: random.Random, user_ids: range, roles: List[dict]) -> Iterator[dict]:
+    """ 每人1~3个角色，其中一个一定是叶子角色，和实际的组织结构差不多 """
+    if not roles:
+        return
+    parent_ids = {r['parent_id'] for r in roles}
+    leaf_ids = [r['id'] for r in roles if r['id'] not in parent_ids]
+    role_ids = [r['id'] for r in roles]
+    for user_id in user_ids:
+        chosen = {rng.choice(leaf_ids)}
+        for _ in range(rng.randint(0, 2)):
+            chosen.add(rng.choice(role_ids))
+        for role_id in sorted(chosen):
+            yield {'user_id': user_id, 'role_id': role_id}
+
+
+def seed_forms(rng: random.Random, count: int, phones: List[str], months: int = 6, end: int = SEED_END) -> Iterator[dict]:
+    """ 申请时间均匀分布在 end 之前的 months 个月里，大约一半是已有用户的手机号，最近的表单有一些还没出校 """
+    start = end - months * 30 * PER_DAY_SECONDS
+    for _ in range(count):
+        in_time_applied = rng.randint(start, end - 1)
+        in_time_real = in_time_applied + rng.randint(-PER_HOUR_SECONDS, PER_HOUR_SECONDS)
+        out_time_real = in_time_real + rng.randint(PER_HOUR_SECONDS // 2, 10 * PER_HOUR_SECONDS)
+        phone = rng.choice(phones) if phones and rng.random() < 0.5 else str(rng.randint(13000000000, 13999999999))
+        yield {
+            'name': _name(rng),
+            'sex': rng.choice((Sex.MALE, Sex.FEMALE)),
+            'phone': phone,
+            'IDCard': _id_card(rng),
+            'org_name': rng.choice(ORG_NAMES),
+            'car_id': f'{rng.choice(PROVINCE_CODES)}{chr(rng.randint(65, 90))}{rng.randint(10000, 99999)}' if rng.random() < 0.3 else '',
+            'reason': rng.choice(REASONS),
+            'guarantor': _name(rng),
+            'guarantor_phone': str(rng.randint(13000000000, 13999999999)),
+            'health_code_status': rng.choices((HealthCodeStatus.GREEN, HealthCodeStatus.YELLOW, HealthCodeStatus.RED), (96, 3, 1))[0],
+            'is_been_epidemic_area_in_two_weeks': rng.random() < 0.02,
+            'is_cough': rng.random() < 0.01,
+            'in_time_applied': in_time_applied,
+            'out_time_applied': in_time_applied + 8 * PER_HOUR_SECONDS,
+            'in_time_real': in_time_real,
+            'out_time_real': None if out_time_real >= end else out_time_real,
+        }
+
+
+def _batches(rows: Iterable[dict], size: int) -> Iterator[List[dict]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def bulk_insert(session: Session, table: Table, rows: Iterable[dict], batch_size: int = SEED_BATCH_SIZE) -> int:
+    """ executemany 分批插入，每批提交一次，返回插入的行数 """
+    total = 0
+    for batch in _batches(rows, batch_size):
+        session.execute(table.insert(), batch)
+        session.commit()
+        total += len(batch)
+    return total
+
+
+def _sync_sequence(session: Session, table: Table):
+    """ 显式写了id，postgresql的自增序列不会跟着走，要手动调到最大id """
+    if session.get_bind().dialect.name == 'postgresql':
+        session.execute(text(f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), (SELECT max(id) FROM \"{table.name}\"))"))
+        session.commit()
+
+
+def seed_database(session: Session, users: int, roles_depth: int, forms: int, seed: int = 0, roles_fanout: int = 3, permissions: int = 50,
+                  password: str = '123456', months: int = 6, batch_size: int = SEED_BATCH_SIZE) -> Dict[str, int]:
+    """ 按顺序生成角色树、权限、用户、用户的角色、表单，返回每张表插入的行数 """
+    rng = random.Random(seed)
+    counts, start = {}, time.perf_counter()
+
+    roles, closure = seed_roles(rng, roles_depth, roles_fanout, _next_id(session, RoleDB.__table__))
+    counts['role'] = bulk_insert(session, RoleDB.__table__, roles, batch_size)
+    counts['role_closure'] = bulk_insert(session, RoleClosureDB.__table__, closure, batch_size)
+
+    permission_rows, relations = seed_permissions(rng, roles, permissions, _next_id(session, PermissionDB.__table__))
+    counts['permission'] = bulk_insert(session, PermissionDB.__table__, permission_rows, batch_size)
+    counts['permission2role'] = bulk_insert(session, Permission2RoleDB.__table__, relations, batch_size)
+
+    user_start = _next_id(session, UserDB.__table__)
+    # seed_user2roles 给每个人都分了角色，和 add_users_to_role 一样，有角色的用户是管理员
+    identity = UserIdentity.ADMIN if roles else UserIdentity.COMMON_USER
+    counts['user'] = bulk_insert(session, UserDB.__table__, seed_users(rng, users, user_start, generate_password_hash(password), identity), batch_size)
+    user_ids = range(user_start, user_start + users)
+    counts['user2role'] = bulk_insert(session, User2RoleDB.__table__, seed_user2roles(rng, user_ids, roles), batch_size)
+    for table in (RoleDB.__table__, PermissionDB.__table__, UserDB.__table__):
+        _sync_sequence(session, table)
+
+    # 表单按月写到各自的分表，每个月攒够一批写一次，内存里最多 月数*batch_size 行
+    phones = [str(SEED_PHONE_BASE + i) for i in user_ids[:10000]]
+    models, buffers = {}, {}
+    
+    def flush(suffix: str):
+        if suffix not in models:
+            models[suffix] = FormMixin.on(session, suffix)
+            session.commit()
+        table = models[suffix].__table__
+        counts[table.name] = counts.get(table.name, 0) + bulk_insert(session, table, buffers.pop(suffix), batch_size)
+    
+    for row in seed_forms(rng, forms, phones, months):
+        suffix = form_month(row['in_time_applied'])
+        buffers.setdefault(suffix, []).append(row)
+        if len(buffers[suffix]) >= batch_size:
+            flush(suffix)
+    for suffix in sorted(buffers):
+        flush(suffix)
+    
+    logger.info(f'seed {counts} in {time.perf_counter() - start:.1f}s')
+    return counts
@@ -1,15 +1,32 @@
-from typing import Optional
+from typing import Iterable, List, Optional
 
 from fastapi import Cookie, Depends, Header
 from sqlalchemy.orm import Session
 
-from apps.a_common.db import get_session
+from apps.a_common.cache import LRUCache
+from apps.a_common.db import get_session, get_session_local
 from apps.a_common.error import PermissionError
+from apps.a_common.job import Job
 from apps.a_common.jwt import decode_token
-from apps.crud.user import get_user_with_permission_and_group_by_id
-from apps.model.user import UserDB
+from apps.a_common.metrics import register_collector
+from apps.a_common.principal import Principal
+from apps.crud.permission import get_role_ids_by_permission_id
+from apps.crud.user import get_principal_by_id, get_user_ids_by_role_ids, update_users_password
+from apps.logic.permission_index import permission_index
+from utils.encode import async_generate_password_hash_batch
 from utils.time import timer
 
+PRINCIPAL_CACHE_SIZE = 4096
+PRINCIPAL_CACHE_TTL = 60
+RESET_PASSWORD_CHUNK_SIZE = 500
+
+""" 已经解析好权限和角色的用户，key为user_id。修改了用户、角色、权限的接口，commit之后要调用下面的invalidate_* """
+principal_cache = LRUCache(maxsize=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL)
+register_collector('principal_cache', principal_cache.stats)
+
+# 每次失效都+1，查库前后不一致说明期间有写入，查到的结果可能已经过期，不能放进缓存
+_generation = 0
+
 
 def get_user_id(token: Optional[str] = Cookie("", alias='user-token', title="用户token", description="推荐通过登录的方式来获得登录凭证（存在cookies中），之后这里就不需要填了"
                                                                                                    "如果想换一个用户（比如换成没权限的用户），可以通过游览器删除token"),
@@ -22,6 +39,47 @@ def get_user_id(token: Optional[str] = Cookie("", alias='user-token', title="用
 
 
 @timer
-def get_user(user_id: int = Depends(get_user_id), session: Session = Depends(get_session)) -> UserDB:
-    user = get_user_with_permission_and_group_by_id(session, user_id)
-    return user
+def get_user(user_id: int = Depends(get_user_id), session: Session = Depends(get_session)) -> Principal:
+    """ 返回的是Principal，需要用户的完整数据时，用 get_user_by_id(session, user.id) """
+    principal = principal_cache.get(user_id)
+    if principal is not None:
+        return principal
+    
+    generation = _generation
+    principal = get_principal_by_id(session, user_id)
+    if principal is not None and generation == _generation:
+        principal_cache.set(user_id, principal)
+    return principal
+
+
+def invalidate_principal(user_ids: Iterable[int]):
+    global _generation
+    _generation += 1
+    principal_cache.pop_many(user_ids)
+
+
+def invalidate_principal_by_role_ids(session: Session, role_ids: Iterable[int]):
+    """ 角色的权限可能变了，角色掩码也要重新加载 """
+    permission_index.expire()
+    invalidate_principal(get_user_ids_by_role_ids(session, role_ids))
+
+
+def invalidate_principal_by_permission_id(session: Session, permission_id: int):
+    invalidate_principal_by_role_ids(session, get_role_ids_by_permission_id(session, permission_id))
+
+
+async def reset_users_password(session: Session, user_ids: List[int], pw: str) -> int:
+    """ 批量重置密码：多进程算hash，一条UPDATE写回，不commit """
+    hash_list = await async_generate_password_hash_batch([pw] * len(user_ids))
+    return update_users_password(session, dict(zip(user_ids, hash_list)))
+
+
+async def reset_users_password_job(job: Job, user_ids: List[int], pw: str):
+    """ 后台任务版本，每一块单独commit，方便查看进度 """
+    for i in range(0, len(user_ids), RESET_PASSWORD_CHUNK_SIZE):
+        chunk = user_ids[i:i + RESET_PASSWORD_CHUNK_SIZE]
+        with get_session_local() as session:
+            await reset_users_password(session, chunk, pw)
+            session.commit()
+        invalidate_principal(chunk)
+        job.advance(len(chunk))
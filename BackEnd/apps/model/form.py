@@ -1,15 +1,21 @@
 from sqlalchemy import Column, Integer, Boolean, VARCHAR, SMALLINT, text
 
-from apps.a_common.db import Base
+from apps.a_common.db import Base, DynamicModelMixin
+from utils.time import to_formatted_time
 
+# 按 in_time_applied 的月份分表，form_202105 这样，旧的 form 表保留，查询时一直带上
+# 对外的id = 月份 * FORM_ID_FACTOR + 分表里的id，旧表的月份当作0，所以旧数据的id不变
+FORM_ID_FACTOR = 10 ** 9
+FORM_MONTH_FORMAT = '%Y%m'
 
-class FormDB(Base):
-    __tablename__ = 'form'
+
+class FormMixin(DynamicModelMixin):
+    __dynamic_prefix__ = 'form'
     
     id = Column(Integer(), primary_key=True)
     name = Column(VARCHAR(126), nullable=False)
     sex = Column(SMALLINT)
-    phone = Column(VARCHAR(126))
+    phone = Column(VARCHAR(126), index=True)
     IDCard = Column(VARCHAR(126))
     org_name = Column(VARCHAR(126))
     car_id = Column(VARCHAR(126))
@@ -21,5 +27,29 @@ class FormDB(Base):
     is_cough = Column(Boolean, server_default=text('False'))
     in_time_applied = Column(Integer)
     out_time_applied = Column(Integer)
-    in_time_real = Column(Integer)
-    out_time_real = Column(Integer)
+    in_time_real = Column(Integer, index=True)
+    out_time_real = Column(Integer, index=True)
+
+
+class FormDB(FormMixin, Base):
+    __tablename__ = 'form'
+
+
+def form_month(t: int) -> str:
+    """ 时间戳所在的月份（北京时间），也就是分表的后缀 """
+    return to_formatted_time(t, FORM_MONTH_FORMAT)
+
+
+def to_form_id(suffix: str, local_id: int) -> int:
+    return int(suffix or 0) * FORM_ID_FACTOR + local_id
+
+
+def from_form_id(form_id: int) -> (str, int):
+    """ 返回 (分表后缀, 分表里的id)，旧表的后缀是空字符串 """
+    month, local_id = divmod(form_id, FORM_ID_FACTOR)
+    return (str(month) if month else ''), local_id
+
+
+def global_form_id(form) -> int:
+    """ 分表的对象上的id是表内的，换成对外的id """
+    return to_form_id(getattr(form, '__dynamic_suffix__', ''), form.id)
@@ -1,10 +1,14 @@
-from sqlalchemy import Column, Integer
+from sqlalchemy import Column, Index, Integer
 
 from apps.a_common.db import Base
 
 
 class Permission2RoleDB(Base):
     __tablename__ = 'permission2role'
+    __table_args__ = (
+        Index('role_id2permission_id_index', 'role_id', 'permission_id'),
+        Index('permission2role_permission_id_index', 'permission_id'),
+    )
     
     id = Column(Integer(), primary_key=True)
     permission_id = Column(Integer, nullable=False)
@@ -0,0 +1,18 @@
+from sqlalchemy import Column, Index, Integer
+
+from apps.a_common.db import Base
+
+
+class RoleClosureDB(Base):
+    """
+    角色树的闭包表，每一对 (祖先, 后代) 一行，包括自己到自己（depth=0）
+    查子树：ancestor_id == x；查祖先：descendant_id == x，都走索引
+    """
+    __tablename__ = 'role_closure'
+    __table_args__ = (
+        Index('role_closure_descendant_id_index', 'descendant_id', 'ancestor_id'),
+    )
+    
+    ancestor_id = Column(Integer, primary_key=True, autoincrement=False)
+    descendant_id = Column(Integer, primary_key=True, autoincrement=False)
+    depth = Column(Integer, nullable=False, server_default='0')
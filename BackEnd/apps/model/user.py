@@ -1,10 +1,9 @@
 from logging import getLogger
-from typing import Set
 
 from sqlalchemy import Boolean, Column, Integer, SMALLINT, text, VARCHAR
 
 from apps.a_common.db import Base
-from utils.encode import generate_password_hash, is_right_password
+from utils.encode import async_generate_password_hash, async_is_right_password, generate_password_hash, is_right_password
 from utils.time import int_timestamp
 
 logger = getLogger(__name__)
@@ -34,35 +33,12 @@ class UserDB(Base):
     def is_right_password(self, pw: str) -> bool:
         return is_right_password(pw, self.password)
     
-    @property
-    def permission_set(self) -> Set[str]:
-        if not hasattr(self, '_permission_set'):
-            self._permission_set = set()
-        return self._permission_set
+    async def async_generate_password_hash(self, pw: str):
+        """ 在进程池里算hash，async的接口里用这个 """
+        self.password = await async_generate_password_hash(pw)
     
-    @permission_set.setter
-    def permission_set(self, s: Set[str]):
-        self._permission_set = s
-    
-    @property
-    def role_set(self) -> Set[str]:
-        if not hasattr(self, '_role_set'):
-            self._role_set = set()
-        return self._role_set
-    
-    @role_set.setter
-    def role_set(self, s: Set[str]):
-        self._role_set = s
-    
-    @property
-    def role_id_set(self) -> Set[str]:
-        if not hasattr(self, '_role_id_set'):
-            self._role_id_set = set()
-        return self._role_id_set
-    
-    @role_id_set.setter
-    def role_id_set(self, s: Set[int]):
-        self._role_id_set = s
+    async def async_is_right_password(self, pw: str) -> bool:
+        return await async_is_right_password(pw, self.password)
 
 
 def __str__(self):
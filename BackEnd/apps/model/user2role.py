@@ -6,7 +6,8 @@ from apps.a_common.db import Base
 class User2RoleDB(Base):
     __tablename__ = 'user2role'
     __table_args__ = (
-        Index('user_id2role_id_index', 'user_id', 'role_id'),
+        Index('user_id2role_id_index', 'user_id', 'role_id', unique=True),
+        Index('user2role_role_id_index', 'role_id'),
     )
     
     id = Column(Integer(), primary_key=True)
@@ -1,9 +1,9 @@
 from typing import List
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 from apps.a_common.constants import SEX_LITERAL, HealthCode_Literal
 from apps.a_common.scheme import PhoneField, IDCardField
-from apps.model.form import FormDB
+from apps.model.form import FormDB, global_form_id
 
 
 class FormSerializer(BaseModel):
@@ -62,6 +62,8 @@ class FormSearchSerializer(BaseModel):
     is_cough: bool = None
     in_time: int = None
     out_time: int = None
+    applied_from: int = Field(None, description="申请入校时间的下限，按月分表，带上可以少查几张表")
+    applied_to: int = Field(None, description="申请入校时间的上限")
     
     class Config:
         orm_mode = True
@@ -74,14 +76,19 @@ class FormSearchSerializer(BaseModel):
                     "is_been_epidemic_area_in_two_weeks": 0,
                     "is_cough": 0,
                     "in_time": 0,
-                    "out_time": 1721497618
+                    "out_time": 1721497618,
+                    "applied_from": 1619798400,
+                    "applied_to": 1622476799
                 }
         }
 
 
 def to_FormDetailSerializer(form: FormDB) -> dict:
     s = FormSerializer.from_orm(form)
-    return s.dict()
+    data = s.dict()
+    # UNION查出来的行已经是对外的id了，没有 __dynamic_suffix__，不会再换一次
+    data['id'] = global_form_id(form)
+    return data
 
 
 def to_UserDetailSerializerList(forms: List[FormDB]) -> List[dict]:
@@ -1,15 +1,21 @@
 import random
 from contextlib import contextmanager
 
+from databases import Database
 from fastapi.testclient import TestClient
 from requests import Response
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.orm import Session, sessionmaker
 from sqlalchemy.schema import MetaData
 
 from apps import app
-from apps.a_common.db import Base, get_session
-from apps.logic.user import get_user, get_user_id
+from apps.a_common.db import Base, bind_sync_engine, get_async_db, get_session
+from apps.a_common.principal import Principal
+from apps.a_common.replica import get_async_read_db, get_read_session
+from apps.logic.permission_index import permission_index
+from apps.logic.role_tree import role_tree
+from apps.logic.user import get_user, get_user_id, principal_cache
+from apps.model.form import FormMixin
 from apps.model.permission import PermissionDB
 from apps.model.permission2role import Permission2RoleDB
 from apps.model.user import UserDB
@@ -18,6 +24,11 @@ from apps.model.role import RoleDB
 from install.test.config import SQL_CONNECT_ARGS, SQL_URL
 from utils.encode import uuid
 
+try:
+    from install.test.config import ASYNC_SQL_URL
+except ImportError:
+    ASYNC_SQL_URL = SQL_URL
+
 """
 测试文件以test_开头
 测试函数以test_开头
@@ -63,6 +74,22 @@ def override_get_session():
 
 
 app.dependency_overrides[get_session] = override_get_session
+# 测试不配副本，读也走测试库
+app.dependency_overrides[get_read_session] = override_get_session
+
+async_database = Database(ASYNC_SQL_URL)
+# 异步接口建分表的时候用测试库的engine
+bind_sync_engine(async_database, engine)
+
+
+async def override_get_async_db() -> Database:
+    if not async_database.is_connected:
+        await async_database.connect()
+    return async_database
+
+
+app.dependency_overrides[get_async_db] = override_get_async_db
+app.dependency_overrides[get_async_read_db] = override_get_async_db
 
 
 @contextmanager
@@ -81,20 +108,21 @@ def get_session_local() -> Session:
 
 
 @contextmanager
-def override_get_user(user=None, is_superuser=False):
+def override_get_user(user=None, is_superuser=False, role_id_set=(), role_set=(), permission_set=()):
     """
     覆盖了对User的依赖，通过直接给定User，可以测试一些需要权限的接口
-    目前只做到，提供一个普通的User
+    会先往数据库里写一个普通的User，再用它的id生成Principal，角色和权限通过参数给定
     example:
-        with override_get_user():
+        with override_get_user(role_id_set={role.id}):
             do_somethings()
     """
     if user is None:
         with get_session_local() as session:
-            user = generate_user()
-            user.is_superuser = is_superuser
-            session.add(user)
+            db_user = generate_user()
+            db_user.is_superuser = is_superuser
+            session.add(db_user)
             session.commit()
+        user = Principal(db_user.id, is_superuser, role_id_set, role_set, permission_set, permission_index.mask_of(permission_set))
     print(user)
     try:
         app.dependency_overrides[get_user] = lambda: user
@@ -145,11 +173,19 @@ def assert_response_success(response: Response):
 
 
 def clean_all():
-    """ 清空所有数据 """
+    """ 清空所有数据，表单的分表直接drop掉 """
     with get_session_local() as session:
+        FormMixin.drop_all(session)
+        session.commit()
+        # 被drop掉的分表还在metadata里，跳过
+        existing = set(inspect(engine).get_table_names())
         for table in reversed(metadata.sorted_tables):
-            session.execute(table.delete())
+            if table.name in existing:
+                session.execute(table.delete())
         session.commit()
+    principal_cache.clear()
+    role_tree.clear()
+    permission_index.expire()
 
 
 def generate_user() -> UserDB:
@@ -157,18 +193,14 @@ def generate_user() -> UserDB:
     return UserDB(name='lyle', password='123', sex=1, phone=str(phone))
 
 
-def generate_manager() -> UserDB:
-    phone = random.randint(17366637010, 17366737010)
-    manager = UserDB(name='admin', password='123', sex=1, phone=str(phone))
-    manager.permission_set = {"manage-organization:1"}
-    return manager
+def generate_manager(user_id: int) -> Principal:
+    """ 权限放在Principal上，user_id 是已经写进数据库的用户 """
+    return generate_manager_with_org(user_id, 1)
 
 
-def generate_manager_with_org(org_id: int) -> UserDB:
-    phone = random.randint(17366637010, 17366737010)
-    manager = UserDB(name='admin', password='123', sex=1, phone=str(phone))
-    manager.permission_set = {f"manage-organization:{org_id}"}
-    return manager
+def generate_manager_with_org(user_id: int, org_id: int) -> Principal:
+    permission_set = {f"manage-organization:{org_id}"}
+    return Principal(user_id, permission_set=permission_set, permission_mask=permission_index.mask_of(permission_set))
 
 
 def generate_role() -> RoleDB:
@@ -0,0 +1,122 @@
+import asyncio
+
+from databases import Database
+
+from apps.a_common.db import CountMode, IdFilterStrategy, Pagination, count_cache, choose_id_filter_strategy, id_filter
+from apps.crud.form import async_add_form, async_delete_form_by_id, async_get_form_by_id, async_update_form_by_phone
+from apps.crud.role import async_get_role_by_user_id, get_role_by_id
+from apps.crud.user import async_get_user_by_id, get_principal_by_id, get_user_by_id, get_user_by_phone_number
+from apps.model.form import global_form_id
+from apps.model.role import RoleDB
+from apps.model.user2role import User2RoleDB
+from apps.model.user import UserDB
+from apps.serializer.form import FormSerializer, FormUpdateSerializer
+from apps.test import ASYNC_SQL_URL, clean_all, generate_role, generate_user, get_session_local
+
+
+def setup_function():
+    """ 这个文件下的每个测试运行之前，都会执行这个函数 """
+    clean_all()
+
+
+def test_id_filter():
+    assert choose_id_filter_strategy('mysql', 1) == IdFilterStrategy.OR
+    assert choose_id_filter_strategy('mysql', 100) == IdFilterStrategy.IN
+    assert choose_id_filter_strategy('mysql', 100000) == IdFilterStrategy.TEMP_TABLE
+    assert choose_id_filter_strategy('sqlite', 1000) == IdFilterStrategy.TEMP_TABLE
+    
+    with get_session_local() as session:
+        users = [generate_user() for i in range(30)]
+        session.add_all(users)
+        session.commit()
+        user_ids = [u.id for u in users[:20]] + [users[0].id, -1]
+        
+        for strategy in (None, IdFilterStrategy.OR, IdFilterStrategy.IN, IdFilterStrategy.TEMP_TABLE):
+            with id_filter(session, UserDB.id, user_ids, strategy=strategy) as condition:
+                assert session.query(UserDB).filter(condition).count() == 20
+        
+        # 临时表里的数据用完就清掉
+        assert session.execute('SELECT count(*) FROM tmp_id_filter').scalar() == 0
+
+
+def test_count_mode():
+    with get_session_local() as session:
+        session.add_all(tuple(generate_role() for i in range(25)))
+        session.commit()
+        query = session.query(RoleDB)
+        
+        paginate = Pagination(query, page_id=1, page_size=10, count_mode=CountMode.CACHED)
+        assert paginate.total == 25 and paginate.count_mode == CountMode.CACHED and paginate.has_more
+        assert not Pagination(query, page_id=3, page_size=10).has_more
+        hits = count_cache.hits
+        assert Pagination(query, page_id=1, page_size=10, count_mode=CountMode.CACHED).total == 25
+        assert count_cache.hits == hits + 1
+        
+        # 写入之后缓存失效
+        session.add(generate_role())
+        session.commit()
+        assert Pagination(query, page_id=1, page_size=10, count_mode=CountMode.CACHED).total == 26
+        # 给了count_key就按key缓存，不编译sql，表的版本还是会带上
+        hits = count_cache.hits
+        assert Pagination(query, page_id=1, page_size=10, count_mode=CountMode.CACHED, count_key='test-roles').total == 26
+        assert Pagination(query, page_id=2, page_size=10, count_mode=CountMode.CACHED, count_key='test-roles').total == 26
+        assert count_cache.hits == hits + 1
+        
+        paginate = Pagination(query, page_id=2, page_size=10, count_mode=CountMode.NONE)
+        assert paginate.total is None and paginate.count_mode == CountMode.NONE
+        assert len(paginate.items) == 10 and paginate.next_page_id == 3
+        paginate = Pagination(query, page_id=3, page_size=10, count_mode=CountMode.NONE)
+        assert len(paginate.items) == 6 and paginate.next_page_id is None
+        
+        # sqlite没有统计信息，退回到精确的count
+        paginate = Pagination(query, page_id=1, page_size=10, count_mode=CountMode.ESTIMATE)
+        assert paginate.total == 26 and paginate.count_mode == CountMode.CACHED
+
+
+def test_async_crud():
+    with get_session_local() as session:
+        user, role = generate_user(), generate_role()
+        session.add_all((user, role))
+        session.commit()
+        session.add(User2RoleDB(user_id=user.id, role_id=role.id))
+        session.commit()
+    
+    async def run():
+        db = Database(ASYNC_SQL_URL)
+        await db.connect()
+        try:
+            assert (await async_get_user_by_id(db, user.id)).phone == user.phone
+            assert await async_get_user_by_id(db, 0) is None
+            assert [r.id for r in await async_get_role_by_user_id(db, user.id)] == [role.id]
+            
+            form = await async_add_form(db, FormSerializer(**FormSerializer.Config.schema_extra['example']))
+            form_id = global_form_id(form)
+            assert form.__tablename__ == 'form_202105'
+            await async_update_form_by_phone(db, FormUpdateSerializer(phone=form.phone))
+            assert (await async_get_form_by_id(db, form_id)).out_time_real != form.out_time_real
+            assert (await async_delete_form_by_id(db, form_id)).id == form.id
+            assert await async_get_form_by_id(db, form_id) is None
+            assert await async_delete_form_by_id(db, form_id) is None
+        finally:
+            await db.disconnect()
+    
+    asyncio.run(run())
+
+
+def test_baked_query():
+    with get_session_local() as session:
+        users, role = [generate_user() for _ in range(2)], generate_role()
+        session.add_all(users + [role])
+        session.commit()
+        session.add(User2RoleDB(user_id=users[0].id, role_id=role.id))
+        session.commit()
+        
+        # 第二次起走的是缓存的sql，参数不能串
+        for user in users:
+            assert get_user_by_id(session, user.id).id == user.id
+            assert get_user_by_phone_number(session, user.phone).id == user.id
+        assert get_user_by_id(session, 0) is None
+        assert get_role_by_id(session, role.id).name == role.name
+        assert get_principal_by_id(session, users[0].id).role_id_set == {role.id}
+        assert get_principal_by_id(session, users[1].id).role_id_set == set()
+        assert get_principal_by_id(session, 0) is None
@@ -0,0 +1,113 @@
+import os
+import tempfile
+
+from apps.a_common.db import keyset_bounds, make_pagination
+from apps.a_common.scheme import PageInfo
+from apps.crud.form import add_form, delete_form_by_id, form_models, form_union_query, get_form_by_id, get_form_by_search, update_form_by_phone
+from apps.logic.form_archive import archive_forms, iter_archived_forms
+from apps.model.form import FORM_ID_FACTOR, FormDB, FormMixin, global_form_id
+from apps.serializer.form import FormSearchSerializer, FormSerializer, FormUpdateSerializer, to_FormDetailSerializer
+from apps.test import clean_all, get_session_local
+
+
+def setup_function():
+    """ 这个文件下的每个测试运行之前，都会执行这个函数 """
+    clean_all()
+
+
+def test_form_partition():
+    example = FormSerializer.Config.schema_extra['example']
+    may = FormSerializer(**example)
+    june = FormSerializer(**dict(example, name='李四', in_time_applied=1623000000))
+    june_first = 1622476800  # 2021-06-01 00:00 北京时间
+    with get_session_local() as session:
+        legacy = FormDB(name='旧表', phone=may.phone, in_time_real=1)
+        session.add(legacy)
+        forms = [add_form(session, may), add_form(session, june)]
+        session.commit()
+        assert [f.__tablename__ for f in forms] == ['form_202105', 'form_202106']
+        assert FormMixin.suffixes(session) == ['202105', '202106']
+        
+        ids = [global_form_id(f) for f in forms]
+        assert ids[0] // FORM_ID_FACTOR == 202105 and global_form_id(legacy) == legacy.id
+        assert to_FormDetailSerializer(forms[1])['id'] == ids[1]
+        assert get_form_by_id(session, ids[1]).name == june.name
+        assert get_form_by_id(session, 202104 * FORM_ID_FACTOR + 1) is None
+        
+        query, form_all = form_union_query(session, form_models(session))
+        assert [r.id for r in query.filter(form_all.c.phone == may.phone).order_by(form_all.c.id)] == [legacy.id] + ids
+        assert [to_FormDetailSerializer(r)['id'] for r in query.filter(form_all.c.id == ids[0])] == [ids[0]]
+        # 只查六月及以后的分表，旧表一直带上
+        assert [suffix for suffix, model in form_models(session, applied_from=june_first)] == ['', '202106']
+        query, form_all = get_form_by_search(session, FormSearchSerializer(applied_from=june_first))
+        assert [r.id for r in query] == [ids[1]]
+        query, form_all = get_form_by_search(session, FormSearchSerializer(name=may.name))
+        assert [r.id for r in query] == [ids[0]]
+        
+        # 游标分页的条件和LIMIT下推到每张表，一页一行翻完和直接查的结果一样，往回翻也一样
+        page_ids, cursors, cursor = [], [], ''
+        while cursor is not None:
+            page_info = PageInfo(page_id=1, page_size=1, cursor=cursor)
+            query, form_all = form_union_query(session, form_models(session), lambda m: [m.phone == may.phone], ('id',), keyset_bounds(page_info, 1))
+            assert str(query.statement).count('LIMIT') == 3
+            paginate = make_pagination(query, page_info, keyset=[form_all.c.id])
+            page_ids += [r.id for r in paginate.items]
+            cursors.append(paginate.prev_cursor)
+            cursor = paginate.next_cursor
+        assert page_ids == [legacy.id] + ids
+        page_info = PageInfo(page_id=1, page_size=1, cursor=cursors[2])
+        query, form_all = form_union_query(session, form_models(session), lambda m: [m.phone == may.phone], ('id',), keyset_bounds(page_info, 1))
+        assert [r.id for r in make_pagination(query, page_info, keyset=[form_all.c.id]).items] == [ids[0]]
+        
+        # 同一个手机号，最早进来的在旧表里
+        update_form_by_phone(session, FormUpdateSerializer(phone=may.phone))
+        session.commit()
+        session.refresh(legacy)
+        assert legacy.out_time_real is not None
+        
+        assert delete_form_by_id(session, ids[0]) is not None
+        session.commit()
+        assert get_form_by_id(session, ids[0]) is None
+        
+        FormMixin.drop(session, '202106')
+        session.commit()
+        assert FormMixin.suffixes(session) == ['202105']
+        assert get_form_by_id(session, ids[1]) is None
+    clean_all()
+
+
+def test_form_archive():
+    example = FormSerializer.Config.schema_extra['example']
+    april = dict(example, in_time_applied=1619000000)  # 2021-04-21
+    may = dict(example, in_time_applied=1621497617)  # 2021-05-20
+    may_late = dict(example, in_time_applied=1622000000)  # 2021-05-26，晚于before
+    with get_session_local() as session:
+        legacy = FormDB(**dict(april, name='旧表'))
+        session.add(legacy)
+        forms = [add_form(session, FormSerializer(**dict(april, name=str(i)))) for i in range(3)]
+        forms += [add_form(session, FormSerializer(**may)), add_form(session, FormSerializer(**may_late))]
+        session.commit()
+        ids = [global_form_id(f) for f in forms]
+        
+        with tempfile.TemporaryDirectory() as path:
+            manifest = archive_forms(session, '2021-05-21', f'{path}/', 'ndjson', batch_size=2, keep=True)
+            assert manifest['tables']['form_202104'] == dict(manifest['tables']['form_202104'], rows=3, action='keep')
+            assert get_form_by_id(session, ids[0]) is not None
+        
+        with tempfile.TemporaryDirectory() as path:
+            path = f'{path}/'
+            manifest = archive_forms(session, '2021-05-21', path, 'csv', batch_size=2, delete_batch_size=1)
+            assert {table: (item['rows'], item['action']) for table, item in manifest['tables'].items()} == {
+                'form': (1, 'delete'), 'form_202104': (3, 'drop'), 'form_202105': (1, 'delete')}
+            assert os.path.exists(f'{path}manifest-{manifest["run_id"]}.json')
+            
+            archived = [*iter_archived_forms('2021-04-01', '2021-04-30', path, phone=example['phone'])]
+            assert sorted(row['id'] for row in archived) == sorted([legacy.id] + ids[:3])
+            assert [row['is_cough'] for row in iter_archived_forms(path=path, id=ids[3])] == [False]
+            assert [*iter_archived_forms('2021-05-21', path=path)] == []
+        
+        assert FormMixin.suffixes(session) == ['202105']
+        assert session.query(FormDB).filter(FormDB.id == legacy.id).first() is None
+        assert get_form_by_id(session, ids[3]) is None
+        assert get_form_by_id(session, ids[4]).name == example['name']
+    clean_all()
@@ -0,0 +1,32 @@
+from apps.a_common.index_audit import audit, capture_statements, filter_columns, find_full_scans, parse_sql_log
+from apps.model.form import FormDB
+from apps.test import clean_all, engine, get_session_local
+
+
+def setup_function():
+    """ 这个文件下的每个测试运行之前，都会执行这个函数 """
+    clean_all()
+
+
+def test_index_audit():
+    log = [
+        '[2021-05-20 10:00:00,000] [sqlalchemy.engine.base.Engine]:[_execute_context]:[INFO] : SELECT form.id \n',
+        'FROM form \n',
+        'WHERE form.name = ? ORDER BY form.in_time_real\n',
+        "[2021-05-20 10:00:00,001] [sqlalchemy.engine.base.Engine]:[_execute_context]:[INFO] : ('a',)\n",
+        '[2021-05-20 10:00:00,002] [sqlalchemy.engine.base.Engine]:[_execute_context]:[INFO] : COMMIT\n',
+    ]
+    assert parse_sql_log(log) == [('SELECT form.id \nFROM form \nWHERE form.name = ? ORDER BY form.in_time_real', ('a',))]
+    assert filter_columns(parse_sql_log(log)[0][0], 'form') == ['name', 'in_time_real']
+    assert find_full_scans('sqlite', [{'detail': 'SCAN TABLE form'}, {'detail': 'SEARCH TABLE user USING INDEX ix_user_phone (phone=?)'}]) == {'form'}
+    assert find_full_scans('mysql', [{'table': 'form', 'type': 'ALL'}, {'table': 'user', 'type': 'ref'}]) == {'form'}
+    
+    with get_session_local() as session:
+        session.add_all([FormDB(name=str(i), phone=str(i)) for i in range(10)])
+        session.commit()
+        with capture_statements() as captured:
+            session.query(FormDB).filter(FormDB.name == '1').all()
+            session.query(FormDB).filter(FormDB.phone == '1').all()
+    
+    report, missing = audit(engine, captured[engine].values())
+    assert ('form', 'name') in missing and ('form', 'phone') not in missing
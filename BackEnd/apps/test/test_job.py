@@ -0,0 +1,30 @@
+import asyncio
+
+from apps.a_common.job import JobStatus, create_job, get_job, run_job
+from apps.test import clean_all
+
+
+def setup_function():
+    """ 这个文件下的每个测试运行之前，都会执行这个函数 """
+    clean_all()
+
+
+def test_job():
+    async def work(job, n):
+        for _ in range(n):
+            job.advance(1)
+    
+    async def fail(job):
+        raise ValueError('boom')
+    
+    job = create_job('test', owner_id=1, total=3)
+    assert get_job(job.id) is job
+    assert job.status == JobStatus.PENDING
+    asyncio.run(run_job(job, work, 3))
+    assert job.to_dict()['done'] == 3
+    assert job.status == JobStatus.SUCCESS
+    
+    job = create_job('test', owner_id=1, total=1)
+    asyncio.run(run_job(job, fail))
+    assert job.status == JobStatus.FAIL
+    assert job.detail == 'boom'
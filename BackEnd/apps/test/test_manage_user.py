@@ -1,4 +1,5 @@
 from apps.a_common.constants import MANAGE_ROLE_PERMISSION_NAME
+from apps.model.user import UserDB
 from apps.test import assert_response_fail, assert_response_success, clean_all, generate_role, generate_user2role, generate_user, get_client, get_session_local, override_get_user
 from apps.view.manage_user import manage_user_prefix
 from config import API_PREFIX
@@ -44,9 +45,7 @@ def test_search_user_search():
         response = client.get(f'{api_prefix}/', params={'role_id': role.id})
         assert_response_fail(response)
     
-    with override_get_user() as user:
-        user.role_set.add(MANAGE_ROLE_PERMISSION_NAME.format(role_id=role.id))
-        user.role_id_set.add(role.id)
+    with override_get_user(role_set={MANAGE_ROLE_PERMISSION_NAME.format(role_id=role.id)}, role_id_set={role.id}):
         response = client.get(f'{api_prefix}/', params={'role_id': role.id})
         data = assert_response_success(response)
         assert len(data) == 10
@@ -76,7 +75,10 @@ def test_manage_reset_password():
         data = assert_response_success(response)
         assert data == {'count': 1}
         
-        response = client.post('/v1/api/users/login', json=dict(phone=user.phone, password='123456789'))
+        # override_get_user 给的是Principal，手机号从数据库里取
+        with get_session_local() as session:
+            phone = session.query(UserDB).get(user.id).phone
+        response = client.post('/v1/api/users/login', json=dict(phone=phone, password='123456789'))
         assert_response_success(response)
 
 
@@ -0,0 +1,69 @@
+import os
+import tempfile
+
+from sqlalchemy import create_engine, exc
+
+from apps.a_common.pool import InstrumentedQueuePool, derive_pool_sizes, pool_stats, watch_engine
+from apps.a_common import sql_trace
+from apps.crud.user import get_user_by_id
+from apps.test import assert_response_fail, assert_response_success, clean_all, get_client, get_session_local, override_get_user
+
+
+def setup_function():
+    """ 这个文件下的每个测试运行之前，都会执行这个函数 """
+    clean_all()
+
+
+def test_sql_pool():
+    # 4个worker分400个连接，每个worker 100个：异步20个，sync 64 + 16
+    assert derive_pool_sizes(400, 4, 20) == (64, 16, 20)
+    assert derive_pool_sizes(40, 4, 20) == (7, 1, 2)
+    assert derive_pool_sizes(1, 8, 20) == (1, 0, 1)
+    
+    with tempfile.TemporaryDirectory() as path:
+        e = create_engine(f'sqlite:///{os.path.join(path, "pool")}.db', poolclass=InstrumentedQueuePool, pool_size=1, max_overflow=0, pool_timeout=0.1)
+        watch_engine('test', e)
+        conn = e.connect()
+        try:
+            e.connect()
+            assert False
+        except exc.TimeoutError:
+            pass
+        stats = pool_stats()['test']
+        assert stats['checked_out'] == 1 and stats['checkouts'] == 1 and stats['timeouts'] == 1
+        conn.close()
+        assert pool_stats()['test']['checked_out'] == 0
+        e.dispose()
+    
+    # 连接池和慢查询带着sql和参数，只有超级管理员能看
+    assert_response_fail(get_client().get('/v1/api/metrics/sql-pool'))
+    with override_get_user():
+        assert_response_fail(get_client().get('/v1/api/metrics/sql-pool'))
+    with override_get_user(is_superuser=True):
+        assert 'test' in assert_response_success(get_client().get('/v1/api/metrics/sql-pool'))
+
+
+def test_sql_trace():
+    assert sql_trace.fingerprint('SELECT a\n  FROM t WHERE id IN (?, ?, ?)') == 'SELECT a FROM t WHERE id IN (?)'
+    assert sql_trace.fingerprint('SELECT a FROM t WHERE id IN (%s,%s)') == 'SELECT a FROM t WHERE id IN (?)'
+    
+    trace = sql_trace.start_request_trace('/test')
+    with get_session_local() as session:
+        for i in range(sql_trace.N_PLUS_ONE_THRESHOLD):
+            get_user_by_id(session, i)
+    assert trace.count == sql_trace.N_PLUS_ONE_THRESHOLD and trace.duration > 0
+    assert len(trace.repeated()) == 1
+    
+    # 阈值改成0，所有的select都算慢查询，sqlite上能拿到EXPLAIN QUERY PLAN
+    slow_query_ms, sql_trace.SQL_SLOW_QUERY_MS = sql_trace.SQL_SLOW_QUERY_MS, 0
+    try:
+        with get_session_local() as session:
+            get_user_by_id(session, 1)
+    finally:
+        sql_trace.SQL_SLOW_QUERY_MS = slow_query_ms
+    slow = sql_trace.slow_queries[-1]
+    assert slow['path'] == '/test' and slow['statement'].startswith('SELECT') and slow['explain']
+    
+    assert_response_fail(get_client().get('/v1/api/metrics/slow-queries'))
+    with override_get_user(is_superuser=True):
+        assert assert_response_success(get_client().get('/v1/api/metrics/slow-queries'))
@@ -1,8 +1,14 @@
+from urllib.parse import parse_qs, urlparse
+
 from fastapi.testclient import TestClient
 
-from apps.a_common.permission import constants_permission_set
+from apps.a_common.constants import MANAGE_ROLE_PERMISSION_NAME, MANAGE_ROLE_SUBTREE_PERMISSION_NAME
+from apps.a_common.permission import MANAGE_USER_ACTION, authorize_manage_user_ids, compile_grants, constants_permission_set, has_permission
+from apps.a_common.principal import Principal
+from apps.crud.user import get_principal_by_id
+from apps.logic.permission_index import permission_index
 from apps.model.permission import PermissionDB
-from apps.test import app, assert_response_success, clean_all, generate_permission, get_client, get_session_local, override_get_user
+from apps.test import app, assert_response_fail, assert_response_success, clean_all, generate_permission, generate_permission2role, generate_role, generate_user, generate_user2role, get_client, get_session_local, override_get_user
 from apps.view.permission import permission_prefix
 from config import API_PREFIX
 from utils.encode import uuid
@@ -47,6 +53,44 @@ def test_permission_list():
         assert len(data) == 5
 
 
+def test_permission_list_by_cursor():
+    with get_session_local() as session:
+        session.add_all(tuple(generate_permission() for i in range(25)))
+        session.commit()
+        all_ids = sorted(p.id for p in session.query(PermissionDB))
+    
+    def get_cursor(url):
+        return parse_qs(urlparse(url).query)['cursor'][0]
+    
+    with override_get_user(is_superuser=True):
+        client = get_client()
+        response = client.get(api_prefix, params=dict(page_size=10, cursor=''))
+        first = response.json()
+        assert [i['id'] for i in first['data']] == all_ids[:10]
+        assert first['previous'] is None and first['count'] is None
+        
+        response = client.get(api_prefix, params=dict(page_size=10, cursor=get_cursor(first['next'])))
+        second = response.json()
+        assert [i['id'] for i in second['data']] == all_ids[10:20]
+        
+        response = client.get(api_prefix, params=dict(page_size=10, cursor=get_cursor(second['next'])))
+        third = response.json()
+        assert [i['id'] for i in third['data']] == all_ids[20:]
+        assert third['next'] is None
+        
+        response = client.get(api_prefix, params=dict(page_size=10, cursor=get_cursor(third['previous'])))
+        data = response.json()
+        assert [i['id'] for i in data['data']] == all_ids[10:20]
+        
+        response = client.get(api_prefix, params=dict(page_size=10, cursor=get_cursor(second['previous'])))
+        data = response.json()
+        assert [i['id'] for i in data['data']] == all_ids[:10]
+        assert data['previous'] is None
+        
+        response = client.get(api_prefix, params=dict(page_size=10, cursor='not a cursor'))
+        assert_response_fail(response)
+
+
 def test_add_permission():
     old = 0
     with get_session_local() as session:
@@ -98,3 +142,100 @@ def test_delete_permission():
 def test_permission_collect():
     with TestClient(app):
         assert len(constants_permission_set) != 0
+
+
+def test_authorize_manage_user_ids():
+    with get_session_local() as session:
+        role1, role2 = generate_role(), generate_role()
+        users = [generate_user() for i in range(4)]
+        session.add_all((role1, role2, *users))
+        session.flush()
+        session.add_all((generate_user2role(users[0].id, role1.id),
+                         generate_user2role(users[1].id, role1.id),
+                         generate_user2role(users[1].id, role2.id),
+                         generate_user2role(users[2].id, role2.id)
+                         ))
+        session.commit()
+        user_ids = [u.id for u in users]
+        not_exist_id = max(user_ids) + 1
+        
+        manager = Principal(-1, permission_set={MANAGE_ROLE_PERMISSION_NAME.format(role_id=role1.id), 'manage-user:abc', 'create-user'})
+        assert compile_grants(manager.permission_set)[MANAGE_USER_ACTION].role_ids == {role1.id}
+        allowed, denied = authorize_manage_user_ids(session, manager, user_ids + [user_ids[0], not_exist_id])
+        assert allowed == user_ids[:2]
+        assert denied == user_ids[2:] + [not_exist_id]
+        
+        allowed, denied = authorize_manage_user_ids(session, Principal(-1), user_ids)
+        assert allowed == [] and denied == user_ids
+        
+        allowed, denied = authorize_manage_user_ids(session, Principal(-1, is_superuser=True), user_ids + [not_exist_id])
+        assert allowed == user_ids
+        assert denied == [not_exist_id]
+
+
+def test_authorize_manage_user_ids_by_subtree():
+    with get_session_local() as session:
+        root, other = generate_role(), generate_role()
+        session.add_all((root, other))
+        session.flush()
+        child = generate_role()
+        child.parent_id = root.id
+        session.add(child)
+        session.flush()
+        grandchild = generate_role()
+        grandchild.parent_id = child.id
+        users = [generate_user() for i in range(3)]
+        session.add_all((grandchild, *users))
+        session.flush()
+        session.add_all((generate_user2role(users[0].id, child.id),
+                         generate_user2role(users[1].id, grandchild.id),
+                         generate_user2role(users[2].id, other.id)
+                         ))
+        session.commit()
+        user_ids = [u.id for u in users]
+        
+        # 一条权限管理整棵子树，不需要每个角色一条
+        manager = Principal(-1, permission_set={MANAGE_ROLE_SUBTREE_PERMISSION_NAME.format(role_id=root.id)})
+        grant = compile_grants(manager.permission_set)[MANAGE_USER_ACTION]
+        assert grant.subtree_role_ids == {root.id}
+        allowed, denied = authorize_manage_user_ids(session, manager, user_ids)
+        assert allowed == user_ids[:2]
+        assert denied == user_ids[2:]
+        
+        manager = Principal(-1, permission_set={MANAGE_ROLE_SUBTREE_PERMISSION_NAME.format(role_id=grandchild.id)})
+        allowed, denied = authorize_manage_user_ids(session, manager, user_ids)
+        assert allowed == [user_ids[1]]
+        
+        manager = Principal(-1, permission_set={'manage-user:*'})
+        allowed, denied = authorize_manage_user_ids(session, manager, user_ids)
+        assert allowed == user_ids and denied == []
+
+
+def test_permission_index():
+    with get_session_local() as session:
+        role1, role2 = generate_role(), generate_role()
+        permission1, permission2, permission3 = generate_permission(), generate_permission(), generate_permission()
+        user = generate_user()
+        session.add_all((role1, role2, permission1, permission2, permission3, user))
+        session.flush()
+        session.add_all((generate_user2role(user.id, role1.id),
+                         generate_user2role(user.id, role2.id),
+                         generate_permission2role(permission1.id, role1.id),
+                         generate_permission2role(permission2.id, role2.id)
+                         ))
+        session.commit()
+        
+        principal = get_principal_by_id(session, user.id)
+        assert principal.permission_mask == permission_index.mask_of([permission1.name, permission2.name])
+        assert principal.permission_set == {permission1.name, permission2.name}
+        assert has_permission(principal, permission1.name)
+        assert not has_permission(principal, permission3.name)
+        assert not has_permission(principal, uuid())
+        assert has_permission(Principal(-1, is_superuser=True), uuid())
+        
+        # 比特位只增不减，重新加载后不会变
+        bit = permission_index.bit(permission1.name)
+        permission_index.expire()
+        permission_index.ensure(session)
+        assert permission_index.bit(permission1.name) == bit
+        assert permission_index.names_of(principal.permission_mask) == {permission1.name, permission2.name}
@@ -0,0 +1,43 @@
+import os
+import tempfile
+
+from sqlalchemy import create_engine
+
+from apps.a_common.replica import Replica, ReplicaSet, RoutingSession
+from apps.model.role import RoleDB
+from apps.test import clean_all, engine, metadata, generate_role
+
+
+def setup_function():
+    """ 这个文件下的每个测试运行之前，都会执行这个函数 """
+    clean_all()
+
+
+def test_replica_routing():
+    with tempfile.TemporaryDirectory() as path:
+        engines = [create_engine(f'sqlite:///{os.path.join(path, name)}.db') for name in 'ab']
+        for e in engines:
+            metadata.create_all(bind=e)
+        a, b = Replica(engines[0], weight=2), Replica(engines[1], weight=1)
+        replica_set = ReplicaSet([a, b])
+        assert [replica_set.choose() for _ in range(6)] == [a, b, a, a, b, a]
+        
+        # 出错的副本被摘掉，全摘掉了就返回None，读主库
+        replica_set.eject(a)
+        assert {replica_set.choose() for _ in range(3)} == {b}
+        replica_set.eject(b)
+        assert replica_set.choose() is None
+        
+        engines[0].execute(RoleDB.__table__.insert().values(name='only-in-replica'))
+        session = RoutingSession(replica=a, bind=engine, autoflush=False, expire_on_commit=False)
+        try:
+            assert session.query(RoleDB).filter(RoleDB.name == 'only-in-replica').count() == 1
+            # 写了之后，同一个session的读都走主库
+            session.add(generate_role())
+            session.commit()
+            assert session.use_primary
+            assert session.query(RoleDB).filter(RoleDB.name == 'only-in-replica').count() == 0
+        finally:
+            session.close()
+            for e in engines:
+                e.dispose()
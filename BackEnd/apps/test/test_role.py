@@ -1,10 +1,13 @@
 from apps.a_common.constants import UserIdentity
 from apps.a_common.scheme import PageInfo
-from apps.crud.role import get_users_by_role_id
+from apps.crud.role import get_role_subtree_ids, get_users_by_role_id
+from apps.logic.role_tree import role_tree
+from apps.model.permission2role import Permission2RoleDB
+from apps.model.role_closure import RoleClosureDB
 from apps.model.user import UserDB
 from apps.model.user2role import User2RoleDB
 from apps.model.role import RoleDB
-from apps.test import assert_response_fail, assert_response_success, clean_all, generate_user, generate_user2role, generate_role, get_client, get_session_local, override_get_user
+from apps.test import assert_response_fail, assert_response_success, clean_all, generate_permission, generate_permission2role, generate_user, generate_user2role, generate_role, get_client, get_session_local, override_get_user
 from apps.view.role import role_prefix
 from config import API_PREFIX
 from utils.encode import uuid
@@ -84,28 +87,19 @@ def test_role_list_by_user_group():
         response = client.post(api_prefix, json=dict(name=uuid(), parent_id=g3['id']))
         g4 = assert_response_success(response)
     
-    with override_get_user() as user:
-        user.role_id_set.add(g2['id'])
-        user.role_set.add(g2['name'])
-        
+    with override_get_user(role_id_set={g2['id']}, role_set={g2['name']}):
         client = get_client()
         response = client.get(api_prefix)
         data = assert_response_success(response)
         assert len(data) == 1
     
-    with override_get_user() as user:
-        user.role_id_set.add(g3['id'])
-        user.role_set.add(g3['name'])
-        
+    with override_get_user(role_id_set={g3['id']}, role_set={g3['name']}):
         client = get_client()
         response = client.get(api_prefix)
         data = assert_response_success(response)
         assert len(data) == 2
     
-    with override_get_user() as user:
-        user.role_id_set.add(g1['id'])
-        user.role_set.add(g1['name'])
-        
+    with override_get_user(role_id_set={g1['id']}, role_set={g1['name']}):
         client = get_client()
         response = client.get(api_prefix)
         data = assert_response_success(response)
@@ -137,6 +131,103 @@ def test_add_role():
         assert session.query(RoleDB).count() == 4
 
 
+def test_role_closure():
+    with override_get_user(is_superuser=True):
+        client = get_client()
+        role_ids = []
+        parent_id = 0
+        for i in range(30):
+            response = client.post(api_prefix, json=dict(name=uuid(), parent_id=parent_id))
+            parent_id = assert_response_success(response)['id']
+            role_ids.append(parent_id)
+        response = client.post(api_prefix, json=dict(name=uuid()))
+        other_id = assert_response_success(response)['id']
+    
+    with get_session_local() as session:
+        # 闭包表和角色树要一致，子树的判断走角色树，闭包表给删除子树和角色列表用
+        descendants = session.query(RoleClosureDB).filter(RoleClosureDB.ancestor_id == role_ids[0])
+        assert {(r.descendant_id, r.depth) for r in descendants} == {(i, n) for n, i in enumerate(role_ids)}
+        assert get_role_subtree_ids(session, role_ids[0]) == role_ids[::-1]
+        assert get_role_subtree_ids(session, other_id) == [other_id]
+        role_tree.ensure(session, role_ids + [other_id])
+        assert set(role_tree.descendants(role_ids[0])) == set(role_ids)
+        assert role_ids[0] in role_tree.ancestors(role_ids[-1]) and role_ids[0] not in role_tree.ancestors(other_id)
+    
+    with override_get_user(role_id_set={role_ids[0]}):
+        response = get_client().get(f'{api_prefix}/{role_ids[-1]}/users')
+        assert_response_success(response)
+    
+    with override_get_user(role_id_set={other_id}):
+        response = get_client().get(f'{api_prefix}/{role_ids[-1]}/users')
+        assert_response_fail(response)
+
+
+def test_role_tree():
+    with override_get_user(is_superuser=True):
+        client = get_client()
+        response = client.post(api_prefix, json=dict(name=uuid()))
+        g1 = assert_response_success(response)
+        response = client.post(api_prefix, json=dict(name=uuid(), parent_id=g1['id']))
+        g2 = assert_response_success(response)
+        response = client.post(api_prefix, json=dict(name=uuid(), parent_id=g2['id']))
+        g3 = assert_response_success(response)
+        
+        # 接口commit之后树是增量更新的
+        assert role_tree.ancestors(g3['id']) == {g1['id'], g2['id']}
+        assert set(role_tree.descendants(g1['id'])) == {g1['id'], g2['id'], g3['id']}
+        assert role_tree.get(g1['id']).children == {g2['id']}
+        assert role_tree.is_under(g3['id'], {g1['id']})
+        assert not role_tree.is_under(g1['id'], {g3['id']})
+        
+        name = uuid()
+        response = client.put(f'{api_prefix}/{g2["id"]}', json=dict(name=name))
+        assert_response_success(response)
+        assert role_tree.get(g2['id']).name == name
+        
+        # 删除角色会连同子树一起删掉，g3 也没了
+        response = client.delete(f'{api_prefix}/{g2["id"]}')
+        assert_response_success(response)
+        assert role_tree.get(g2['id']) is None
+        assert role_tree.get(g3['id']) is None
+        assert role_tree.get(g1['id']).children == set()
+        assert set(role_tree.descendants(g1['id'])) == {g1['id']}
+        with get_session_local() as session:
+            assert session.query(RoleDB).filter(RoleDB.id.in_((g2['id'], g3['id']))).count() == 0
+    
+    # 直接写数据库的角色，树里没有，用到的时候会重新加载
+    with get_session_local() as session:
+        role = generate_role()
+        role.parent_id = g1['id']
+        session.add(role)
+        session.commit()
+        role_tree.ensure(session, [role.id])
+        assert role_tree.ancestors(role.id) == {g1['id']}
+    
+    with override_get_user(role_id_set={g1['id']}):
+        response = get_client().get(f'{api_prefix}/{role.id}/users')
+        assert_response_success(response)
+
+
+
+def test_write_to_role_deleted_by_other_worker():
+    with get_session_local() as session:
+        role = generate_role()
+        user = generate_user()
+        session.add_all((role, user))
+        session.commit()
+        role_tree.ensure(session, [role.id])
+        assert role_tree.get(role.id) is not None
+        # 别的worker删掉了角色，这个进程的树还不知道
+        session.query(RoleDB).filter(RoleDB.id == role.id).delete(False)
+        session.commit()
+    
+    with override_get_user(is_superuser=True):
+        response = get_client().post(f'{api_prefix}/{role.id}/users:add', json=[user.id])
+        assert_response_fail(response)
+    assert role_tree.get(role.id) is None
+    with get_session_local() as session:
+        assert session.query(User2RoleDB).filter(User2RoleDB.role_id == role.id).count() == 0
+
 def test_role_user_list():
     with override_get_user(is_superuser=True):
         client = get_client()
@@ -155,14 +246,11 @@ def test_role_user_list():
         session.flush()
         session.add_all((generate_user2role(user11.id, g1['id']),
                          generate_user2role(user12.id, g1['id']),
-                         generate_user2role(user2.id, g2['id']),
                          generate_user2role(user2.id, g2['id'])
                          ))
         session.commit()
         
-        with override_get_user() as user:
-            user.role_id_set.add(g1['id'])
-            user.role_set.add(g1['name'])
+        with override_get_user(role_id_set={g1['id']}, role_set={g1['name']}):
             client = get_client()
             response = client.get(f'{api_prefix}/{g1["id"]}/users')
             data = assert_response_success(response)
@@ -219,6 +307,53 @@ def test_del_role():
             assert r.role_id == role2.id
 
 
+def test_del_role_recursive():
+    with override_get_user(is_superuser=True):
+        client = get_client()
+        response = client.post(api_prefix, json=dict(name=uuid()))
+        g1 = assert_response_success(response)
+        response = client.post(api_prefix, json=dict(name=uuid(), parent_id=g1['id']))
+        g2 = assert_response_success(response)
+        response = client.post(api_prefix, json=dict(name=uuid(), parent_id=g2['id']))
+        g3 = assert_response_success(response)
+        response = client.post(api_prefix, json=dict(name=uuid()))
+        other = assert_response_success(response)
+    
+    with get_session_local() as session:
+        user1 = generate_user()
+        user2 = generate_user()
+        user1.user_identity = user2.user_identity = UserIdentity.ADMIN
+        permission = generate_permission()
+        session.add_all((user1, user2, permission))
+        session.flush()
+        session.add_all((generate_user2role(user1.id, g3['id']),
+                         generate_user2role(user2.id, g2['id']),
+                         generate_user2role(user2.id, other['id']),
+                         generate_permission2role(permission.id, g2['id']),
+                         generate_permission2role(permission.id, other['id'])
+                         ))
+        session.commit()
+        
+        with override_get_user(is_superuser=True):
+            response = get_client().delete(f'{api_prefix}/{g1["id"]}')
+            data = assert_response_success(response)
+            assert data['count'] == 3
+            assert 'job_id' not in data
+        
+        role_ids = {g1['id'], g2['id'], g3['id']}
+        assert session.query(RoleDB).filter(RoleDB.id.in_(role_ids)).count() == 0
+        assert session.query(User2RoleDB).filter(User2RoleDB.role_id.in_(role_ids)).count() == 0
+        assert session.query(Permission2RoleDB).filter(Permission2RoleDB.role_id.in_(role_ids)).count() == 0
+        assert session.query(RoleClosureDB).filter(RoleClosureDB.descendant_id.in_(role_ids)).count() == 0
+        assert session.query(Permission2RoleDB).filter(Permission2RoleDB.role_id == other['id']).count() == 1
+        assert role_tree.get(g3['id']) is None
+        
+        # user1没有角色了，取消管理员身份，user2还有other
+        session.expire_all()
+        assert session.query(UserDB).get(user1.id).user_identity & UserIdentity.ADMIN == 0
+        assert session.query(UserDB).get(user2.id).user_identity & UserIdentity.ADMIN == UserIdentity.ADMIN
+
+
 def test_add_user_to_role_by_superuser():
     with get_session_local() as session:
         user1 = generate_user()
@@ -232,16 +367,26 @@ def test_add_user_to_role_by_superuser():
     with override_get_user(is_superuser=True):
         client = get_client()
         response = client.post(f'{api_prefix}/{role1.id}/users:add', json=[user1.id, user2.id])
-        assert_response_success(response)
+        data = assert_response_success(response)
+        assert data == {'added': 2, 'present': 0}
         response = client.get(f'{api_prefix}/{role1.id}/users')
         data = assert_response_success(response)
         assert len(data) == 2
         
-        response = client.post(f'{api_prefix}/{role1.id}/users:add', json=[user2.id, user3.id])
-        assert_response_success(response)
+        response = client.post(f'{api_prefix}/{role1.id}/users:add', json=[user2.id, user3.id, user3.id])
+        data = assert_response_success(response)
+        assert data == {'added': 1, 'present': 1}
         response = client.get(f'{api_prefix}/{role1.id}/users')
         data = assert_response_success(response)
         assert len(data) == 3
+        
+        # 重复添加不会产生重复的关联
+        response = client.post(f'{api_prefix}/{role1.id}/users:add', json=[user1.id, user2.id, user3.id])
+        data = assert_response_success(response)
+        assert data == {'added': 0, 'present': 3}
+    
+    with get_session_local() as session:
+        assert session.query(User2RoleDB).filter(User2RoleDB.role_id == role1.id).count() == 3
 
 
 def test_del_user_to_role():
@@ -254,7 +399,6 @@ def test_del_user_to_role():
         session.add_all((user1, user2, user3, role1, role2))
         session.flush()
         session.add_all((generate_user2role(user1.id, role1.id),
-                         generate_user2role(user1.id, role1.id),
                          generate_user2role(user2.id, role1.id),
                          generate_user2role(user2.id, role2.id),
                          generate_user2role(user3.id, role2.id)
@@ -0,0 +1,40 @@
+import random
+
+from apps.a_common.constants import UserIdentity
+from apps.crud.form import form_models, form_union_query
+from apps.crud.user import get_principal_by_id
+from apps.logic.seed import seed_database, seed_roles
+from apps.model.role_closure import RoleClosureDB
+from apps.model.user import UserDB
+from apps.test import clean_all, get_session_local
+
+
+def setup_function():
+    """ 这个文件下的每个测试运行之前，都会执行这个函数 """
+    clean_all()
+
+
+def test_seed():
+    roles, closure = seed_roles(random.Random(1), 3, 2, 1)
+    assert (roles, closure) == seed_roles(random.Random(1), 3, 2, 1)
+    assert [r['parent_id'] for r in roles[:2]] == [0, 0]
+    # 每个角色在闭包表里的行数 = 自己 + 祖先的个数
+    assert len(closure) == sum(len(r['grand_id'].split('|')) - 1 if r['grand_id'] else 1 for r in roles)
+    
+    snapshots = []
+    for _ in range(2):
+        clean_all()
+        with get_session_local() as session:
+            counts = seed_database(session, users=20, roles_depth=3, forms=50, seed=1, roles_fanout=2, password='pw', batch_size=7)
+            assert counts['user'] == session.query(UserDB).count() == 20
+            assert counts['role_closure'] == session.query(RoleClosureDB).count()
+            assert sum(v for k, v in counts.items() if k.startswith('form_')) == 50
+            
+            user = session.query(UserDB).order_by(UserDB.id).first()
+            assert user.is_right_password('pw')
+            assert get_principal_by_id(session, user.id).role_id_set
+            assert session.query(UserDB).filter(UserDB.user_identity != UserIdentity.ADMIN).count() == 0
+            query, form_all = form_union_query(session, form_models(session))
+            snapshots.append(([(u.phone, u.name) for u in session.query(UserDB).order_by(UserDB.id)], sorted(r.IDCard for r in query)))
+    assert snapshots[0] == snapshots[1]
+    clean_all()
@@ -1,7 +1,12 @@
-from apps.crud.user import get_user_with_permission_and_group_by_id
+import pytest
+
+from apps.a_common.principal import Principal
+from apps.crud.user import get_principal_by_id
+from apps.logic.user import get_user, invalidate_principal_by_role_ids, principal_cache
 from apps.model.user import UserDB
 from apps.test import assert_response_fail, assert_response_success, clean_all, generate_permission, generate_permission2role, generate_user, generate_user2role, generate_role, get_client, get_session_local
 from apps.view.user import user_prefix
+from utils.encode import METHOD_NAME, hash_password
 from config import API_PREFIX
 
 api_prefix = f"{API_PREFIX}/{user_prefix}"
@@ -83,6 +88,20 @@ def test_login():
             assert_response_fail(response)
 
 
+def test_login_rehash_old_password():
+    with get_session_local() as session:
+        user = generate_user()
+        user.password = 'pbkdf2:sha256:1000$abcdefgh$' + hash_password(b'123123', b'abcdefgh', 1000)
+        session.add(user)
+        session.commit()
+    
+    response = get_client().post(f"{api_prefix}/login", json=dict(phone=user.phone, password='123123'))
+    assert_response_success(response)
+    with get_session_local() as session:
+        password = session.query(UserDB.password).filter(UserDB.id == user.id).scalar()
+        assert password.startswith(f'{METHOD_NAME}$')
+
+
 def test_read_me():
     client = get_client()
     response = client.post(f"{api_prefix}/register", json=right_user_data)
@@ -95,7 +114,7 @@ def test_read_me():
     assert user_data['phone'] == right_user_data['phone']
 
 
-def test_get_user_with_permission_and_group_by_id():
+def test_get_principal_by_id():
     with get_session_local() as session:
         # simple
         user = generate_user()
@@ -112,10 +131,10 @@ def test_get_user_with_permission_and_group_by_id():
         ))
         session.commit()
         
-        user = get_user_with_permission_and_group_by_id(session, user.id)
-        assert user is not None
-        assert user.permission_set == {permission1.name, permission2.name}
-        assert user.role_set == {role.name}
+        principal = get_principal_by_id(session, user.id)
+        assert principal is not None
+        assert principal.permission_set == {permission1.name, permission2.name}
+        assert principal.role_set == {role.name}
     
     clean_all()
     with get_session_local() as session:
@@ -138,10 +157,10 @@ def test_get_user_with_permission_and_group_by_id():
         ))
         session.commit()
         
-        user = get_user_with_permission_and_group_by_id(session, user.id)
-        assert user is not None
-        assert user.permission_set == {permission1.name, permission2.name, permission3.name}
-        assert user.role_set == {role1.name, role2.name}
+        principal = get_principal_by_id(session, user.id)
+        assert principal is not None
+        assert principal.permission_set == {permission1.name, permission2.name, permission3.name}
+        assert principal.role_set == {role1.name, role2.name}
     
     clean_all()
     with get_session_local() as session:
@@ -158,10 +177,10 @@ def test_get_user_with_permission_and_group_by_id():
         ))
         session.commit()
         
-        user = get_user_with_permission_and_group_by_id(session, user.id)
-        assert user is not None
-        assert len(user.permission_set) == 0
-        assert user.role_set == {role1.name, role2.name}
+        principal = get_principal_by_id(session, user.id)
+        assert principal is not None
+        assert len(principal.permission_set) == 0
+        assert principal.role_set == {role1.name, role2.name}
     
     clean_all()
     with get_session_local() as session:
@@ -170,7 +189,45 @@ def test_get_user_with_permission_and_group_by_id():
         session.add(user)
         session.commit()
         
-        user = get_user_with_permission_and_group_by_id(session, user.id)
-        assert user is not None
-        assert len(user.permission_set) == 0
-        assert len(user.role_set) == 0
+        principal = get_principal_by_id(session, user.id)
+        assert principal is not None
+        assert len(principal.permission_set) == 0
+        assert len(principal.role_set) == 0
+
+
+def test_get_user_cache():
+    with get_session_local() as session:
+        user = generate_user()
+        role = generate_role()
+        permission1 = generate_permission()
+        permission2 = generate_permission()
+        session.add_all((user, role, permission1, permission2))
+        session.flush()
+        session.add_all((generate_user2role(user.id, role.id), generate_permission2role(permission1.id, role.id)))
+        session.commit()
+        user_id, role_id = user.id, role.id
+    
+    with get_session_local() as session:
+        assert get_user(user_id, session).permission_set == {permission1.name}
+    
+    with get_session_local() as session:
+        session.add(generate_permission2role(permission2.id, role_id))
+        session.commit()
+        hits = principal_cache.hits
+        assert get_user(user_id, session).permission_set == {permission1.name}
+        assert principal_cache.hits == hits + 1
+        
+        invalidate_principal_by_role_ids(session, [role_id])
+        cached_user = get_user(user_id, session)
+        assert cached_user.permission_set == {permission1.name, permission2.name}
+        assert cached_user.role_id_set == {role_id}
+
+
+def test_principal_immutable():
+    principal = Principal(1, False, {1, 2}, {'a'}, {'p'})
+    assert principal == Principal(1, False, [2, 1], ['a'], ['p'])
+    assert hash(principal) == hash(Principal(1, False, [2, 1], ['a'], ['p']))
+    with pytest.raises(AttributeError):
+        principal.is_superuser = True
+    with pytest.raises(AttributeError):
+        principal.role_id_set.add(3)
@@ -1,10 +1,13 @@
+import asyncio
+
+from apps.a_common.cache import LRUCache
 from apps.a_common.constants import SEX_CHOICE, SEX_MAP
 from apps.a_common.db import Pagination
-from apps.a_common.jwt import decode_token, encode_token
+from apps.a_common.jwt import bad_token_cache, decode_token, encode_token, verified_token_cache
 from apps.a_common.storage import get_filename_without_uuid_prefix, temp_file_name
 from apps.model.role import RoleDB
 from apps.test import clean_all, generate_role, get_client, get_session_local
-from utils.encode import generate_password_hash, is_right_password
+from utils.encode import async_generate_password_hash, async_is_right_password, generate_password_hash, hash_password, hash_pool_stats, is_right_password, password_need_rehash
 
 
 def setup_function():
@@ -26,6 +29,26 @@ def test_password_hash():
         assert is_right_password(pw, hpw)
 
 
+def test_password_hash_with_old_method():
+    old_hpw = 'pbkdf2:sha256:1000$abcdefgh$' + hash_password(b'123123', b'abcdefgh', 1000)
+    assert is_right_password('123123', old_hpw)
+    assert not is_right_password('321321', old_hpw)
+    assert password_need_rehash(old_hpw)
+    assert not password_need_rehash(generate_password_hash('123123'))
+    assert not is_right_password('123123', 'md5:1000$abcdefgh$' + hash_password(b'123123', b'abcdefgh', 1000))
+
+
+def test_async_password_hash():
+    async def run():
+        hpw = await async_generate_password_hash('123123')
+        return await async_is_right_password('123123', hpw), await async_is_right_password('321321', hpw)
+    
+    completed = hash_pool_stats()['completed']
+    assert asyncio.run(run()) == (True, False)
+    assert hash_pool_stats()['completed'] == completed + 3
+    assert hash_pool_stats()['pending'] == 0
+
+
 def test_constants_to_map():
     assert type(SEX_CHOICE) == tuple
     assert type(SEX_MAP) == dict
@@ -62,6 +85,20 @@ def test_jwt():
         assert er == data
 
 
+def test_jwt_cache():
+    token = encode_token(12345)
+    assert decode_token(token) == (12345, True)
+    hits = verified_token_cache.hits
+    assert decode_token(token.decode()) == (12345, True)
+    assert verified_token_cache.hits == hits + 1
+    
+    bad_token = token[:-2] + b'xx'
+    assert decode_token(bad_token) == ({}, False)
+    hits = bad_token_cache.hits
+    assert decode_token(bad_token) == ({}, False)
+    assert bad_token_cache.hits == hits + 1
+
+
 def test_pagination():
     with get_session_local() as session:
         # session = TestingSessionLocal()
@@ -87,3 +124,20 @@ def test_get_filename_without_uuid_prefix():
     temp_name = temp_file_name(raw_name)
     temp_name_with_path = f'temp/{temp_name}'
     assert raw_name == get_filename_without_uuid_prefix(temp_name_with_path)
+
+
+def test_lru_cache():
+    now = [0]
+    cache = LRUCache(maxsize=2, ttl=10, clock=lambda: now[0])
+    cache.set(1, 'a')
+    cache.set(2, 'b')
+    assert cache.get(1) == 'a'
+    cache.set(3, 'c')  # 2最久没用，被淘汰
+    assert cache.get(2) is None
+    assert cache.get(3) == 'c'
+    
+    now[0] = 11
+    assert cache.get(1) is None
+    assert cache.stats()['hits'] == 2
+    assert cache.stats()['misses'] == 2
+    assert cache.stats()['evictions'] == 1
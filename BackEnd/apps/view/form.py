@@ -1,57 +1,70 @@
 from logging import getLogger
 
-from fastapi import APIRouter, Depends, Request
+from databases import Database
+from fastapi import APIRouter, Depends, Query, Request
 from sqlalchemy.orm import Session
 
-from apps.a_common.db import get_session, Pagination
-from apps.a_common.response import make_paginate_info, success_response
+from apps.a_common.db import CountMode, get_async_db, keyset_bounds, make_pagination
+from apps.a_common.error import NotFound
+from apps.a_common.principal import Principal
+from apps.a_common.replica import get_read_session
+from apps.a_common.response import error_response, make_paginate_info, success_response
 from apps.a_common.scheme import PageInfo, PageInfo_
 
-from apps.crud.form import add_form, get_form_by_search, update_form_by_phone, delete_form_by_id
+from apps.crud.form import async_add_form, async_delete_form_by_id, async_update_form_by_phone, form_models, form_union_query, get_form_by_search
 from apps.logic.user import get_user
-from apps.model.user import UserDB
-from apps.model.form import FormDB
 from apps.serializer.form import FormSerializer, FormSearchSerializer, FormUpdateSerializer, to_FormDetailSerializer, to_UserDetailSerializerList
 
 form_router = APIRouter()
 form_prefix = 'form'
 logger = getLogger(__name__)
 
+# 游标分页可以用的排序方式，最后一列要唯一，是分表 UNION ALL 之后子查询 form_all 的列名
+FORM_KEYSETS = {
+    'id': ('id',),
+    'in_time_real': ('in_time_real', 'id'),
+}
+
 
 @form_router.post("", summary="创建表单")
-async def create_form(form_data: FormSerializer, session: Session = Depends(get_session)):
-    form = add_form(session=session, form_data=form_data)
-    session.commit()
+async def create_form(form_data: FormSerializer, db: Database = Depends(get_async_db)):
+    form = await async_add_form(db, form_data)
     return success_response(to_FormDetailSerializer(form))
 
 
 @form_router.post("/out_time", summary="修改表单入校时间")
-async def create_form(data: FormUpdateSerializer, session: Session = Depends(get_session)):
-    update_form_by_phone(session=session, data=data)
-    session.commit()
+async def create_form(data: FormUpdateSerializer, db: Database = Depends(get_async_db)):
+    await async_update_form_by_phone(db, data)
     return success_response()
 
 
 @form_router.get("", summary="管理员查看全部表单")
-async def get_all_form(request: Request, page_info: PageInfo = Depends(PageInfo_), manager: UserDB = Depends(get_user), session: Session = Depends(get_session)):
-    query = session.query(FormDB)
-    paginate = Pagination(query, page_info=page_info)
+async def get_all_form(request: Request, page_info: PageInfo = Depends(PageInfo_), order_by: str = Query('id', regex='^(id|in_time_real)$', description="游标分页时的排序字段"),
+                       manager: Principal = Depends(get_user), session: Session = Depends(get_read_session)):
+    names = FORM_KEYSETS[order_by]
+    query, form_all = form_union_query(session, form_models(session), keyset=names, bounds=keyset_bounds(page_info, len(names)))
+    keyset = [form_all.c[name] for name in names]
+    # 不带条件的列表要count所有的分表，不count，用has_more判断有没有下一页
+    paginate = make_pagination(query.order_by(form_all.c.id), page_info, keyset=keyset, count_mode=CountMode.NONE)
     paginate_info = make_paginate_info(paginate, request)
     data = [to_FormDetailSerializer(form) for form in paginate.items]
     return success_response(data, paginate_info)
 
 
 @form_router.post("/search", summary="管理员搜索表单")
-async def get_all_form(request: Request, search_condiction: FormSearchSerializer, page_info: PageInfo = Depends(PageInfo_), manager: UserDB = Depends(get_user), session: Session = Depends(get_session)):
-    query = get_form_by_search(session=session, search_condiction=search_condiction)
-    paginate = Pagination(query, page_info=page_info)
+async def get_all_form(request: Request, search_condiction: FormSearchSerializer, page_info: PageInfo = Depends(PageInfo_), manager: Principal = Depends(get_user), session: Session = Depends(get_read_session)):
+    names = FORM_KEYSETS['id']
+    query, form_all = get_form_by_search(session=session, search_condiction=search_condiction, keyset=names, bounds=keyset_bounds(page_info, len(names)))
+    keyset = [form_all.c[name] for name in names]
+    paginate = make_pagination(query.order_by(form_all.c.id), page_info, keyset=keyset, count_mode=CountMode.CACHED, count_key=f'form-search:{search_condiction.json()}')
     paginate_info = make_paginate_info(paginate, request)
     data = [to_FormDetailSerializer(form) for form in paginate.items]
     return success_response(data, paginate_info)
 
 
 @form_router.delete("/{form_id}", summary="管理员删除指定表单")
-async def get_all_form(request: Request, form_id: int, manager: UserDB = Depends(get_user), session: Session = Depends(get_session)):
-    form = delete_form_by_id(session=session, form_id=form_id)
-    session.commit()
+async def get_all_form(request: Request, form_id: int, manager: Principal = Depends(get_user), db: Database = Depends(get_async_db)):
+    form = await async_delete_form_by_id(db, form_id)
+    if form is None:
+        return error_response(NotFound())
     return success_response(to_FormDetailSerializer(form))
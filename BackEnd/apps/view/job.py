@@ -0,0 +1,20 @@
+from fastapi import APIRouter, Depends
+
+from apps.a_common.error import NotFound, PermissionError
+from apps.a_common.job import get_job
+from apps.a_common.principal import Principal
+from apps.a_common.response import error_response, success_response
+from apps.logic.user import get_user
+
+job_router = APIRouter()
+job_prefix = 'jobs'
+
+
+@job_router.get("/{job_id}", summary="查看后台任务的进度，只有发起人和超级管理员能看")
+async def get_job_(job_id: str, user: Principal = Depends(get_user)):
+    job = get_job(job_id)
+    if job is None:
+        return error_response(NotFound())
+    if job.owner_id != user.id and not user.is_superuser:
+        return error_response(PermissionError())
+    return success_response(job.to_dict())
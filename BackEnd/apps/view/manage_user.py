@@ -1,30 +1,37 @@
 from logging import getLogger
 from typing import List
 
-from fastapi import APIRouter, Body, Depends, Query, Request
+from fastapi import APIRouter, BackgroundTasks, Body, Depends, Query, Request
 from sqlalchemy.orm import Session
 
-from apps.a_common.db import get_session, Pagination
+from apps.a_common.db import CountMode, get_session, make_pagination
 from apps.a_common.error import NotFound, PermissionError
-from apps.a_common.permission import has_permission_decorator, has_permission_manage_user
+from apps.a_common.job import create_job, run_job
+from apps.a_common.permission import has_permission_decorator, has_permission_manage_user, has_permission_manage_user_ids
+from apps.a_common.principal import Principal
+from apps.a_common.replica import get_read_session
 from apps.a_common.response import error_response, make_paginate_info, success_response
 from apps.a_common.scheme import CommonlyUsedUserSearch, CommonlyUsedUserSearch_, PageInfo, PageInfo_
-from apps.crud.user import add_user, get_user_by_id, get_users_by_id_list, common_user_search_with_permission_check
-from apps.logic.user import get_user
+from apps.crud.user import add_user, get_user_by_id, common_user_search_with_permission_check
+from apps.logic.user import get_user, invalidate_principal, reset_users_password, reset_users_password_job
 from apps.model.user import UserDB
 from apps.model.user2role import User2RoleDB
 from apps.serializer.user import BaseUserSerializer, ManagerCreateUser, to_UserDetailSerializer, ManagerUpdateUserSerializer
+from utils.encode import async_generate_password_hash
 
 manage_user_router = APIRouter()
 manage_user_prefix = 'manage-user'
 logger = getLogger(__name__)
 
+DEFAULT_PASSWORD = '123456789'
+RESET_PASSWORD_SYNC_LIMIT = 200  # 超过这个数量就放到后台任务里做
+
 
 @manage_user_router.get('/ids', summary="搜索用户的id")
 async def search_user_ids(sex: int = Query(None, ge=1, le=2),
                           keyword: str = None,
-                          manager: UserDB = Depends(get_user),
-                          session: Session = Depends(get_session)
+                          manager: Principal = Depends(get_user),
+                          session: Session = Depends(get_read_session)
                           ):
     query = session.query(UserDB.id)
     if sex:
@@ -40,36 +47,36 @@ async def search_user_ids(sex: int = Query(None, ge=1, le=2),
 async def search_user_(request: Request,
                        page_info: PageInfo = Depends(PageInfo_),
                        search_condition: CommonlyUsedUserSearch = Depends(CommonlyUsedUserSearch_),
-                       manager: UserDB = Depends(get_user),
-                       session: Session = Depends(get_session)
+                       manager: Principal = Depends(get_user),
+                       session: Session = Depends(get_read_session)
                        ):
     query = session.query(UserDB).join(User2RoleDB, User2RoleDB.user_id == UserDB.id)
     query, error = common_user_search_with_permission_check(manager, query, session, search_condition)
     if error:
         return error_response(error)
     
-    paginate = Pagination(query, page_info=page_info)
+    paginate = make_pagination(query, page_info, keyset=(UserDB.id,), count_mode=CountMode.CACHED)
     paginate_info = make_paginate_info(paginate, request)
     data = [BaseUserSerializer.from_orm(op_user).dict() for op_user in paginate.items]
     return success_response(data, paginate_info)
 
 
 @manage_user_router.get("/{op_user_id}", summary="管理员获取个人信息")
-async def read_op_user_(op_user_id: int, manager: UserDB = Depends(get_user), session: Session = Depends(get_session)):
+async def read_op_user_(op_user_id: int, manager: Principal = Depends(get_user), session: Session = Depends(get_session)):
     op_user = get_user_by_id(session, op_user_id)
     if op_user is None:
         return error_response(NotFound("没找到该用户~"))
-    if not has_permission_manage_user(manager, op_user):
+    if not has_permission_manage_user(session, manager, op_user_id):
         return error_response(PermissionError())
     
     return success_response(to_UserDetailSerializer(op_user))
 
 
 @manage_user_router.put("/{op_user_id}", summary="管理更新用户的数据，所有的字段都需要传递，除了id")
-async def update_op_user_(op_user_id: int, user_data: ManagerUpdateUserSerializer, manager: UserDB = Depends(get_user), session: Session = Depends(get_session)):
-    op_user = get_user_by_id(session, op_user_id)
-    if not has_permission_manage_user(manager, op_user):
+async def update_op_user_(op_user_id: int, user_data: ManagerUpdateUserSerializer, manager: Principal = Depends(get_user), session: Session = Depends(get_session)):
+    if not has_permission_manage_user(session, manager, op_user_id):
         return error_response(PermissionError())
+    op_user = get_user_by_id(session, op_user_id)
     
     op_user.sex = user_data.sex
     op_user.phone = user_data.phone
@@ -78,23 +85,30 @@ async def update_op_user_(op_user_id: int, user_data: ManagerUpdateUserSerialize
     op_user.birthday = user_data.birthday
     op_user.name = user_data.name
     session.commit()
+    invalidate_principal([op_user_id])
     return success_response(to_UserDetailSerializer(op_user))
 
 
 @manage_user_router.post("", summary="管理员创建用户")
 @has_permission_decorator('create-user')
-async def manager_create_user(user_data: ManagerCreateUser, manager: UserDB = Depends(get_user), session: Session = Depends(get_session)):
-    user = add_user(session, user_data)
+async def manager_create_user(user_data: ManagerCreateUser, manager: Principal = Depends(get_user), session: Session = Depends(get_session)):
+    user = add_user(session, user_data, await async_generate_password_hash(user_data.password))
     session.commit()
     return success_response(to_UserDetailSerializer(user))
 
 
-@manage_user_router.post("/reset-password", summary="管理员重置用户密码为123456789")
-async def manage_reset_password(op_user_id_list: List[int] = Body(...), manager: UserDB = Depends(get_user), session: Session = Depends(get_session)):
-    op_user_line = get_users_by_id_list(session, op_user_id_list)
-    for op_user in op_user_line:
-        if not has_permission_manage_user(manager, op_user):
-            return error_response(PermissionError())
-        op_user.generate_password_hash('123456789')
+@manage_user_router.post("/reset-password", summary="管理员重置用户密码为123456789", description=f"超过{RESET_PASSWORD_SYNC_LIMIT}个用户时转为后台任务，返回job_id，通过 /jobs/{{job_id}} 查看进度")
+async def manage_reset_password(background_tasks: BackgroundTasks, op_user_id_list: List[int] = Body(...), manager: Principal = Depends(get_user), session: Session = Depends(get_session)):
+    has_permission, op_user_ids = has_permission_manage_user_ids(session, manager, op_user_id_list)
+    if not has_permission:
+        return error_response(PermissionError())
+    
+    if len(op_user_ids) > RESET_PASSWORD_SYNC_LIMIT:
+        job = create_job('reset-password', manager.id, total=len(op_user_ids))
+        background_tasks.add_task(run_job, job, reset_users_password_job, op_user_ids, DEFAULT_PASSWORD)
+        return success_response({'count': len(op_user_ids), 'job_id': job.id})
+    
+    await reset_users_password(session, op_user_ids, DEFAULT_PASSWORD)
     session.commit()
-    return success_response({'count': len(op_user_line)})
+    invalidate_principal(op_user_ids)
+    return success_response({'count': len(op_user_ids)})
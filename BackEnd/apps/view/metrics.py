@@ -0,0 +1,30 @@
+from fastapi import APIRouter, Depends
+
+from apps.a_common.metrics import collect_metrics
+from apps.a_common.permission import is_superuser
+from apps.a_common.pool import pool_stats
+from apps.a_common.principal import Principal
+from apps.a_common.sql_trace import slow_queries
+from apps.a_common.response import success_response
+from apps.logic.user import get_user
+
+metrics_router = APIRouter()
+metrics_prefix = 'metrics'
+
+
+@metrics_router.get("", summary="进程内的各项统计数据，用于监控抓取")
+async def get_metrics():
+    return success_response(collect_metrics())
+
+
+# 下面两个接口带着数据库地址、sql和参数（手机号、密码的hash），只给超级管理员看
+@metrics_router.get("/sql-pool", summary="数据库连接池：大小、正在用的连接、overflow、取连接的等待时间和超时次数")
+@is_superuser
+async def get_sql_pool_metrics(manager: Principal = Depends(get_user)):
+    return success_response(pool_stats())
+
+
+@metrics_router.get("/slow-queries", summary="最近的慢查询，包括sql、参数、耗时和EXPLAIN的结果，最新的在前面")
+@is_superuser
+async def get_slow_queries(manager: Principal = Depends(get_user)):
+    return success_response(list(reversed(slow_queries)))
@@ -1,19 +1,23 @@
 from typing import List
 
-from fastapi import APIRouter, Body, Depends, Request
+from fastapi import APIRouter, BackgroundTasks, Body, Depends, Request
 from sqlalchemy.orm import Session
 
 from apps.a_common.constants import UserIdentity
-from apps.a_common.db import get_session
+from apps.a_common.db import get_session, id_filter
 from apps.a_common.error import AppError, InvalidParamError, NotFound, PermissionError
-from apps.a_common.permission import has_permission_manage_role, is_superuser, has_permission_manage_user_ids
+from apps.a_common.job import create_job, run_job
+from apps.a_common.permission import authorize_manage_user_ids, has_permission_manage_role, has_permission_manage_user, is_superuser
+from apps.a_common.principal import Principal
+from apps.a_common.replica import get_read_session
 from apps.a_common.response import empty_paginate_response, error_response, make_paginate_info, success_response
 from apps.a_common.scheme import PageInfo, PageInfo_
 from apps.crud.user import update_user_identity, cancel_user_as_admin_if_no_role
-from apps.crud.role import add_permission_to_role, add_role, get_role_by_id, get_role_by_user_id, get_role_under_user, get_users_by_role_id
-from apps.logic.user import get_user
+from apps.crud.role import add_permission_to_role, add_role, add_users_to_role, get_role_by_id, get_role_subtree_ids, get_role_by_user_id, get_role_under_user, get_users_by_role_id
+from apps.logic.role import delete_role_subtree, delete_role_subtree_job
+from apps.logic.role_tree import RoleNode, role_tree
+from apps.logic.user import get_user, invalidate_principal, invalidate_principal_by_role_ids
 from apps.model.permission2role import Permission2RoleDB
-from apps.model.user import UserDB
 from apps.model.user2role import User2RoleDB
 from apps.model.role import RoleDB
 from apps.serializer.user import BaseUserSerializer
@@ -22,18 +26,29 @@ from apps.serializer.role import RoleSerializer
 role_router = APIRouter()
 role_prefix = 'role'
 
+DELETE_ROLE_SYNC_LIMIT = 1000  # 子树超过这么多角色就放到后台任务里删
 
-def _check_group_exist_and_permission(session: Session, user: UserDB, role_id: int) -> (RoleDB, AppError):
-    role = get_role_by_id(session, role_id)
+
+def _check_group_exist_and_permission(session: Session, user: Principal, role_id: int, for_write: bool = False) -> (RoleNode, AppError):
+    """
+    祖先和权限的判断用进程内的角色树，不查数据库，需要修改角色的地方再用get_role_by_id取出RoleDB
+    别的worker删掉的角色，这里的树最多 ROLE_TREE_RELOAD_SECONDS 秒之后才知道
+    所以要写 user2role、permission2role 的接口传 for_write=True，按主键查一次数据库，不存在的话顺便从树里去掉
+    """
+    role_tree.ensure(session, [role_id])
+    role = role_tree.get(role_id)
+    if role is not None and for_write and get_role_by_id(session, role_id) is None:
+        role_tree.remove(role_tree.descendants(role_id))
+        role = None
     if role is None:
         return None, NotFound()
-    if not has_permission_manage_role(role, user):
+    if not has_permission_manage_role(session, role, user):
         return None, PermissionError()
     return role, None
 
 
 @role_router.get("", summary="角色列表，！！！这里有对这一系列接口的介绍！！！")
-async def role_list(request: Request, page_info: PageInfo = Depends(PageInfo_), manager: UserDB = Depends(get_user), session: Session = Depends(get_session)):
+async def role_list(request: Request, page_info: PageInfo = Depends(PageInfo_), manager: Principal = Depends(get_user), session: Session = Depends(get_read_session)):
     """
     role接口仅对外提供：
     1. user查看自己能看到的role
@@ -55,9 +70,8 @@ async def role_list(request: Request, page_info: PageInfo = Depends(PageInfo_),
 
 
 @role_router.get("/search", summary="查看某个人属于哪些角色")
-async def my_roles(user_id: int, manager: UserDB = Depends(get_user), session: Session = Depends(get_session)):
-    has_permission, user_ids = has_permission_manage_user_ids(session, manager, [user_id])
-    if not has_permission and not user_id == manager.id:
+async def my_roles(user_id: int, manager: Principal = Depends(get_user), session: Session = Depends(get_read_session)):
+    if not user_id == manager.id and not has_permission_manage_user(session, manager, user_id):
         return error_response(PermissionError())
     role_list = get_role_by_user_id(session, user_id)
     data = [RoleSerializer.from_orm(role).dict() for role in role_list]
@@ -65,7 +79,7 @@ async def my_roles(user_id: int, manager: UserDB = Depends(get_user), session: S
 
 
 @role_router.get("/{role_id}/users", summary="角色详情，即这个角色下有哪些用户", description="查看的group必须要小于等于自己的group")
-async def role_user_list(request: Request, role_id: int, page_info: PageInfo = Depends(PageInfo_), manager: UserDB = Depends(get_user), session: Session = Depends(get_session)):
+async def role_user_list(request: Request, role_id: int, page_info: PageInfo = Depends(PageInfo_), manager: Principal = Depends(get_user), session: Session = Depends(get_read_session)):
     role, err = _check_group_exist_and_permission(session, manager, role_id)
     if err is not None:
         return error_response(err)
@@ -77,86 +91,110 @@ async def role_user_list(request: Request, role_id: int, page_info: PageInfo = D
 
 
 @role_router.put("/{role_id}", summary="修改角色的名字", description="修改的group必须要小于等于自己的group")
-async def update_role_(role_id: int, data: RoleSerializer, manager: UserDB = Depends(get_user), session: Session = Depends(get_session)):
-    role, err = _check_group_exist_and_permission(session, manager, role_id)
+async def update_role_(role_id: int, data: RoleSerializer, manager: Principal = Depends(get_user), session: Session = Depends(get_session)):
+    _, err = _check_group_exist_and_permission(session, manager, role_id)
     if err is not None:
         return error_response(err)
+    role = get_role_by_id(session, role_id)
+    if role is None:
+        return error_response(NotFound())
     
     role.name = data.name
     if session.query(RoleDB).filter(RoleDB.name == data.name).first() != None:
         return error_response(InvalidParamError("角色名重复！"))
     session.add(role)
     session.commit()
+    role_tree.rename(role.id, role.name)
+    invalidate_principal_by_role_ids(session, [role_id])
     return success_response(RoleSerializer.from_orm(role).dict())
 
 
-@role_router.post("/{role_id}/users:add", summary="将用户批量添加到角色")
-async def add_user_to_role(role_id: int, user_ids: List[int] = Body(...), manager: UserDB = Depends(get_user), session: Session = Depends(get_session)):
-    role, err = _check_group_exist_and_permission(session, manager, role_id)
+@role_router.post("/{role_id}/users:add", summary="将用户批量添加到角色", description="重复添加不会报错，返回新加的数量added和已经在角色里的数量present")
+async def add_user_to_role(role_id: int, user_ids: List[int] = Body(...), manager: Principal = Depends(get_user), session: Session = Depends(get_session)):
+    role, err = _check_group_exist_and_permission(session, manager, role_id, for_write=True)
     if err is not None:
         return error_response(err)
-    has_permission, user_ids = has_permission_manage_user_ids(session, manager, user_ids)
-    if not has_permission:
-        return error_response(PermissionError())
+    user_ids, denied = authorize_manage_user_ids(session, manager, user_ids)
+    if denied and not manager.is_superuser:
+        return error_response(PermissionError(fields=denied))
     
-    session.add_all(tuple(User2RoleDB(user_id=i, role_id=role_id) for i in user_ids))
-    update_user_identity(session, user_ids, UserIdentity.ADMIN)
+    added_ids, present = add_users_to_role(session, role_id, user_ids)
+    update_user_identity(session, added_ids, UserIdentity.ADMIN)
     session.commit()
-    return success_response()
+    invalidate_principal(added_ids)
+    return success_response({'added': len(added_ids), 'present': present})
 
 
 @role_router.post("/{role_id}/users:delete", summary="将用户批量从角色中删除")
-async def del_user_to_role(role_id: int, user_ids: List[int], manager: UserDB = Depends(get_user), session: Session = Depends(get_session)):
-    role, err = _check_group_exist_and_permission(session, manager, role_id)
+async def del_user_to_role(role_id: int, user_ids: List[int], manager: Principal = Depends(get_user), session: Session = Depends(get_session)):
+    role, err = _check_group_exist_and_permission(session, manager, role_id, for_write=True)
     if err is not None:
         return error_response(err)
-    has_permission, user_ids = has_permission_manage_user_ids(session, manager, user_ids)
-    if not has_permission:
-        return error_response(PermissionError())
+    user_ids, denied = authorize_manage_user_ids(session, manager, user_ids)
+    if denied and not manager.is_superuser:
+        return error_response(PermissionError(fields=denied))
     
-    session.query(User2RoleDB).filter(User2RoleDB.role_id == role_id, User2RoleDB.user_id.in_(user_ids)).delete(False)
+    with id_filter(session, User2RoleDB.user_id, user_ids) as condition:
+        session.query(User2RoleDB).filter(User2RoleDB.role_id == role_id, condition).delete(False)
     cancel_user_as_admin_if_no_role(session, user_ids)
     session.commit()
+    invalidate_principal(user_ids)
     return success_response()
 
 
 @role_router.post("", summary="增加角色，这个接口不对外开放")
 @is_superuser
-async def add_role_(data: RoleSerializer, manager: UserDB = Depends(get_user), session: Session = Depends(get_session)):
+async def add_role_(data: RoleSerializer, manager: Principal = Depends(get_user), session: Session = Depends(get_session)):
     role = add_role(session, data)
     session.commit()
+    role_tree.add(role.id, role.name, role.parent_id)
     return success_response(RoleSerializer.from_orm(role).dict())
 
 
-@role_router.delete("/{role_id}", summary="删除角色, 同时删除用户的关联信息，这个接口不对外开放")
+@role_router.delete("/{role_id}", summary="递归删除角色和它的子角色, 同时删除用户、权限的关联信息，这个接口不对外开放",
+                    description=f"子树超过{DELETE_ROLE_SYNC_LIMIT}个角色时转为后台任务，返回值里带上job_id，通过 /jobs/{{job_id}} 查看进度")
 @is_superuser
-async def del_role(role_id: int, manager: UserDB = Depends(get_user), session: Session = Depends(get_session)):
-    role, err = _check_group_exist_and_permission(session, manager, role_id)
+async def del_role(role_id: int, background_tasks: BackgroundTasks, manager: Principal = Depends(get_user), session: Session = Depends(get_session)):
+    _, err = _check_group_exist_and_permission(session, manager, role_id)
     if err is not None:
         return error_response(err)
-    # todo: 这里按道理要递归删除，但是还没做
-    session.delete(role)
-    session.query(User2RoleDB).filter(User2RoleDB.role_id == role_id).delete(False)
+    role = get_role_by_id(session, role_id)
+    if role is None:
+        return error_response(NotFound())
+    data = RoleSerializer.from_orm(role).dict()
+    
+    role_ids = get_role_subtree_ids(session, role_id)
+    data['count'] = len(role_ids)
+    if len(role_ids) > DELETE_ROLE_SYNC_LIMIT:
+        job = create_job('delete-role', manager.id, total=len(role_ids))
+        background_tasks.add_task(run_job, job, delete_role_subtree_job, role_ids)
+        data['job_id'] = job.id
+        return success_response(data)
+    
+    user_ids = delete_role_subtree(session, role_ids)
     session.commit()
-    return success_response(RoleSerializer.from_orm(role).dict())
+    role_tree.remove(role_ids)
+    invalidate_principal(user_ids)
+    return success_response(data)
 
 
 @role_router.post("/{role_id}/permission:add", summary="将权限批量添加到角色，这个接口不对外开放")
 @is_superuser
-async def psot_permission_to_role_(role_id: int, permission_ids: List[int] = Body(...), manager: UserDB = Depends(get_user), session: Session = Depends(get_session)):
-    role, err = _check_group_exist_and_permission(session, manager, role_id)
+async def psot_permission_to_role_(role_id: int, permission_ids: List[int] = Body(...), manager: Principal = Depends(get_user), session: Session = Depends(get_session)):
+    role, err = _check_group_exist_and_permission(session, manager, role_id, for_write=True)
     if err is not None:
         return error_response(err)
     
     add_permission_to_role(session, permission_ids, role_id)
     session.commit()
+    invalidate_principal_by_role_ids(session, [role_id])
     return success_response()
 
 
 @role_router.post("/{role_id}/permission:delete", summary="将权限批量从角色中删除，这个接口不对外开放")
 @is_superuser
-async def del_permission_to_role(role_id: int, permission_ids: List[int], manager: UserDB = Depends(get_user), session: Session = Depends(get_session)):
-    role, err = _check_group_exist_and_permission(session, manager, role_id)
+async def del_permission_to_role(role_id: int, permission_ids: List[int], manager: Principal = Depends(get_user), session: Session = Depends(get_session)):
+    role, err = _check_group_exist_and_permission(session, manager, role_id, for_write=True)
     if err is not None:
         return error_response(err)
     
@@ -164,4 +202,5 @@ async def del_permission_to_role(role_id: int, permission_ids: List[int], manage
         filter(Permission2RoleDB.role_id == role_id). \
         filter(Permission2RoleDB.permission_id.in_(permission_ids)).delete(False)
     session.commit()
+    invalidate_principal_by_role_ids(session, [role_id])
     return success_response()
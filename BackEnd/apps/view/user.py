@@ -1,16 +1,19 @@
 from logging import getLogger
 
+from databases import Database
 from fastapi import APIRouter, Body, Depends
 from sqlalchemy.orm import Session
 
-from apps.a_common.db import get_session
+from apps.a_common.db import get_async_db, get_session
 from apps.a_common.error import WrongPassword
 from apps.a_common.jwt import encode_token
+from apps.a_common.principal import Principal
+from apps.a_common.replica import get_async_read_db
 from apps.a_common.response import error_response, success_response
-from apps.crud.user import add_user, get_user_by_phone_number, delete_user_by_id
-from apps.logic.user import get_user, get_user_id
-from apps.model.user import UserDB
+from apps.crud.user import add_user, async_get_user_by_id, async_get_user_by_phone_number, async_update_user_password, get_user_by_id, delete_user_by_id
+from apps.logic.user import get_user, get_user_id, invalidate_principal
 from apps.serializer.user import BaseUserSerializer, CreateUser, LoginSerializer, UserUpdateSerializer, to_UserDetailSerializer
+from utils.encode import async_generate_password_hash, password_need_rehash
 
 user_router = APIRouter()
 user_prefix = 'users'
@@ -19,18 +22,22 @@ logger = getLogger(__name__)
 
 @user_router.post("/register", summary="注册")
 async def register(user_data: CreateUser, session: Session = Depends(get_session)):
-    user = add_user(session, user_data)
+    user = add_user(session, user_data, await async_generate_password_hash(user_data.password))
     session.commit()
     return success_response(to_UserDetailSerializer(user))
 
 
 @user_router.post("/login", summary="登录")
-async def login_(login_data: LoginSerializer, session: Session = Depends(get_session)):
+async def login_(login_data: LoginSerializer, db: Database = Depends(get_async_db)):
     logger.info(f"phone number: {login_data.phone} login")
-    user = get_user_by_phone_number(session=session, phone_number=login_data.phone)
+    user = await async_get_user_by_phone_number(db, login_data.phone)
     logger.info(f'get user: {user}')
-    if user is None or not user.is_right_password(login_data.password):
+    if user is None or not await user.async_is_right_password(login_data.password):
         return error_response(WrongPassword())
+    if password_need_rehash(user.password):
+        # 迭代次数等参数变了，趁有明文密码的时候换成新参数的hash
+        await user.async_generate_password_hash(login_data.password)
+        await async_update_user_password(db, user.id, user.password)
     data = to_UserDetailSerializer(user)
     user_token = encode_token(user.id).decode()
     data['user_token'] = user_token
@@ -40,12 +47,14 @@ async def login_(login_data: LoginSerializer, session: Session = Depends(get_ses
 
 
 @user_router.get("/me", summary="获取个人信息")
-async def read_self_(user: UserDB = Depends(get_user), session: Session = Depends(get_session)):
+async def read_self_(principal: Principal = Depends(get_user), db: Database = Depends(get_async_read_db)):
+    user = await async_get_user_by_id(db, principal.id)
     return success_response(to_UserDetailSerializer(user))
 
 
 @user_router.put("/me", summary="更新用户的数据，所有的字段都需要传递")
-async def update_me_(user_data: UserUpdateSerializer, user: UserDB = Depends(get_user), session: Session = Depends(get_session)):
+async def update_me_(user_data: UserUpdateSerializer, principal: Principal = Depends(get_user), session: Session = Depends(get_session)):
+    user = get_user_by_id(session, principal.id)
     user.sex = user_data.sex
     user.phone = user_data.phone
     user.address = user_data.address
@@ -53,14 +62,17 @@ async def update_me_(user_data: UserUpdateSerializer, user: UserDB = Depends(get
     user.birthday = user_data.birthday
     session.add(user)
     session.commit()
+    invalidate_principal([user.id])
     return success_response(to_UserDetailSerializer(user))
 
 
 @user_router.post("/reset-password", summary="重置密码")
-async def reset_password(pw: str = Body(...), user: UserDB = Depends(get_user), session: Session = Depends(get_session)):
-    user.generate_password_hash(pw)
+async def reset_password(pw: str = Body(...), principal: Principal = Depends(get_user), session: Session = Depends(get_session)):
+    user = get_user_by_id(session, principal.id)
+    await user.async_generate_password_hash(pw)
     session.add(user)
     session.commit()
+    invalidate_principal([user.id])
     return success_response(BaseUserSerializer.from_orm(user).dict())
 
 
@@ -68,4 +80,5 @@ async def reset_password(pw: str = Body(...), user: UserDB = Depends(get_user),
 async def read_user_by_id_(user_id: int = Depends(get_user_id), session: Session = Depends(get_session)):
     delete_user_by_id(session=session, user_id=user_id)
     session.commit()
+    invalidate_principal([user_id])
     return success_response()
@@ -1,13 +1,29 @@
+import asyncio
+import json
 import logging
+import time
 
 import click
 import uvicorn
+from sqlalchemy import func
 
 from apps import Base, engine
-from apps.a_common.db import get_session_local
+from apps.a_common.db import IdFilterStrategy, choose_id_filter_strategy, get_async_db, get_session_local, id_filter
+from apps.a_common.index_audit import audit, capture_statements, parse_sql_log, write_migration
 from apps.a_common.permission import constants_permission_set
+from apps.crud.role import get_role_by_id
+from apps.crud.user import async_get_user_by_id, get_principal_by_id, get_user_by_id, get_user_by_phone_number
+from apps.a_common.error import DBError
+from apps.foundation import database
 from apps.logconfig import set_all_log_info
+from apps.logic.form_archive import ARCHIVE_FORMATS, ARCHIVE_PATH, archive_forms, iter_archived_forms
+from apps.logic.seed import SEED_BATCH_SIZE, seed_database
+from apps.model.form import FormMixin
+from apps.model.role import RoleDB
+from apps.model.user import UserDB
+from apps.model.user2role import User2RoleDB
 from config import DEBUG, HOST, PORT
+from utils.encode import calibrate_pbkdf2_iterations, HASH_NAME, PBKDF2_ITERATIONS
 
 
 @click.group()
@@ -35,33 +51,277 @@ def organization():
     pass
 
 
+@cli.group()
+def password():
+    pass
+
+
+@cli.group()
+def bench():
+    pass
+
+
+@cli.group()
+def form():
+    pass
+
+
 @db.command()
 def create():
     Base.metadata.create_all(bind=engine)
 
 
-@db.command()
-def clean():
+def _clean_tables():
+    """ 先drop表单的分表（见 DynamicModelMixin.drop_all），再清空其他的表，drop掉的分表还在metadata里，跳过 """
     with get_session_local() as session:
+        dropped = set(FormMixin.drop_all(session))
+        session.commit()
         for table in reversed(Base.metadata.sorted_tables):
-            session.execute(table.delete())
+            if table.name not in dropped:
+                session.execute(table.delete())
         session.commit()
 
 
+@db.command()
+def clean():
+    _clean_tables()
+
+
 @db.command()
 def reset():
-    with get_session_local() as session:
-        for table in reversed(Base.metadata.sorted_tables):
-            session.execute(table.delete())
-        session.commit()
+    _clean_tables()
     Base.metadata.create_all(bind=engine)
 
 
+@db.command('index-audit')
+@click.option('--log', 'log_files', multiple=True, type=click.Path(exists=True), help='sqlalchemy.engine 的日志（config.py 的 SQL_LOG），可以给多个；不给就跑一遍测试来收集sql')
+@click.option('--pytest-args', default='apps/test -q -p no:cacheprovider', show_default=True, help='收集sql时跑测试用的参数')
+@click.option('--migration/--no-migration', default=True, show_default=True, help='是否为缺的索引生成alembic的migration')
+def index_audit(log_files, pytest_args, migration):
+    """ EXPLAIN程序发出的每一条select，报告全表扫描和缺的索引 """
+    if log_files:
+        statements = {}
+        for path in log_files:
+            with open(path, encoding='utf-8') as f:
+                for statement, parameters in parse_sql_log(f):
+                    statements.setdefault(statement, parameters)
+        targets = [(engine, statements.items())]
+    else:
+        import pytest
+        with capture_statements() as captured:
+            pytest.main(pytest_args.split())
+        targets = [(e, statements.values()) for e, statements in captured.items()]
+    
+    missing = {}
+    for target_engine, statements in targets:
+        statements = [*statements]
+        report, target_missing = audit(target_engine, statements)
+        print(f'{target_engine.url!r}: {len(statements)} statements, {len(report)} full scans')
+        for item in report:
+            print(f'\n[{item["table"]}] missing: {", ".join(item["missing"]) or "-"}')
+            print(item['statement'])
+            for row in item['plan']:
+                print(f'    {row}')
+        missing.update(dict.fromkeys(target_missing))
+    
+    if not missing:
+        print('\nno missing index')
+        return
+    print('\nmissing indexes: ' + ', '.join(f'{table}.{column}' for table, column in missing))
+    if migration:
+        print(f'migration: {write_migration([*missing])}')
+
+
+@cli.command()
+@click.option('--users', default=1000, show_default=True)
+@click.option('--roles-depth', default=4, show_default=True, help='角色树的深度')
+@click.option('--roles-fanout', default=3, show_default=True, help='每个角色平均的子角色数')
+@click.option('--permissions', default=50, show_default=True, help='普通权限的数量，另外每个角色还有管理它的权限')
+@click.option('--forms', default=10000, show_default=True)
+@click.option('--months', default=6, show_default=True, help='表单的申请时间分布在2021-06-01之前的几个月')
+@click.option('--seed', 'random_seed', default=0, show_default=True, help='随机数种子，一样的种子生成一样的数据')
+@click.option('--password', default='123456', show_default=True, help='所有用户的密码')
+@click.option('--batch-size', default=SEED_BATCH_SIZE, show_default=True, help='每次executemany的行数')
+def seed(users, roles_depth, roles_fanout, permissions, forms, months, random_seed, password, batch_size):
+    """ 批量造数据，用来在本地压测、看执行计划 """
+    start = time.perf_counter()
+    with get_session_local() as session:
+        counts = seed_database(session, users, roles_depth, forms, random_seed, roles_fanout, permissions, password, months, batch_size)
+    for table, count in counts.items():
+        print(f'{table:>16}{count:>12}')
+    print(f'done in {time.perf_counter() - start:.1f}s')
+
+
+# python manage.py seed 和 python manage.py db seed 都可以
+db.add_command(seed)
+
+
+@form.command()
+@click.option('--before', required=True, help='归档申请入校时间早于这一天（北京时间，YYYY-MM-DD）的表单')
+@click.option('--path', default=ARCHIVE_PATH, show_default=True, help='归档文件的目录')
+@click.option('--format', 'fmt', type=click.Choice(ARCHIVE_FORMATS), default='ndjson', show_default=True)
+@click.option('--batch-size', default=5000, show_default=True, help='每次从数据库读出的行数')
+@click.option('--delete-batch-size', default=500, show_default=True, help='每次删除的行数，每批单独提交')
+@click.option('--pause', default=0.0, show_default=True, help='每批删除之后停顿的秒数，给从库追日志')
+@click.option('--keep', is_flag=True, help='只归档和校验，不删除数据库里的数据')
+def archive(before, path, fmt, batch_size, delete_batch_size, pause, keep):
+    """ 把旧表单归档成压缩文件，校验之后从数据库删除 """
+    with get_session_local() as session:
+        try:
+            manifest = archive_forms(session, before, path, fmt, batch_size, delete_batch_size, pause, keep)
+        except DBError as e:
+            raise click.ClickException(f'archive verify fail, rows of this table are kept: {e.fields}')
+    for table, item in manifest['tables'].items():
+        print(f'{table:>16}{item["rows"]:>10} rows{len(item["files"]):>6} files  {item["action"]}')
+    print(f'manifest: {path}manifest-{manifest["run_id"]}.json')
+
+
+@form.command('archive-query')
+@click.option('--from', 'date_from', help='申请日期的下限，YYYY-MM-DD')
+@click.option('--to', 'date_to', help='申请日期的上限，YYYY-MM-DD')
+@click.option('--path', default=ARCHIVE_PATH, show_default=True)
+@click.option('--id', 'form_id', type=int)
+@click.option('--phone')
+@click.option('--name')
+@click.option('--id-card', 'id_card')
+def archive_query(date_from, date_to, path, form_id, phone, name, id_card):
+    """ 查归档了的表单，每行输出一个json """
+    equals = {k: v for k, v in (('id', form_id), ('phone', phone), ('name', name), ('IDCard', id_card)) if v is not None}
+    for row in iter_archived_forms(date_from, date_to, path, **equals):
+        print(json.dumps(row, ensure_ascii=False))
+
+
 @permission.command()
 def list():
     for key in constants_permission_set:
         print(key)
 
 
+@password.command()
+@click.option('--target-ms', default=100, show_default=True, help='期望单次hash的耗时（毫秒）')
+@click.option('--hash-name', default=HASH_NAME, show_default=True)
+def calibrate(target_ms, hash_name):
+    """ 测出本机上单次hash耗时为target-ms的迭代次数并打印出来，不会改配置，要自己把它写到config.py的PBKDF2_ITERATIONS，改了之后旧密码会在用户下次登录时自动升级 """
+    iterations = calibrate_pbkdf2_iterations(target_ms, hash_name)
+    print(f'current PBKDF2_ITERATIONS = {PBKDF2_ITERATIONS}')
+    print(f'PBKDF2_ITERATIONS = {iterations}  # about {target_ms}ms per hash with {hash_name} on this host')
+
+
+@bench.command('id-filter')
+@click.option('--sizes', default='4,8,32,128,500,900,2000,5000,20000', show_default=True, help='id的数量，逗号分隔')
+@click.option('--repeat', default=5, show_default=True)
+@click.option('--or-limit', default=2000, show_default=True, help='or的条件太多时数据库会很慢甚至报错，超过这个数量不测or')
+def bench_id_filter(sizes, repeat, or_limit):
+    """ 在当前配置的数据库上比较 or / 分块in / 临时表 三种方式的耗时，用来调整 apps/a_common/db.py 里的阈值 """
+    strategies = (IdFilterStrategy.OR, IdFilterStrategy.IN, IdFilterStrategy.TEMP_TABLE)
+    print(f'{"size":>8}' + ''.join(f'{s:>14}' for s in strategies) + f'{"chosen":>14}')
+    with get_session_local() as session:
+        dialect_name = session.get_bind().dialect.name
+        for size in (int(i) for i in sizes.split(',')):
+            ids = range(1, size + 1)
+            cost = []
+            for strategy in strategies:
+                if strategy == IdFilterStrategy.OR and size > or_limit:
+                    cost.append('-')
+                    continue
+                try:
+                    start = time.perf_counter()
+                    for _ in range(repeat):
+                        with id_filter(session, UserDB.id, ids, strategy=strategy) as condition:
+                            session.query(func.count(UserDB.id)).filter(condition).scalar()
+                    cost.append(f'{(time.perf_counter() - start) / repeat * 1000:.2f}ms')
+                except Exception as e:
+                    cost.append('fail')
+                    logging.warning(f'{strategy} with {size} ids fail: {e}')
+                finally:
+                    session.rollback()
+            print(f'{size:>8}' + ''.join(f'{c:>14}' for c in cost) + f'{choose_id_filter_strategy(dialect_name, size):>14}')
+
+
+@bench.command('async-db')
+@click.option('--concurrency', default=50, show_default=True, help='同时在跑的请求数')
+@click.option('--requests', 'total', default=2000, show_default=True)
+def bench_async_db(concurrency, total):
+    """
+    模拟async接口里查一次用户的吞吐：
+    sync 是原来的写法，在事件循环里直接用session查，会阻塞其他请求
+    async 是用 get_async_db 的写法
+    """
+    with get_session_local() as session:
+        user_id = session.query(UserDB.id).limit(1).scalar()
+    if user_id is None:
+        print('no user in database, register one first')
+        return
+    
+    async def sync_request():
+        with get_session_local() as session:
+            get_user_by_id(session, user_id)
+    
+    async def async_request():
+        await async_get_user_by_id(await get_async_db(), user_id)
+    
+    async def run(request):
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def limited():
+            async with semaphore:
+                await request()
+        
+        start = time.perf_counter()
+        await asyncio.gather(*(limited() for _ in range(total)))
+        return time.perf_counter() - start
+    
+    async def main():
+        result = {}
+        for name, request in (('sync', sync_request), ('async', async_request)):
+            await run(request)  # 预热连接池
+            result[name] = await run(request)
+        await database.disconnect()
+        return result
+    
+    for name, cost in asyncio.run(main()).items():
+        print(f'{name:>8}{total / cost:>12.1f} req/s{cost * 1000 / total:>10.3f} ms/req')
+
+
+@bench.command('baked-query')
+@click.option('--repeat', default=2000, show_default=True)
+def bench_baked_query(repeat):
+    """ 比较热点查询每次重新构造Query（原来的写法）和用bakery缓存之后的单次耗时 """
+    with get_session_local() as session:
+        user = session.query(UserDB).first()
+        role_id = session.query(RoleDB.id).limit(1).scalar() or 0
+        if user is None:
+            print('no user in database, register one first')
+            return
+        
+        cases = (
+            ('user_by_id',
+             lambda: session.query(UserDB).filter(UserDB.id == user.id).first(),
+             lambda: get_user_by_id(session, user.id)),
+            ('user_by_phone',
+             lambda: session.query(UserDB).filter(UserDB.phone == user.phone).first(),
+             lambda: get_user_by_phone_number(session, user.phone)),
+            ('role_by_id',
+             lambda: session.query(RoleDB).filter(RoleDB.id == role_id).first(),
+             lambda: get_role_by_id(session, role_id)),
+            ('principal',
+             lambda: session.query(UserDB.is_superuser, RoleDB.id, RoleDB.name).
+                 outerjoin(User2RoleDB, User2RoleDB.user_id == UserDB.id).
+                 outerjoin(RoleDB, RoleDB.id == User2RoleDB.role_id).
+                 filter(UserDB.id == user.id).all(),
+             lambda: get_principal_by_id(session, user.id)),
+        )
+        print(f'{"query":>16}{"query us/call":>16}{"baked us/call":>16}')
+        for name, *functions in cases:
+            cost = []
+            for function in functions:
+                function()  # 预热，baked的第一次调用会编译并放进缓存
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    function()
+                cost.append((time.perf_counter() - start) / repeat * 1000000)
+            print(f'{name:>16}{cost[0]:>16.1f}{cost[1]:>16.1f}')
+
+
 if __name__ == "__main__":
     cli()
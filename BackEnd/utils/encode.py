@@ -1,8 +1,15 @@
+import asyncio
 import binascii
 import datetime
 import decimal
 import hashlib
+import hmac
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 from json import JSONEncoder
+from threading import Lock
+from typing import List
 from random import SystemRandom
 from uuid import UUID, uuid4 as _uuid4
 
@@ -72,9 +79,16 @@ _sys_rng = SystemRandom()
 SALT_CHARS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
 DEFAULT_PBKDF2_ITERATIONS = 150000
 HASH_NAME = 'sha256'
-METHOD_NAME = f'pbkdf2:{HASH_NAME}:{DEFAULT_PBKDF2_ITERATIONS}'
 SALT_LEN = 8
 
+try:
+    from config import PBKDF2_ITERATIONS
+except ImportError:
+    PBKDF2_ITERATIONS = DEFAULT_PBKDF2_ITERATIONS
+
+# 存下来的hash形如 pbkdf2:sha256:150000$salt$hash，参数跟着hash走，修改迭代次数不影响旧密码的验证
+METHOD_NAME = f'pbkdf2:{HASH_NAME}:{PBKDF2_ITERATIONS}'
+
 
 def gen_salt(length) -> str:
     if length <= 0:
@@ -82,8 +96,8 @@ def gen_salt(length) -> str:
     return "".join(_sys_rng.choice(SALT_CHARS) for _ in range(length))
 
 
-def hash_password(pw: bytes, salt: bytes) -> str:
-    h = hashlib.pbkdf2_hmac(HASH_NAME, pw, salt, 150000)
+def hash_password(pw: bytes, salt: bytes, iterations: int = PBKDF2_ITERATIONS, hash_name: str = HASH_NAME) -> str:
+    h = hashlib.pbkdf2_hmac(hash_name, pw, salt, iterations)
     return binascii.hexlify(h).decode('utf-8')
 
 
@@ -93,12 +107,114 @@ def generate_password_hash(pw: str) -> str:
     return "%s$%s$%s" % (METHOD_NAME, salt, h)
 
 
+def parse_method(method: str) -> (str, int):
+    """ pbkdf2:sha256:150000 -> ('sha256', 150000)，格式不对时抛ValueError """
+    algorithm, hash_name, iterations = method.split(':')
+    if algorithm != 'pbkdf2':
+        raise ValueError(f'unsupported password method: {method}')
+    return hash_name, int(iterations)
+
+
 def is_right_password(pw: str, hashpw: str) -> bool:
-    if hashpw.count("$") < 2:
+    if not hashpw or hashpw.count("$") < 2:
         return False
-    _, salt, hashval = hashpw.split("$", 2)
-    h = hash_password(pw.encode('utf-8'), salt.encode())
-    return h == hashval
+    method, salt, hashval = hashpw.split("$", 2)
+    try:
+        hash_name, iterations = parse_method(method)
+    except ValueError:
+        return False
+    h = hash_password(pw.encode('utf-8'), salt.encode(), iterations, hash_name)
+    return hmac.compare_digest(h, hashval)
+
+
+def password_need_rehash(hashpw: str) -> bool:
+    """ 旧的hash用的参数和现在配置的不一致，登录成功后要重新算一遍 """
+    if not hashpw or hashpw.count("$") < 2:
+        return True
+    return hashpw.split("$", 1)[0] != METHOD_NAME
+
+
+def calibrate_pbkdf2_iterations(target_ms: float, hash_name: str = HASH_NAME, sample_iterations: int = 50000, rounds: int = 5) -> int:
+    """ 在本机上测PBKDF2的速度，算出单次hash耗时约为target_ms的迭代次数，取整到千 """
+    salt = gen_salt(SALT_LEN).encode()
+    cost = min(_time_pbkdf2(hash_name, salt, sample_iterations) for _ in range(rounds))
+    iterations = int(sample_iterations * target_ms / 1000 / cost)
+    return max(iterations // 1000 * 1000, 1000)
+
+
+def _time_pbkdf2(hash_name: str, salt: bytes, iterations: int) -> float:
+    start = time.perf_counter()
+    hashlib.pbkdf2_hmac(hash_name, b'calibrate', salt, iterations)
+    return time.perf_counter() - start
+
+
+""" PBKDF2很耗CPU，在async的接口里直接算会卡住整个事件循环，所以放到进程池里算 """
+HASH_POOL_SIZE = max((os.cpu_count() or 1) // 2, 1)
+HASH_MAX_PENDING = HASH_POOL_SIZE * 16  # 排队+正在算的任务上限，超过直接拒绝，避免请求越积越多
+
+_hash_pool = None
+_hash_pool_lock = Lock()
+_hash_pool_stats = {'pending': 0, 'submitted': 0, 'completed': 0, 'rejected': 0}
+
+
+def _get_hash_pool() -> ProcessPoolExecutor:
+    global _hash_pool
+    if _hash_pool is None:
+        with _hash_pool_lock:
+            if _hash_pool is None:
+                _hash_pool = ProcessPoolExecutor(max_workers=HASH_POOL_SIZE)
+    return _hash_pool
+
+
+async def _run_in_hash_pool(func, *args):
+    with _hash_pool_lock:
+        if _hash_pool_stats['pending'] >= HASH_MAX_PENDING:
+            _hash_pool_stats['rejected'] += 1
+            from apps.a_common.error import RequestThrottled
+            raise RequestThrottled()
+        _hash_pool_stats['pending'] += 1
+        _hash_pool_stats['submitted'] += 1
+    
+    try:
+        return await asyncio.get_event_loop().run_in_executor(_get_hash_pool(), func, *args)
+    finally:
+        with _hash_pool_lock:
+            _hash_pool_stats['pending'] -= 1
+            _hash_pool_stats['completed'] += 1
+
+
+async def async_generate_password_hash(pw: str) -> str:
+    return await _run_in_hash_pool(generate_password_hash, pw)
+
+
+async def async_is_right_password(pw: str, hashpw: str) -> bool:
+    return await _run_in_hash_pool(is_right_password, pw, hashpw)
+
+
+def _generate_password_hash_chunk(pw_list: List[str]) -> List[str]:
+    return [generate_password_hash(pw) for pw in pw_list]
+
+
+async def async_generate_password_hash_batch(pw_list: List[str]) -> List[str]:
+    """ 批量算hash，切成和进程数一样多的块，分到各个进程里并行计算，返回的顺序和传入的一致 """
+    if not pw_list:
+        return []
+    chunk_size = -(-len(pw_list) // HASH_POOL_SIZE)
+    chunks = [pw_list[i:i + chunk_size] for i in range(0, len(pw_list), chunk_size)]
+    results = await asyncio.gather(*(_run_in_hash_pool(_generate_password_hash_chunk, chunk) for chunk in chunks))
+    return [h for chunk in results for h in chunk]
+
+
+def hash_pool_stats() -> dict:
+    return dict(_hash_pool_stats, max_workers=HASH_POOL_SIZE, max_pending=HASH_MAX_PENDING)
+
+
+def shutdown_hash_pool():
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is not None:
+            _hash_pool.shutdown(wait=False)
+            _hash_pool = None
 
 
 def get_birthday_by_IDCard(id: str) -> datetime.datetime: